@@ -0,0 +1,264 @@
+#
+# Benchmark the anomaly scorers - execute time and peak memory over entity counts and series lengths
+#   synthetic frames with 1 to 10^4 entities and 10^2 to 10^6 readings each, a Temperature sine with noise and
+#   spikes and a correlated Pressure; every case runs in a forked process after a warm-up run on a small frame,
+#   which pays for first-use imports, and is stopped after --timeout seconds
+#
+#   python benchmarks/bench_anomaly.py                                  default grid up to 10^6 rows
+#   python benchmarks/bench_anomaly.py --entities 1 10 --points 1000 --scorers KDEAnomalyScore
+#   python benchmarks/bench_anomaly.py --output new.json --baseline old.json    exits with 1 on regressions
+#
+# Results go to a JSON file: run metadata and one record per scorer, entity count and series length with
+#   status ok, error, timeout or skipped, seconds, rows per second, peak resident memory and its growth during
+#   execute. Peak memory is taken from VmHWM after resetting it through /proc/self/clear_refs (Linux).
+#
+
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, Float
+
+from mmfunctions import anomaly
+from mmfunctions.modelstore import LocalDatabase
+
+Temperature = 'Temperature'
+Pressure = 'Pressure'
+
+# scorer name: function with the arguments used in the benchmark
+scorers = {
+    'SpectralAnomalyScore': lambda: anomaly.SpectralAnomalyScore(Temperature, 12, 'score'),
+    'SpectralAnomalyScoreExt': lambda: anomaly.SpectralAnomalyScoreExt(Temperature, 12, 'score', 'inv_score'),
+    'KMeansAnomalyScore': lambda: anomaly.KMeansAnomalyScore(Temperature, 12, 'score'),
+    'GeneralizedAnomalyScore': lambda: anomaly.GeneralizedAnomalyScore(Temperature, 12, 'score'),
+    'NoDataAnomalyScore': lambda: anomaly.NoDataAnomalyScore(Temperature, 12, 'score'),
+    'FFTbasedGeneralizedAnomalyScore': lambda: anomaly.FFTbasedGeneralizedAnomalyScore(Temperature, 12, 'score'),
+    'FFTbasedGeneralizedAnomalyScore2':
+        lambda: anomaly.FFTbasedGeneralizedAnomalyScore2(Temperature, 12, 0.5, 'score'),
+    'SaliencybasedGeneralizedAnomalyScore':
+        lambda: anomaly.SaliencybasedGeneralizedAnomalyScore(Temperature, 12, 'score'),
+    'KMeansAnomalyScoreV2': lambda: anomaly.KMeansAnomalyScoreV2(Temperature, 12, True, 'score'),
+    'GeneralizedAnomalyScoreV2': lambda: anomaly.GeneralizedAnomalyScoreV2(Temperature, 12, True, 'score'),
+    'FFTbasedGeneralizedAnomalyScoreV2':
+        lambda: anomaly.FFTbasedGeneralizedAnomalyScoreV2(Temperature, 12, True, 'score'),
+    'SaliencybasedGeneralizedAnomalyScoreV2':
+        lambda: anomaly.SaliencybasedGeneralizedAnomalyScoreV2(Temperature, 12, True, 'score'),
+    'KDEAnomalyScore': lambda: anomaly.KDEAnomalyScore(1e-6, [Temperature], [Pressure]),
+    'VIAnomalyScore': lambda: vi_anomaly_score(),
+    'OnlineChangePoint': lambda: anomaly.OnlineChangePoint(Temperature),
+    'ChangePointSegmentation': lambda: anomaly.ChangePointSegmentation(Temperature),
+}
+# only defined for some iotfunctions versions
+if hasattr(anomaly, 'MatrixProfileAnomalyScore'):
+    scorers['MatrixProfileAnomalyScore'] = lambda: anomaly.MatrixProfileAnomalyScore(Temperature, 12, 'score')
+
+
+def vi_anomaly_score():
+    scorer = anomaly.VIAnomalyScore([Temperature], [Pressure])
+    # the pipeline switches training on, without it there is nothing to score with
+    scorer.auto_train = True
+    return scorer
+
+
+def make_frame(n_entities, n_points, seed=42):
+    """
+    Readings every minute, a daily Temperature cycle with noise and spikes, Pressure following Temperature
+    """
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range('2021-01-01', periods=n_points, freq='min')
+    index = pd.MultiIndex.from_product([['Pump' + str(i) for i in range(n_entities)], timestamps],
+                                       names=['entity', 'timestamp'])
+    minute = np.tile(np.arange(n_points), n_entities)
+    phase = np.repeat(rng.uniform(0, 2 * np.pi, n_entities), n_points)
+    temperature = 20 + 2 * np.sin(2 * np.pi * minute / 1440 + phase) + rng.normal(0, 0.5, len(minute))
+    spikes = rng.random(len(minute)) < 0.001
+    temperature[spikes] += rng.normal(0, 10, spikes.sum())
+    pressure = 0.5 * temperature + rng.normal(0, 0.2, len(minute))
+    return pd.DataFrame({Temperature: temperature, Pressure: pressure}, index=index)
+
+
+def memory_status():
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS', 'VmHWM')):
+                key, value = line.split(':')
+                status[key] = int(value.split()[0]) / 1024
+    return status
+
+
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def build_scorer(name, path):
+    scorer = scorers[name]()
+    # set by the pipeline, part of model names
+    scorer.name = name
+    scorer._entity_type = scorer._build_entity_type(name='bench', db=LocalDatabase(path),
+                                                    columns=[Column(Temperature, Float()), Column(Pressure, Float())])
+    return scorer
+
+
+def run_case(name, n_entities, n_points, connection):
+    """
+    Runs in the forked process, sends the measurements back
+    """
+    warnings.simplefilter('ignore')
+    logging.disable(logging.CRITICAL)
+    result = {}
+    try:
+        with tempfile.TemporaryDirectory() as warmup_path, tempfile.TemporaryDirectory() as path, \
+                open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # first use imports, the models it stores are kept apart from the measured run
+            build_scorer(name, warmup_path).execute(df=make_frame(1, 100, seed=1))
+
+            df = make_frame(n_entities, n_points)
+            scorer = build_scorer(name, path)
+            before = memory_status()
+            peak_reset = reset_peak_memory()
+
+            start = time.perf_counter()
+            scorer.execute(df=df)
+            seconds = time.perf_counter() - start
+
+            after = memory_status()
+        result = {'status': 'ok', 'seconds': seconds, 'rows_per_s': len(df) / seconds if seconds > 0 else None,
+                  'peak_rss_mb': after['VmHWM'], 'execute_mb': after['VmHWM'] - before['VmRSS'] if peak_reset else None}
+    except Exception as e:
+        result = {'status': 'error', 'error': type(e).__name__ + ': ' + str(e)[:500]}
+    connection.send(result)
+    connection.close()
+
+
+def measure(name, n_entities, n_points, timeout):
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_case, args=(name, n_entities, n_points, sender))
+    process.start()
+    sender.close()
+    if receiver.poll(timeout):
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = {'status': 'error', 'error': 'benchmark process died'}
+    else:
+        process.kill()
+        result = {'status': 'timeout', 'seconds': timeout}
+    process.join()
+    if process.exitcode not in (0, None) and result.get('status') == 'ok':
+        result['status'] = 'error'
+    return result
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'timestamp': pd.Timestamp.now().isoformat(), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__}
+
+
+def scaling(results):
+    """
+    Slope of log seconds over log rows per scorer - 1 is linear in the number of rows
+    """
+    slopes = {}
+    for name in sorted(set(r['scorer'] for r in results)):
+        ok = [r for r in results if r['scorer'] == name and r['status'] == 'ok' and r['seconds'] > 0]
+        if len(set(r['rows'] for r in ok)) >= 2:
+            slopes[name] = float(np.polyfit(np.log([r['rows'] for r in ok]), np.log([r['seconds'] for r in ok]), 1)[0])
+    return slopes
+
+
+def regressions(results, baseline, tolerance, noise_floor=0.05):
+    """
+    Cases that got slower than tolerance times the baseline, or stopped working
+    """
+    previous = {(r['scorer'], r['entities'], r['points']): r for r in baseline['results']}
+    found = []
+    for r in results:
+        old = previous.get((r['scorer'], r['entities'], r['points']))
+        if old is None or old['status'] != 'ok':
+            continue
+        if r['status'] != 'ok':
+            found.append((r, old, None))
+        elif r['seconds'] > max(tolerance * old['seconds'], noise_floor):
+            found.append((r, old, r['seconds'] / old['seconds']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the anomaly scorers')
+    parser.add_argument('--entities', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('--points', type=int, nargs='+', default=[100, 1000, 10000, 100000, 1000000],
+                        help='readings per entity')
+    parser.add_argument('--scorers', nargs='+', default=sorted(scorers), choices=sorted(scorers), metavar='SCORER')
+    parser.add_argument('--max-rows', type=int, default=1000000, help='skip cases with more rows')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds per case')
+    parser.add_argument('--output', default='bench_anomaly.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown against the baseline reported')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.scorers:
+        # larger cases of a scorer that ran out of time are not tried
+        limit = None
+        for n_entities in sorted(args.entities):
+            for n_points in sorted(args.points):
+                rows = n_entities * n_points
+                record = {'scorer': name, 'entities': n_entities, 'points': n_points, 'rows': rows}
+                if rows > args.max_rows or (limit is not None and rows >= limit):
+                    record['status'] = 'skipped'
+                else:
+                    record.update(measure(name, n_entities, n_points, args.timeout))
+                    if record['status'] == 'timeout':
+                        limit = rows if limit is None else min(limit, rows)
+                results.append(record)
+                if record['status'] == 'ok':
+                    print('%-40s %6d x %-8d %9.3f s %12.0f rows/s %8.1f MB' % (
+                        name, n_entities, n_points, record['seconds'], record['rows_per_s'],
+                        record['peak_rss_mb']), flush=True)
+                elif record['status'] != 'skipped':
+                    print('%-40s %6d x %-8d %s %s' % (name, n_entities, n_points, record['status'],
+                                                      record.get('error', '')), flush=True)
+
+    report = {'meta': metadata(), 'results': results, 'scaling': scaling(results)}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('scaling exponents (seconds ~ rows^k): ' + json.dumps(report['scaling']))
+    print('results written to ' + args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for r, old, ratio in found:
+            print('REGRESSION %-40s %6d x %-8d %s' % (r['scorer'], r['entities'], r['points'],
+                                                     r['status'] if ratio is None else '%.2fx slower' % ratio))
+        if len(found) > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
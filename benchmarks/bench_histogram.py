@@ -0,0 +1,69 @@
+#
+# Benchmark histogram aggregation - HistogramAggregator.execute per group vs execute_bulk
+#   and HistogramDirectAggregator, the bulk path as the pipeline runs it
+#   10^6 rows, 100 devices with 100 readings per hour over 100 hours - 10^4 device/hour groups, 15 bins
+#
+#   python benchmarks/bench_histogram.py
+#
+
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from mmfunctions.anomaly import HistogramAggregator, HistogramDirectAggregator
+
+# make_histogram logs every group
+logging.disable(logging.WARNING)
+
+n_rows = 1000000
+n_groups = 10000
+bins = 15
+
+n_devices = 100
+rows_per_device = n_rows // n_devices
+
+rng = np.random.default_rng(42)
+devices = np.repeat(np.arange(n_devices), rows_per_device)
+timestamps = pd.Timestamp('2021-01-01') + pd.to_timedelta(np.tile(np.arange(rows_per_device) * 36, n_devices),
+                                                          unit='s')
+df = pd.DataFrame({'deviceid': devices, 'timestamp': timestamps,
+                   'Temperature': rng.normal(20, 2, n_rows)}).set_index(['deviceid', 'timestamp'])
+
+group_base = [pd.Grouper(freq='1H', level='timestamp'), pd.Grouper(level='deviceid')]
+grouped = df.groupby(group_base)['Temperature']
+print('rows: %d  groups: %d  bins: %d' % (n_rows, grouped.ngroups, bins))
+
+aggregator = HistogramAggregator('Temperature', bins)
+
+start = time.perf_counter()
+per_group = grouped.agg(aggregator.execute)
+t_per_group = time.perf_counter() - start
+
+start = time.perf_counter()
+numeric = aggregator.execute_bulk(grouped)
+t_numeric = time.perf_counter() - start
+
+start = time.perf_counter()
+string = aggregator.execute_bulk(grouped, encoding='string')
+t_string = time.perf_counter() - start
+
+direct = HistogramDirectAggregator('Temperature', bins, name='histogram')
+start = time.perf_counter()
+df_direct = direct.execute(df=df, group_base=group_base, group_base_names=['timestamp', 'deviceid'])
+t_direct = time.perf_counter() - start
+
+direct_numeric = HistogramDirectAggregator('Temperature', bins, name='histogram', encoding='numeric')
+start = time.perf_counter()
+df_direct_numeric = direct_numeric.execute(df=df, group_base=group_base, group_base_names=['timestamp', 'deviceid'])
+t_direct_numeric = time.perf_counter() - start
+
+assert (per_group == string).all()
+assert (per_group == df_direct['histogram']).all()
+
+print('  per group execute       %8.1f ms  %10.0f rows/s' % (t_per_group * 1e3, n_rows / t_per_group))
+print('  bulk, numeric encoding  %8.1f ms  %10.0f rows/s' % (t_numeric * 1e3, n_rows / t_numeric))
+print('  bulk, string encoding   %8.1f ms  %10.0f rows/s' % (t_string * 1e3, n_rows / t_string))
+print('  direct aggregator       %8.1f ms  %10.0f rows/s' % (t_direct * 1e3, n_rows / t_direct))
+print('  direct, numeric         %8.1f ms  %10.0f rows/s' % (t_direct_numeric * 1e3, n_rows / t_direct_numeric))
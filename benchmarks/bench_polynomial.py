@@ -0,0 +1,61 @@
+#
+# Benchmark polynomial feature expansion - sklearn PolynomialFeatures vs mmfunctions PolynomialExpansion
+#   10 features, degree 3, as used by BayesRidgeRegressorExt
+#
+#   python benchmarks/bench_polynomial.py
+#
+
+import timeit
+
+import numpy as np
+import scipy.sparse
+from sklearn.preprocessing import PolynomialFeatures
+
+from mmfunctions.features import PolynomialExpansion
+
+n_features = 10
+degree = 3
+repeat = 5
+
+for n_rows in [1000, 10000, 100000]:
+    X = np.random.default_rng(42).normal(size=(n_rows, n_features))
+
+    poly = PolynomialFeatures(degree=degree).fit(X)
+    expansion = PolynomialExpansion(degree=degree).fit(X)
+    expansion32 = PolynomialExpansion(degree=degree, dtype=np.float32).fit(X)
+
+    assert np.allclose(poly.transform(X), expansion.expand(X))
+
+    t_sklearn = min(timeit.repeat(lambda: poly.transform(X), number=1, repeat=repeat))
+    t_expand = min(timeit.repeat(lambda: expansion.expand(X), number=1, repeat=repeat))
+    t_expand32 = min(timeit.repeat(lambda: expansion32.expand(X), number=1, repeat=repeat))
+
+    # fit + predict on the same batch: sklearn expands twice, the cached expansion once
+    def sklearn_fit_predict():
+        poly.fit_transform(X)
+        poly.transform(X)
+
+    def expansion_fit_predict():
+        expansion.fit_transform(X)
+        expansion.transform(X)
+
+    t_sklearn_fp = min(timeit.repeat(sklearn_fit_predict, number=1, repeat=repeat))
+    t_expansion_fp = min(timeit.repeat(expansion_fit_predict, number=1, repeat=repeat))
+
+    print('rows: %7d  output features: %d' % (n_rows, expansion.n_output_features_))
+    print('  transform      sklearn %8.2f ms   expansion %8.2f ms   float32 %8.2f ms' %
+          (t_sklearn * 1e3, t_expand * 1e3, t_expand32 * 1e3))
+    print('  fit + predict  sklearn %8.2f ms   expansion %8.2f ms' % (t_sklearn_fp * 1e3, t_expansion_fp * 1e3))
+
+    # mostly zero features, 5% nonzero: the sparse expansion stores the nonzeros only
+    X_sparse = scipy.sparse.random(n_rows, n_features, density=0.05, format='csr', random_state=42)
+    poly_sparse = PolynomialFeatures(degree=degree).fit(X_sparse)
+    sparse = PolynomialExpansion(degree=degree, sparse=True).fit(X_sparse)
+
+    assert np.allclose(poly_sparse.transform(X_sparse).toarray(), sparse.expand_sparse(X_sparse).toarray())
+
+    t_sklearn_sparse = min(timeit.repeat(lambda: poly_sparse.transform(X_sparse), number=1, repeat=repeat))
+    t_sparse = min(timeit.repeat(lambda: sparse.expand_sparse(X_sparse), number=1, repeat=repeat))
+    out = sparse.expand_sparse(X_sparse)
+    print('  sparse input   sklearn %8.2f ms   expansion %8.2f ms   %d nonzeros, %.1f%% of dense' %
+          (t_sklearn_sparse * 1e3, t_sparse * 1e3, out.nnz, 100.0 * out.nnz / np.prod(out.shape)))
@@ -0,0 +1,34 @@
+#
+# Benchmark offline change point segmentation - PELT and binary segmentation on a 10^6 point series
+#   piecewise constant mean with unit noise, segments of 1000 points
+#   PELT keeps about one segment length of candidates, so its time grows with n times the segment length,
+#   binary segmentation grows with n log(n)
+#
+#   python benchmarks/bench_segmentation.py
+#
+
+import time
+
+import numpy as np
+
+from mmfunctions.changepoint import pelt, binary_segmentation
+
+segment_length = 1000
+
+rng = np.random.default_rng(42)
+
+for n_points in [10000, 100000, 1000000]:
+    n_segments = n_points // segment_length
+    values = np.concatenate([rng.normal(level, 1, segment_length) for level in rng.normal(0, 3, n_segments)])
+    true_change_points = np.arange(1, n_segments) * segment_length
+
+    print('points: %7d  change points: %d' % (n_points, true_change_points.size))
+    for name, segmentation in [('binseg', binary_segmentation), ('pelt', pelt)]:
+        start = time.perf_counter()
+        change_points = segmentation(values)
+        elapsed = time.perf_counter() - start
+
+        # change points found within 5 points of a true one
+        distance = np.abs(change_points[:, None] - true_change_points[None, :]).min(axis=1)
+        print('  %-7s %9.1f ms  %10.0f points/s  found %d, %d within 5 points' %
+              (name, elapsed * 1e3, n_points / elapsed, change_points.size, np.count_nonzero(distance <= 5)))
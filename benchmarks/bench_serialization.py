@@ -0,0 +1,59 @@
+#
+# Benchmark model serialization - dill pickles as written by the model store vs compact bundles
+#   KDE of KDEAnomalyScore over 20000 readings of two sensors, VI network of VIAnomalyScore with its scaler
+#   size and time to load, for every codec installed
+#
+#   python benchmarks/bench_serialization.py
+#
+
+import time
+import warnings
+
+import dill
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+from statsmodels.nonparametric.kernel_density import KDEMultivariate
+
+from mmfunctions import serialization
+from mmfunctions.variational import VI
+
+repeat = 20
+
+# statsmodels warns about its random generator default
+warnings.simplefilter('ignore', FutureWarning)
+
+rng = np.random.default_rng(42)
+# sensor readings come with limited resolution
+temperature = np.round(rng.normal(20, 2, 20000), 2)
+pressure = np.round(0.5 * temperature + rng.normal(0, 0.5, 20000), 2)
+xy = np.column_stack([temperature, pressure])
+
+kde = KDEMultivariate(xy, var_type='cc', bw=[0.3, 0.2])
+vi = VI(StandardScaler().fit(temperature.reshape(-1, 1)), prior_sigma=2.0, adjust_mean=10.0, version=1)
+
+
+def best(function):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+for name, model in [('KDE', kde), ('VI', vi)]:
+    print(name)
+
+    pickled = dill.dumps(model)
+    t_pickle = best(lambda: dill.loads(pickled))
+    print('  %-14s %10d bytes  load %8.3f ms' % ('dill pickle', len(pickled), t_pickle * 1e3))
+
+    for codec in serialization.codecs:
+        if not serialization.codec_available(codec):
+            continue
+        bundle = serialization.dumps(model, codec=codec)
+        t_load = best(lambda: serialization.loads(bundle))
+        t_lazy = best(lambda: serialization.loads(bundle, lazy=True))
+        print('  %-14s %10d bytes  load %8.3f ms  lazy %8.3f ms  size %5.1f%%  load %5.1f%%' %
+              ('bundle ' + codec, len(bundle), t_load * 1e3, t_lazy * 1e3, 100 * len(bundle) / len(pickled),
+               100 * t_load / t_pickle))
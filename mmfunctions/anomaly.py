@@ -12,48 +12,69 @@
 The Built In Functions module contains preinstalled functions
 """
 
+import copy
 import itertools as it
 import datetime as dt
 import logging
 
-# for gradient boosting
-import lightgbm
 import numpy as np
 import pandas as pd
 import scipy as sp
-from pyod.models.cblof import CBLOF
-#  for Spectral Analysis
-from scipy import signal, fftpack
 #   for KMeans
 #from skimage import util as skiutil  # for nifty windowing
 from sklearn import ensemble
 from sklearn import linear_model
 from sklearn import metrics
-from sklearn.covariance import MinCovDet
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import (StandardScaler, RobustScaler, MinMaxScaler,
-                                   minmax_scale, PowerTransformer, PolynomialFeatures)
+                                   minmax_scale, PowerTransformer)
 from sklearn.utils import check_array
-# for Matrix Profile
 import iotfunctions
+
+from iotfunctions.base import (BaseTransformer, BaseRegressor, BaseEstimatorFunction, BaseAggregator,
+                               BaseSimpleAggregator)
+from iotfunctions.ui import (UISingle, UIMulti, UIMultiItem, UIFunctionOutSingle, UISingleItem, UIFunctionOutMulti)
+
+from mmfunctions.changepoint import detectors, BayesianOnline, ChangePointState, detect_change_points, \
+    segment_entities
+from mmfunctions.features import PolynomialExpansion, EntityGroups, TailState, lag_matrix, calendar_features, \
+    feature_family, rolling_methods, group_histograms
+from mmfunctions.lazy import lazy_import, lazy_attribute
+from mmfunctions.modelstore import model_cache, ModelBatch
+from mmfunctions.parallel import prefetched_models, train_entities
+from mmfunctions.sketches import KLLSketch, HistogramSketch
+from mmfunctions.timing import stage, stage_timing
+
+# heavy dependencies are imported when a function first uses them
+# for gradient boosting
+lightgbm = lazy_import('lightgbm')
+CBLOF = lazy_attribute('pyod.models.cblof', 'CBLOF')
+#  for Spectral Analysis
+signal = lazy_import('scipy.signal')
+fftpack = lazy_import('scipy.fftpack')
+MinCovDet = lazy_attribute('sklearn.covariance', 'MinCovDet')
+# for Matrix Profile
 if iotfunctions.__version__ != '8.2.1':
-    import stumpy
+    stumpy = lazy_import('stumpy')
 
 #import statsmodels.api as sm
-from statsmodels.nonparametric.kernel_density import KDEMultivariate
+KDEMultivariate = lazy_attribute('statsmodels.nonparametric.kernel_density', 'KDEMultivariate')
 
-from iotfunctions.base import (BaseTransformer, BaseRegressor, BaseEstimatorFunction, BaseSimpleAggregator)
-from iotfunctions.bif import (AlertHighValue)
-from iotfunctions.ui import (UISingle, UIMulti, UIMultiItem, UIFunctionOutSingle, UISingleItem, UIFunctionOutMulti)
+# iotfunctions.bif pulls in Watson Machine Learning and torch
+AlertHighValue = lazy_attribute('iotfunctions.bif', 'AlertHighValue')
 
 # VAE
-import torch
-import torch.autograd
-from torch.autograd import Variable
-import torch.nn as nn
-import torch.optim as optim
-from torch.utils.data import DataLoader, Dataset, TensorDataset
-import torch.nn.functional as torchfunc
+torch = lazy_import('torch')
+
+# moved to mmfunctions.variational, still resolved here for models stored with the old location
+_variational_names = ['VI', 'll_gaussian', 'l_gaussian', 'kl_div']
+
+
+def __getattr__(name):
+    if name in _variational_names:
+        import mmfunctions.variational
+        return getattr(mmfunctions.variational, name)
+    raise AttributeError('module ' + __name__ + ' has no attribute ' + name)
 
 
 logger = logging.getLogger(__name__)
@@ -396,6 +417,327 @@ class Interpolator(BaseTransformer):
 # Scalers
 #######################################################################################
 
+def entity_codes(df, entities=None):
+    """
+    Map the entity level of the index to integer codes
+    Without entities the codes index into the sorted unique entities of df, otherwise into entities
+    (-1 for entities not contained in entities)
+    """
+    level = df.index.get_level_values(0)
+    if entities is None:
+        codes, entities = pd.factorize(level, sort=True)
+    else:
+        codes = pd.Index(entities).get_indexer(level)
+    return codes, np.asarray(entities)
+
+
+def entity_validity(X, codes, n_entities):
+    """
+    Flag entities without NaN or infinite values in any of their rows - computed once for all entities
+    """
+    invalid_rows = ~np.isfinite(X).all(axis=1)
+    invalid_per_entity = np.bincount(codes[codes >= 0], weights=invalid_rows[codes >= 0], minlength=n_entities)
+    return invalid_per_entity == 0
+
+
+class EntityScaler(object):
+    """
+    Scaling parameters for all entities held in arrays indexed by entity code
+    Fitting runs a single groupby aggregation, transforming is a single broadcasted numpy expression
+    In incremental mode running statistics are updated with each batch instead of fitting once
+    """
+
+    methods = ['standard', 'robust', 'minmax']
+
+    def __init__(self, method, features, incremental=False):
+        if method not in self.methods:
+            raise ValueError('EntityScaler: unknown scaling method ' + str(method))
+
+        self.method = method
+        self.features = list(features)
+        self.incremental = incremental
+        self.build_time = pd.Timestamp.now()
+
+        n_features = len(self.features)
+        self.entities = np.array([], dtype=object)
+        self.center = np.zeros((0, n_features))
+        self.scale = np.ones((0, n_features))
+
+        # running statistics for incremental scaling
+        self.count = np.zeros((0, n_features))
+        self.mean = np.zeros((0, n_features))
+        self.m2 = np.zeros((0, n_features))
+        self.minimum = np.zeros((0, n_features))
+        self.maximum = np.zeros((0, n_features))
+        self.sketches = {}
+        self.last_timestamp = np.array([], dtype='datetime64[ns]')
+
+    def __contains__(self, entity):
+        return entity in set(self.entities)
+
+    def add_entities(self, entities):
+        """
+        Append entities we don't know yet with neutral parameters, return the codes of all given entities
+        """
+        entities = np.asarray(entities, dtype=object)
+        codes = pd.Index(self.entities).get_indexer(entities)
+
+        new_entities = pd.unique(entities[codes < 0])
+        if new_entities.size > 0:
+            shape = (new_entities.size, len(self.features))
+            self.entities = np.concatenate([self.entities, new_entities])
+            self.center = np.vstack([self.center, np.zeros(shape)])
+            self.scale = np.vstack([self.scale, np.ones(shape)])
+            self.count = np.vstack([self.count, np.zeros(shape)])
+            self.mean = np.vstack([self.mean, np.zeros(shape)])
+            self.m2 = np.vstack([self.m2, np.zeros(shape)])
+            self.minimum = np.vstack([self.minimum, np.full(shape, np.inf)])
+            self.maximum = np.vstack([self.maximum, np.full(shape, -np.inf)])
+            self.last_timestamp = np.concatenate([self.last_timestamp,
+                                                  np.full(new_entities.size, np.datetime64('NaT'), 'datetime64[ns]')])
+            codes = pd.Index(self.entities).get_indexer(entities)
+
+        return codes
+
+    def fit(self, df):
+        """
+        Learn scaling parameters for all entities in df, entities already known are refitted
+        """
+        grp = df[self.features].astype(np.float64).groupby(level=0)
+
+        if self.method == 'standard':
+            agg = grp.agg(['count', 'mean', 'var'])
+            count = agg.xs('count', axis=1, level=1)[self.features].to_numpy(dtype=np.float64)
+            center = agg.xs('mean', axis=1, level=1)[self.features].to_numpy(dtype=np.float64)
+            # population variance as in sklearn's StandardScaler
+            var = agg.xs('var', axis=1, level=1)[self.features].fillna(0).to_numpy(dtype=np.float64)
+            scale = np.sqrt(var * np.maximum(count - 1, 0) / np.maximum(count, 1))
+        elif self.method == 'robust':
+            agg = grp.quantile([0.25, 0.5, 0.75])
+            center = agg.xs(0.5, level=1)[self.features].to_numpy(dtype=np.float64)
+            scale = agg.xs(0.75, level=1)[self.features].to_numpy(dtype=np.float64) - \
+                agg.xs(0.25, level=1)[self.features].to_numpy(dtype=np.float64)
+            agg = agg.xs(0.5, level=1)
+        else:
+            agg = grp.agg(['min', 'max'])
+            center = agg.xs('min', axis=1, level=1)[self.features].to_numpy(dtype=np.float64)
+            scale = agg.xs('max', axis=1, level=1)[self.features].to_numpy(dtype=np.float64) - center
+
+        self.set_parameters(agg.index.to_numpy(), center, scale)
+        return self
+
+    def set_parameters(self, entities, center, scale):
+        """
+        Set per entity parameters, constant features are not scaled (like sklearn does)
+        """
+        codes = self.add_entities(entities)
+        self.center[codes] = np.where(np.isfinite(center), center, 0.0)
+        self.scale[codes] = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+
+    def new_rows(self, df):
+        """
+        Mask of rows newer than the last timestamp seen for their entity - overlapping windows are not counted twice
+        """
+        codes, _ = entity_codes(df, self.entities)
+        timestamps = df.index.get_level_values(1).to_numpy(dtype='datetime64[ns]')
+
+        last_timestamp = np.full(timestamps.shape, np.datetime64('NaT'), 'datetime64[ns]')
+        last_timestamp[codes >= 0] = self.last_timestamp[codes[codes >= 0]]
+        return np.isnat(last_timestamp) | (timestamps > last_timestamp)
+
+    def partial_fit(self, df):
+        """
+        Update the running statistics with a batch of rows in O(batch)
+          count, mean and sum of squared deviations are merged following Welford/Chan,
+          min and max are running extremes, robust scaling maintains a quantile sketch per entity and feature
+        """
+        if df.shape[0] == 0:
+            return self
+
+        X = df[self.features].to_numpy(dtype=np.float64)
+        X = np.where(np.isfinite(X), X, np.nan)
+        level = df.index.get_level_values(0)
+
+        batch = pd.DataFrame(X, index=level, columns=self.features)
+        agg = batch.groupby(level=0, sort=True).agg(['count', 'mean', 'var', 'min', 'max'])
+
+        def stat(name):
+            return agg.xs(name, axis=1, level=1)[self.features].to_numpy(dtype=np.float64)
+
+        codes = self.add_entities(agg.index.to_numpy())
+
+        count_b = stat('count')
+        mean_b = np.nan_to_num(stat('mean'))
+        m2_b = np.nan_to_num(stat('var')) * np.maximum(count_b - 1, 0)
+
+        count_a = self.count[codes]
+        mean_a = self.mean[codes]
+
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        fraction = np.divide(count_b, count, out=np.zeros_like(count), where=count > 0)
+
+        self.mean[codes] = mean_a + delta * fraction
+        self.m2[codes] = self.m2[codes] + m2_b + delta ** 2 * count_a * fraction
+        self.count[codes] = count
+        self.minimum[codes] = np.fmin(self.minimum[codes], stat('min'))
+        self.maximum[codes] = np.fmax(self.maximum[codes], stat('max'))
+
+        if self.method == 'robust':
+            row_codes, entities = entity_codes(df)
+            order = np.argsort(row_codes, kind='stable')
+            boundaries = np.flatnonzero(np.diff(row_codes[order])) + 1
+            for rows in np.split(order, boundaries):
+                entity = entities[row_codes[rows[0]]]
+                if entity not in self.sketches:
+                    self.sketches[entity] = [KLLSketch() for _ in self.features]
+                for feature, sketch in enumerate(self.sketches[entity]):
+                    sketch.update(X[rows, feature])
+
+        # remember the latest timestamp per entity
+        timestamps = pd.Series(df.index.get_level_values(1).to_numpy(dtype='datetime64[ns]'), index=level)
+        latest = timestamps.groupby(level=0, sort=True).max().to_numpy(dtype='datetime64[ns]')
+        previous = self.last_timestamp[codes]
+        self.last_timestamp[codes] = np.where(np.isnat(previous) | (latest > previous), latest, previous)
+
+        self.update_parameters(codes)
+        return self
+
+    def update_parameters(self, codes):
+        """
+        Derive center and scale from the running statistics
+        """
+        if self.method == 'standard':
+            center = self.mean[codes]
+            scale = np.sqrt(np.divide(self.m2[codes], self.count[codes], out=np.zeros_like(self.m2[codes]),
+                                      where=self.count[codes] > 0))
+        elif self.method == 'robust':
+            quantiles = np.array([[sketch.quantile([0.25, 0.5, 0.75]) for sketch in self.sketches[entity]]
+                                  if entity in self.sketches else np.full((len(self.features), 3), np.nan)
+                                  for entity in self.entities[codes]])
+            center = quantiles[:, :, 1]
+            scale = quantiles[:, :, 2] - quantiles[:, :, 0]
+        else:
+            center = self.minimum[codes]
+            scale = self.maximum[codes] - self.minimum[codes]
+
+        self.center[codes] = np.where(np.isfinite(center), center, 0.0)
+        self.scale[codes] = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+
+    def transform(self, df, X=None):
+        """
+        Scale all rows of df at once - rows of unknown entities come back as NaN
+        """
+        if X is None:
+            X = df[self.features].to_numpy(dtype=np.float64)
+
+        codes, _ = entity_codes(df, self.entities)
+        known = codes >= 0
+
+        scaled = np.full(X.shape, np.nan)
+        scaled[known] = (X[known] - self.center[codes[known]]) / self.scale[codes[known]]
+        return scaled
+
+
+def execute_entity_scaler(scaler_function, df_copy, method, incremental=False):
+    """
+    Vectorized scaling of all entities of df_copy by a scaler function
+      one model holds the parameters of all entities, only entities without parameters are fitted.
+      In incremental mode the running statistics are updated with the rows not seen before.
+    Returns the dataframe with the predictions columns and the array of entities that could be scaled
+    """
+    features = scaler_function.features
+    predictions = scaler_function.predictions[:len(features)]
+
+    codes, entities = entity_codes(df_copy)
+
+    try:
+        X = df_copy[features].to_numpy(dtype=np.float64)
+    except Exception as e:
+        logger.error('Found non numeric values in feature columns error: ' + str(e))
+        return df_copy, np.array([], dtype=object)
+
+    valid = entity_validity(X, codes, entities.size)
+    for entity in entities[~valid]:
+        logger.error('Found Nan or infinite value in feature columns for entity ' + str(entity))
+
+    db = scaler_function._entity_type.db
+    model_name = scaler_function.get_model_name(features, scaler_function.targets[0], suffix='entities')
+
+    entity_scaler = None
+    try:
+        with stage(scaler_function, 'model_io'):
+            entity_scaler = db.model_store.retrieve_model(model_name)
+        logger.info('load model %s' % str(entity_scaler))
+    except Exception as e:
+        logger.error('Model retrieval failed with ' + str(e))
+        pass
+
+    if entity_scaler is None or entity_scaler.method != method or entity_scaler.features != list(features) or \
+            entity_scaler.incremental != incremental:
+        entity_scaler = EntityScaler(method, features, incremental=incremental)
+
+    updated = False
+    if incremental:
+        # track slow drift - only rows we haven't seen in previous runs update the statistics
+        new_rows = entity_scaler.new_rows(df_copy)
+        if new_rows.any() and scaler_function.auto_train:
+            with stage(scaler_function, 'fit'):
+                entity_scaler.partial_fit(df_copy[new_rows])
+            logger.debug('Updated ' + method + ' scaling statistics with ' + str(new_rows.sum()) + ' rows')
+            updated = True
+    else:
+        # fit entities we haven't seen before in one go
+        known_entities = set(entity_scaler.entities)
+        new_entities = [entity for entity in entities[valid] if entity not in known_entities]
+        if len(new_entities) > 0 and scaler_function.auto_train:
+            with stage(scaler_function, 'fit'):
+                entity_scaler.fit(df_copy.loc[new_entities])
+            logger.debug('Fitted ' + method + ' scaling parameters for entities ' + str(new_entities))
+            updated = True
+
+    if updated:
+        try:
+            with stage(scaler_function, 'model_io'):
+                db.model_store.store_model(model_name, entity_scaler)
+        except Exception as e:
+            logger.error('Model store failed with ' + str(e))
+            pass
+
+    with stage(scaler_function, 'score'):
+        scaled = entity_scaler.transform(df_copy, X=X)
+        scaled[~valid[codes]] = np.nan
+
+    # single block write for all entities
+    with stage(scaler_function, 'write_back'):
+        df_copy[predictions] = scaled[:, :len(predictions)]
+
+    return df_copy, entities[valid]
+
+
+def execute_estimator(function, df, entity):
+    """
+    BaseEstimatorFunction._execute for one entity with stage timing - training is timed as fit, retrieving the
+    models and predicting as score. Models train_entities already retrieved or trained are served from memory.
+    """
+    with prefetched_models(function, entity):
+        if getattr(function, '_stage_timings', None) is None:
+            return BaseEstimatorFunction._execute(function, df, entity)
+
+        find_best_model = function.find_best_model
+
+        def timed_find_best_model(*args, **kwargs):
+            with stage(function, 'fit', entity):
+                return find_best_model(*args, **kwargs)
+
+        function.find_best_model = timed_find_best_model
+        try:
+            with stage(function, 'score', entity):
+                return BaseEstimatorFunction._execute(function, df, entity)
+        finally:
+            del function.find_best_model
+
+
 class Standard_Scaler(BaseEstimatorFunction):
     """
     Learns and applies standard scaling
@@ -409,7 +751,7 @@ class Standard_Scaler(BaseEstimatorFunction):
         self.estimators['standard_scaler'] = (StandardScaler, self.params)
         logger.info('Standard Scaler initialized')
 
-    def __init__(self, features=None, targets=None, predictions=None):
+    def __init__(self, features=None, targets=None, predictions=None, vectorized=False, incremental=False):
         super().__init__(features=features, targets=targets, predictions=predictions, keep_current_models=True)
 
         # do not run score and call transform instead of predict
@@ -420,6 +762,11 @@ class Standard_Scaler(BaseEstimatorFunction):
 
         self.params = {}
 
+        # scale all entities at once with one model holding the parameters for all of them
+        #   incremental scaling updates running statistics with each batch, implies vectorized
+        self.incremental = incremental
+        self.vectorized = vectorized or incremental
+
     # used by all the anomaly scorers based on it
     def prepare_data(self, dfEntity):
 
@@ -448,6 +795,8 @@ class Standard_Scaler(BaseEstimatorFunction):
     def kexecute(self, entity, df_copy):
         return df_copy
 
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -458,6 +807,22 @@ class Standard_Scaler(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        if self.vectorized:
+            scaled_entities = set()
+            if self.normalize:
+                df_copy, scaled_entities = execute_entity_scaler(self, df_copy, 'standard',
+                                                                 incremental=self.incremental)
+                scaled_entities = set(scaled_entities)
+
+            for entity in entities:
+                if entity not in scaled_entities:
+                    self.prediction = self.features[0]
+                df_copy = self.kexecute(entity, df_copy)
+                self.prediction = self.predictions[0]
+
+            logger.info('Standard_Scaler: Found columns ' + str(df_copy.columns))
+            return df_copy
+
         for entity in entities:
 
             normalize_entity = self.normalize
@@ -472,8 +837,9 @@ class Standard_Scaler(BaseEstimatorFunction):
 
             # support for optional scaling in subclasses
             if normalize_entity:
-                dfe = super()._execute(df_copy.loc[[entity]], entity)
-                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+                dfe = execute_estimator(self, df_copy.loc[[entity]], entity)
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[entity, self.predictions] = dfe[self.predictions]
             else:
                 self.prediction = self.features[0]
 
@@ -491,6 +857,10 @@ class Standard_Scaler(BaseEstimatorFunction):
         inputs.append(UIMultiItem(name='features', datatype=float, required=True))
         inputs.append(UIMultiItem(name='targets', datatype=float, required=True, output_item='predictions',
                                   is_output_datatype_derived=True))
+        inputs.append(UISingle(name='vectorized', datatype=bool, required=False,
+                               description='Scale all entities at once with a single model'))
+        inputs.append(UISingle(name='incremental', datatype=bool, required=False,
+                               description='Update scaling statistics with each batch to track drift'))
         # define arguments that behave as function outputs
         outputs = []
         return (inputs, outputs)
@@ -509,7 +879,7 @@ class Robust_Scaler(BaseEstimatorFunction):
         self.estimators['robust_scaler'] = (RobustScaler, self.params)
         logger.info('Robust Scaler initialized')
 
-    def __init__(self, features=None, targets=None, predictions=None):
+    def __init__(self, features=None, targets=None, predictions=None, vectorized=False, incremental=False):
         super().__init__(features=features, targets=targets, predictions=predictions, keep_current_models=True)
 
         # do not run score and call transform instead of predict
@@ -518,6 +888,13 @@ class Robust_Scaler(BaseEstimatorFunction):
 
         self.params = {}
 
+        # scale all entities at once with one model holding the parameters for all of them
+        #   incremental scaling updates running statistics with each batch, implies vectorized
+        self.incremental = incremental
+        self.vectorized = vectorized or incremental
+
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -528,6 +905,10 @@ class Robust_Scaler(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        if self.vectorized:
+            df_copy, _ = execute_entity_scaler(self, df_copy, 'robust', incremental=self.incremental)
+            return df_copy
+
         for entity in entities:
             # per entity - copy for later inplace operations
             try:
@@ -537,8 +918,9 @@ class Robust_Scaler(BaseEstimatorFunction):
                     'Found Nan or infinite value in feature columns for entity ' + str(entity) + ' error: ' + str(e))
                 continue
 
-            dfe = super()._execute(df_copy.loc[[entity]], entity)
-            df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+            dfe = execute_estimator(self, df_copy.loc[[entity]], entity)
+            with stage(self, 'write_back', entity):
+                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
 
         return df_copy
 
@@ -549,6 +931,10 @@ class Robust_Scaler(BaseEstimatorFunction):
         inputs.append(UIMultiItem(name='features', datatype=float, required=True))
         inputs.append(UIMultiItem(name='targets', datatype=float, required=True, output_item='predictions',
                                   is_output_datatype_derived=True))
+        inputs.append(UISingle(name='vectorized', datatype=bool, required=False,
+                               description='Scale all entities at once with a single model'))
+        inputs.append(UISingle(name='incremental', datatype=bool, required=False,
+                               description='Update scaling statistics with each batch to track drift'))
         # define arguments that behave as function outputs
         outputs = []
         return (inputs, outputs)
@@ -567,7 +953,7 @@ class MinMax_Scaler(BaseEstimatorFunction):
         self.estimators['minmax_scaler'] = (MinMaxScaler, self.params)
         logger.info('MinMax Scaler initialized')
 
-    def __init__(self, features=None, targets=None, predictions=None):
+    def __init__(self, features=None, targets=None, predictions=None, vectorized=False, incremental=False):
         super().__init__(features=features, targets=targets, predictions=predictions, keep_current_models=True)
 
         # do not run score and call transform instead of predict
@@ -576,6 +962,13 @@ class MinMax_Scaler(BaseEstimatorFunction):
 
         self.params = {}
 
+        # scale all entities at once with one model holding the parameters for all of them
+        #   incremental scaling updates running statistics with each batch, implies vectorized
+        self.incremental = incremental
+        self.vectorized = vectorized or incremental
+
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -586,6 +979,10 @@ class MinMax_Scaler(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        if self.vectorized:
+            df_copy, _ = execute_entity_scaler(self, df_copy, 'minmax', incremental=self.incremental)
+            return df_copy
+
         for entity in entities:
             try:
                 check_array(df_copy.loc[[entity]][self.features].values, allow_nd=True)
@@ -594,8 +991,9 @@ class MinMax_Scaler(BaseEstimatorFunction):
                     'Found Nan or infinite value in feature columns for entity ' + str(entity) + ' error: ' + str(e))
                 continue
 
-            dfe = super()._execute(df_copy.loc[[entity]], entity)
-            df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+            dfe = execute_estimator(self, df_copy.loc[[entity]], entity)
+            with stage(self, 'write_back', entity):
+                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
 
         return df_copy
 
@@ -606,6 +1004,10 @@ class MinMax_Scaler(BaseEstimatorFunction):
         inputs.append(UIMultiItem(name='features', datatype=float, required=True))
         inputs.append(UIMultiItem(name='targets', datatype=float, required=True, output_item='predictions',
                                   is_output_datatype_derived=True))
+        inputs.append(UISingle(name='vectorized', datatype=bool, required=False,
+                               description='Scale all entities at once with a single model'))
+        inputs.append(UISingle(name='incremental', datatype=bool, required=False,
+                               description='Update scaling statistics with each batch to track drift'))
         # define arguments that behave as function outputs
         outputs = []
         return (inputs, outputs)
@@ -664,6 +1066,7 @@ class SpectralAnomalyScore(BaseTransformer):
 
         return dfe, temperature
 
+    @stage_timing
     def execute(self, df):
 
         df_copy = df.copy()
@@ -678,18 +1081,19 @@ class SpectralAnomalyScore(BaseTransformer):
 
         for entity in entities:
             # per entity - copy for later inplace operations
-            dfe = df_copy.loc[[entity]].dropna(how='all')
-            dfe_orig = df_copy.loc[[entity]].copy()
+            with stage(self, 'split', entity):
+                dfe = df_copy.loc[[entity]].dropna(how='all')
+                dfe_orig = df_copy.loc[[entity]].copy()
 
-            # get rid of entityid part of the index
-            # do it inplace as we copied the data before
-            dfe.reset_index(level=[0], inplace=True)
-            dfe.sort_index(inplace=True)
-            dfe_orig.reset_index(level=[0], inplace=True)
-            dfe_orig.sort_index(inplace=True)
+                # get rid of entityid part of the index
+                # do it inplace as we copied the data before
+                dfe.reset_index(level=[0], inplace=True)
+                dfe.sort_index(inplace=True)
+                dfe_orig.reset_index(level=[0], inplace=True)
+                dfe_orig.sort_index(inplace=True)
 
-            # minimal time delta for merging
-            mindelta, dfe_orig = min_delta(dfe_orig)
+                # minimal time delta for merging
+                mindelta, dfe_orig = min_delta(dfe_orig)
 
             logger.debug('Timedelta:' + str(mindelta) + ' Index: ' + str(dfe_orig.index))
 
@@ -698,7 +1102,8 @@ class SpectralAnomalyScore(BaseTransformer):
 
             # interpolate gaps - data imputation by default
             #   for missing data detection we look at the timestamp gradient instead
-            dfe, temperature = self.prepare_data(dfe)
+            with stage(self, 'prepare_data', entity):
+                dfe, temperature = self.prepare_data(dfe)
 
             logger.debug(
                 'Module Spectral, Entity: ' + str(entity) + ', Input: ' + str(self.input_item) + ', Windowsize: ' + str(
@@ -720,24 +1125,27 @@ class SpectralAnomalyScore(BaseTransformer):
                 try:
                     # Fourier transform:
                     #   frequency, time, spectral density
-                    frequency_temperature, time_series_temperature, spectral_density_temperature = signal.spectrogram(
-                        temperature, fs=self.frame_rate, window='hanning', nperseg=self.windowsize,
-                        noverlap=self.windowoverlap, detrend='l', scaling='spectrum')
+                    with stage(self, 'windowing', entity):
+                        frequency_temperature, time_series_temperature, spectral_density_temperature = \
+                            signal.spectrogram(temperature, fs=self.frame_rate, window='hanning',
+                                               nperseg=self.windowsize, noverlap=self.windowoverlap, detrend='l',
+                                               scaling='spectrum')
 
                     # cut off freqencies too low to fit into the window
-                    frequency_temperatureb = (frequency_temperature > 2 / self.windowsize).astype(int)
-                    frequency_temperature = frequency_temperature * frequency_temperatureb
-                    frequency_temperature[frequency_temperature == 0] = 1 / self.windowsize
+                    with stage(self, 'score', entity):
+                        frequency_temperatureb = (frequency_temperature > 2 / self.windowsize).astype(int)
+                        frequency_temperature = frequency_temperature * frequency_temperatureb
+                        frequency_temperature[frequency_temperature == 0] = 1 / self.windowsize
 
-                    signal_energy = np.dot(spectral_density_temperature.T, frequency_temperature)
+                        signal_energy = np.dot(spectral_density_temperature.T, frequency_temperature)
 
-                    signal_energy[signal_energy < SmallEnergy] = SmallEnergy
-                    inv_signal_energy = np.divide(np.ones(signal_energy.size), signal_energy)
+                        signal_energy[signal_energy < SmallEnergy] = SmallEnergy
+                        inv_signal_energy = np.divide(np.ones(signal_energy.size), signal_energy)
 
-                    dfe[self.output_item] = 0.0005
+                        dfe[self.output_item] = 0.0005
 
-                    ets_zscore = abs(sp.stats.zscore(signal_energy)) * Spectral_normalizer
-                    inv_zscore = abs(sp.stats.zscore(inv_signal_energy))
+                        ets_zscore = abs(sp.stats.zscore(signal_energy)) * Spectral_normalizer
+                        inv_zscore = abs(sp.stats.zscore(inv_signal_energy))
 
                     logger.debug(
                         'Spectral z-score max: ' + str(ets_zscore.max()) + ',   Spectral inv z-score max: ' + str(
@@ -746,28 +1154,31 @@ class SpectralAnomalyScore(BaseTransformer):
                     # length of time_series_temperature, signal_energy and ets_zscore is smaller than half the original
                     #   extend it to cover the full original length
                     dfe[self.output_item] = 0.0006
-                    linear_interpolate = sp.interpolate.interp1d(time_series_temperature, ets_zscore, kind='linear',
-                                                                 fill_value='extrapolate')
+                    with stage(self, 'merge_score', entity):
+                        linear_interpolate = sp.interpolate.interp1d(time_series_temperature, ets_zscore, kind='linear',
+                                                                     fill_value='extrapolate')
 
-                    zScoreII = merge_score(dfe, dfe_orig, self.output_item,
-                                           abs(linear_interpolate(np.arange(0, temperature.size, 1))), mindelta)
+                        zScoreII = merge_score(dfe, dfe_orig, self.output_item,
+                                               abs(linear_interpolate(np.arange(0, temperature.size, 1))), mindelta)
 
                     if self.inv_zscore is not None:
-                        linear_interpol_inv_zscore = sp.interpolate.interp1d(time_series_temperature, inv_zscore,
-                                                                             kind='linear', fill_value='extrapolate')
+                        with stage(self, 'merge_score', entity):
+                            linear_interpol_inv_zscore = sp.interpolate.interp1d(
+                                time_series_temperature, inv_zscore, kind='linear', fill_value='extrapolate')
 
-                        inv_zScoreII = merge_score(dfe, dfe_orig, self.inv_zscore,
-                                                   abs(linear_interpol_inv_zscore(np.arange(0, temperature.size, 1))),
-                                                   mindelta)
+                            inv_zScoreII = merge_score(
+                                dfe, dfe_orig, self.inv_zscore,
+                                abs(linear_interpol_inv_zscore(np.arange(0, temperature.size, 1))), mindelta)
 
                 except Exception as e:
                     logger.error('Spectral failed with ' + str(e))
 
                 idx = pd.IndexSlice
-                df_copy.loc[idx[entity, :], self.output_item] = zScoreII
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[idx[entity, :], self.output_item] = zScoreII
 
-                if self.inv_zscore is not None:
-                    df_copy.loc[idx[entity, :], self.inv_zscore] = inv_zScoreII
+                    if self.inv_zscore is not None:
+                        df_copy.loc[idx[entity, :], self.inv_zscore] = inv_zScoreII
 
         if self.inv_zscore is not None:
             msg = 'SpectralAnomalyScoreExt'
@@ -809,6 +1220,7 @@ class SpectralAnomalyScoreExt(SpectralAnomalyScore):
 
         self.inv_zscore = inv_zscore
 
+    @stage_timing
     def execute(self, df):
         return super().execute(df)
 
@@ -880,6 +1292,7 @@ class KMeansAnomalyScore(BaseTransformer):
 
         return dfe, temperature
 
+    @stage_timing
     def execute(self, df):
 
         df_copy = df.copy()
@@ -894,24 +1307,26 @@ class KMeansAnomalyScore(BaseTransformer):
 
         for entity in entities:
             # per entity - copy for later inplace operations
-            dfe = df_copy.loc[[entity]].dropna(how='all')
-            dfe_orig = df_copy.loc[[entity]].copy()
+            with stage(self, 'split', entity):
+                dfe = df_copy.loc[[entity]].dropna(how='all')
+                dfe_orig = df_copy.loc[[entity]].copy()
 
-            # get rid of entityid part of the index
-            # do it inplace as we copied the data before
-            dfe.reset_index(level=[0], inplace=True)
-            dfe.sort_index(inplace=True)
-            dfe_orig.reset_index(level=[0], inplace=True)
-            dfe_orig.sort_index(inplace=True)
+                # get rid of entityid part of the index
+                # do it inplace as we copied the data before
+                dfe.reset_index(level=[0], inplace=True)
+                dfe.sort_index(inplace=True)
+                dfe_orig.reset_index(level=[0], inplace=True)
+                dfe_orig.sort_index(inplace=True)
 
-            # minimal time delta for merging
-            mindelta, dfe_orig = min_delta(dfe_orig)
+                # minimal time delta for merging
+                mindelta, dfe_orig = min_delta(dfe_orig)
 
             logger.debug('Timedelta:' + str(mindelta))
 
             # interpolate gaps - data imputation by default
             #   for missing data detection we look at the timestamp gradient instead
-            dfe, temperature = self.prepare_data(dfe)
+            with stage(self, 'prepare_data', entity):
+                dfe, temperature = self.prepare_data(dfe)
 
             logger.debug(
                 'Module KMeans, Entity: ' + str(entity) + ', Input: ' + str(self.input_item) + ', Windowsize: ' + str(
@@ -923,7 +1338,8 @@ class KMeansAnomalyScore(BaseTransformer):
 
                 # Chop into overlapping windows
                 #slices = skiutil.view_as_windows(temperature, window_shape=(self.windowsize,), step=self.step)
-                slices = view_as_windows(temperature, self.windowsize, self.step)
+                with stage(self, 'windowing', entity):
+                    slices = view_as_windows(temperature, self.windowsize, self.step)
 
                 if self.windowsize > 1:
                     n_cluster = 40
@@ -936,7 +1352,8 @@ class KMeansAnomalyScore(BaseTransformer):
 
                 cblofwin = CBLOF(n_clusters=n_cluster, n_jobs=-1)
                 try:
-                    cblofwin.fit(slices)
+                    with stage(self, 'fit', entity):
+                        cblofwin.fit(slices)
                 except Exception as e:
                     logger.info('KMeans failed with ' + str(e))
                     self.trace_append('KMeans failed with' + str(e))
@@ -951,14 +1368,16 @@ class KMeansAnomalyScore(BaseTransformer):
                 time_series_temperature = np.linspace(self.windowsize // 2, temperature.size - self.windowsize // 2 + 1,
                                                       temperature.size - diff)
 
-                linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind='linear',
-                                                               fill_value='extrapolate')
+                with stage(self, 'merge_score', entity):
+                    linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind='linear',
+                                                                   fill_value='extrapolate')
 
-                zScoreII = merge_score(dfe, dfe_orig, self.output_item,
-                                       linear_interpolate_k(np.arange(0, temperature.size, 1)), mindelta)
+                    zScoreII = merge_score(dfe, dfe_orig, self.output_item,
+                                           linear_interpolate_k(np.arange(0, temperature.size, 1)), mindelta)
 
                 idx = pd.IndexSlice
-                df_copy.loc[idx[entity, :], self.output_item] = zScoreII
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[idx[entity, :], self.output_item] = zScoreII
 
         msg = 'KMeansAnomalyScore'
         self.trace_append(msg)
@@ -1043,6 +1462,7 @@ class GeneralizedAnomalyScore(BaseTransformer):
 
         return slices
 
+    @stage_timing
     def execute(self, df):
 
         df_copy = df.copy()
@@ -1057,22 +1477,24 @@ class GeneralizedAnomalyScore(BaseTransformer):
 
         for entity in entities:
             # per entity - copy for later inplace operations
-            dfe = df_copy.loc[[entity]].dropna(how='all')
-            dfe_orig = df_copy.loc[[entity]].copy()
+            with stage(self, 'split', entity):
+                dfe = df_copy.loc[[entity]].dropna(how='all')
+                dfe_orig = df_copy.loc[[entity]].copy()
 
-            # get rid of entityid part of the index
-            # do it inplace as we copied the data before
-            dfe.reset_index(level=[0], inplace=True)
-            dfe.sort_index(inplace=True)
-            dfe_orig.reset_index(level=[0], inplace=True)
-            dfe_orig.sort_index(inplace=True)
+                # get rid of entityid part of the index
+                # do it inplace as we copied the data before
+                dfe.reset_index(level=[0], inplace=True)
+                dfe.sort_index(inplace=True)
+                dfe_orig.reset_index(level=[0], inplace=True)
+                dfe_orig.sort_index(inplace=True)
 
-            # minimal time delta for merging
-            mindelta, dfe_orig = min_delta(dfe_orig)
+                # minimal time delta for merging
+                mindelta, dfe_orig = min_delta(dfe_orig)
 
             # interpolate gaps - data imputation by default
             #   for missing data detection we look at the timestamp gradient instead
-            dfe, temperature = self.prepare_data(dfe)
+            with stage(self, 'prepare_data', entity):
+                dfe, temperature = self.prepare_data(dfe)
 
             logger.debug('Module GeneralizedAnomaly, Entity: ' + str(entity) + ', Input: ' + str(
                 self.input_item) + ', Windowsize: ' + str(self.windowsize) + ', Output: ' + str(
@@ -1085,13 +1507,16 @@ class GeneralizedAnomalyScore(BaseTransformer):
                 mcd = MinCovDet()
 
                 # Chop into overlapping windows (default) or run through FFT first
-                slices = self.feature_extract(temperature)
+                with stage(self, 'windowing', entity):
+                    slices = self.feature_extract(temperature)
 
                 pred_score = None
 
                 try:
-                    mcd.fit(slices)
-                    pred_score = mcd.mahalanobis(slices).copy() * self.normalizer
+                    with stage(self, 'fit', entity):
+                        mcd.fit(slices)
+                    with stage(self, 'score', entity):
+                        pred_score = mcd.mahalanobis(slices).copy() * self.normalizer
 
                 except ValueError as ve:
 
@@ -1124,17 +1549,20 @@ class GeneralizedAnomalyScore(BaseTransformer):
                 logger.debug(self.whoami + '   Entity: ' + str(entity) + ', result shape: ' + str(
                     time_series_temperature.shape) + ' score shape: ' + str(pred_score.shape))
 
-                linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind="linear",
-                                                               fill_value="extrapolate")
+                with stage(self, 'interpolation', entity):
+                    linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind="linear",
+                                                                   fill_value="extrapolate")
 
-                gam_scoreI = linear_interpolate_k(np.arange(0, temperature.size, 1))
+                    gam_scoreI = linear_interpolate_k(np.arange(0, temperature.size, 1))
 
                 dampen_anomaly_score(gam_scoreI, self.dampening)
 
-                zScoreII = merge_score(dfe, dfe_orig, self.output_item, gam_scoreI, mindelta)
+                with stage(self, 'merge_score', entity):
+                    zScoreII = merge_score(dfe, dfe_orig, self.output_item, gam_scoreI, mindelta)
 
                 idx = pd.IndexSlice
-                df_copy.loc[idx[entity, :], self.output_item] = zScoreII
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[idx[entity, :], self.output_item] = zScoreII
 
         msg = "GeneralizedAnomalyScore"
         self.trace_append(msg)
@@ -1203,6 +1631,7 @@ class NoDataAnomalyScore(GeneralizedAnomalyScore):
 
         return dfe, temperature
 
+    @stage_timing
     def execute(self, df):
         df_copy = super().execute(df)
 
@@ -1256,6 +1685,7 @@ class FFTbasedGeneralizedAnomalyScore(GeneralizedAnomalyScore):
 
         return np.stack(slicelist, axis=0)
 
+    @stage_timing
     def execute(self, df):
         df_copy = super().execute(df)
 
@@ -1323,6 +1753,7 @@ if iotfunctions.__version__ != '8.2.1':
 
             return dfe, analysis_input
 
+        @stage_timing
         def execute(self, df):
             df_copy = df.copy()
             entities = np.unique(df_copy.index.levels[0])
@@ -1335,25 +1766,28 @@ if iotfunctions.__version__ != '8.2.1':
 
             for entity in entities:
                 # per entity - copy for later inplace operations
-                dfe = df_copy.loc[[entity]].dropna(how='all')
-                dfe_orig = df_copy.loc[[entity]].copy()
-                logger.debug(f' Original df shape: {df_copy.shape} Entity df shape: {dfe.shape}')
+                with stage(self, 'split', entity):
+                    dfe = df_copy.loc[[entity]].dropna(how='all')
+                    dfe_orig = df_copy.loc[[entity]].copy()
+                    logger.debug(f' Original df shape: {df_copy.shape} Entity df shape: {dfe.shape}')
 
-                # get rid of entity_id part of the index
-                # do it inplace as we copied the data before
-                dfe.reset_index(level=[0], inplace=True)
-                dfe.sort_index(inplace=True)
-                dfe_orig.reset_index(level=[0], inplace=True)
-                dfe_orig.sort_index(inplace=True)
+                    # get rid of entity_id part of the index
+                    # do it inplace as we copied the data before
+                    dfe.reset_index(level=[0], inplace=True)
+                    dfe.sort_index(inplace=True)
+                    dfe_orig.reset_index(level=[0], inplace=True)
+                    dfe_orig.sort_index(inplace=True)
 
-                # minimal time delta for merging
-                mindelta, dfe_orig = min_delta(dfe_orig)
+                    # minimal time delta for merging
+                    mindelta, dfe_orig = min_delta(dfe_orig)
 
                 if dfe.size >= self.window_size:
                     # interpolate gaps - data imputation by default
-                    dfe, matrix_profile_input = self.prepare_data(dfe)
+                    with stage(self, 'prepare_data', entity):
+                        dfe, matrix_profile_input = self.prepare_data(dfe)
                     try:  # calculate scores
-                        matrix_profile = stumpy.aamp(matrix_profile_input, m=self.window_size)[:, 0]
+                        with stage(self, 'score', entity):
+                            matrix_profile = stumpy.aamp(matrix_profile_input, m=self.window_size)[:, 0]
                         # fill in a small value for newer data points outside the last possible window
                         fillers = np.array([self.DATAPOINTS_AFTER_LAST_WINDOW] * (self.window_size - 1))
                         matrix_profile = np.append(matrix_profile, fillers)
@@ -1364,10 +1798,12 @@ if iotfunctions.__version__ != '8.2.1':
                     logger.warning(f' Not enough data to calculate Matrix Profile for entity. {entity}')
                     matrix_profile = np.array([self.ERROR_SCORES] * dfe.shape[0])
 
-                anomaly_score = merge_score(dfe, dfe_orig, self.output_item, matrix_profile, mindelta)
+                with stage(self, 'merge_score', entity):
+                    anomaly_score = merge_score(dfe, dfe_orig, self.output_item, matrix_profile, mindelta)
 
                 idx = pd.IndexSlice
-                df_copy.loc[idx[entity, :], self.output_item] = anomaly_score
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[idx[entity, :], self.output_item] = anomaly_score
 
             return df_copy
 
@@ -1418,6 +1854,7 @@ class FFTbasedGeneralizedAnomalyScore2(GeneralizedAnomalyScore):
 
         return np.stack(slicelist, axis=0)
 
+    @stage_timing
     def execute(self, df):
         df_copy = super().execute(df)
 
@@ -1474,6 +1911,7 @@ class SaliencybasedGeneralizedAnomalyScore(GeneralizedAnomalyScore):
 
         return slices
 
+    @stage_timing
     def execute(self, df):
         df_copy = super().execute(df)
 
@@ -1540,24 +1978,26 @@ class KMeansAnomalyScoreV2(Standard_Scaler):
     def kexecute(self, entity, df_copy):
 
         # per entity - copy for later inplace operations
-        dfe = df_copy.loc[[entity]].dropna(how='all')
-        dfe_orig = df_copy.loc[[entity]].copy()
+        with stage(self, 'split', entity):
+            dfe = df_copy.loc[[entity]].dropna(how='all')
+            dfe_orig = df_copy.loc[[entity]].copy()
 
-        # get rid of entityid part of the index
-        # do it inplace as we copied the data before
-        dfe.reset_index(level=[0], inplace=True)
-        dfe.sort_index(inplace=True)
-        dfe_orig.reset_index(level=[0], inplace=True)
-        dfe_orig.sort_index(inplace=True)
+            # get rid of entityid part of the index
+            # do it inplace as we copied the data before
+            dfe.reset_index(level=[0], inplace=True)
+            dfe.sort_index(inplace=True)
+            dfe_orig.reset_index(level=[0], inplace=True)
+            dfe_orig.sort_index(inplace=True)
 
-        # minimal time delta for merging
-        mindelta, dfe_orig = min_delta(dfe_orig)
+            # minimal time delta for merging
+            mindelta, dfe_orig = min_delta(dfe_orig)
 
         logger.debug('Timedelta:' + str(mindelta))
 
         # interpolate gaps - data imputation by default
         #   for missing data detection we look at the timestamp gradient instead
-        dfe, temperature = self.prepare_data(dfe)
+        with stage(self, 'prepare_data', entity):
+            dfe, temperature = self.prepare_data(dfe)
 
         logger.debug('Module ' + self.whoami + ', Entity: ' + str(entity) + ', Input: ' + str(
             self.input_item) + ', Windowsize: ' + str(self.windowsize) + ', Output: ' + str(
@@ -1568,7 +2008,8 @@ class KMeansAnomalyScoreV2(Standard_Scaler):
 
             # Chop into overlapping windows
             #slices = skiutil.view_as_windows(temperature, window_shape=(self.windowsize,), step=self.step)
-            slices = view_as_windows(temperature, self.windowsize, self.step)
+            with stage(self, 'windowing', entity):
+                slices = view_as_windows(temperature, self.windowsize, self.step)
 
             if self.windowsize > 1:
                 n_cluster = 40
@@ -1581,7 +2022,8 @@ class KMeansAnomalyScoreV2(Standard_Scaler):
 
             cblofwin = CBLOF(n_clusters=n_cluster, n_jobs=-1)
             try:
-                cblofwin.fit(slices)
+                with stage(self, 'fit', entity):
+                    cblofwin.fit(slices)
             except Exception as e:
                 logger.info('KMeans failed with ' + str(e))
                 self.trace_append('KMeans failed with' + str(e))
@@ -1596,14 +2038,16 @@ class KMeansAnomalyScoreV2(Standard_Scaler):
             time_series_temperature = np.linspace(self.windowsize // 2, temperature.size - self.windowsize // 2 + 1,
                                                   temperature.size - diff)
 
-            linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind='linear',
-                                                           fill_value='extrapolate')
+            with stage(self, 'merge_score', entity):
+                linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind='linear',
+                                                               fill_value='extrapolate')
 
-            z_score_ii = merge_score(dfe, dfe_orig, self.output_item,
-                                     linear_interpolate_k(np.arange(0, temperature.size, 1)), mindelta)
+                z_score_ii = merge_score(dfe, dfe_orig, self.output_item,
+                                         linear_interpolate_k(np.arange(0, temperature.size, 1)), mindelta)
 
             idx = pd.IndexSlice
-            df_copy.loc[idx[entity, :], self.output_item] = z_score_ii
+            with stage(self, 'write_back', entity):
+                df_copy.loc[idx[entity, :], self.output_item] = z_score_ii
 
         return df_copy
 
@@ -1677,24 +2121,26 @@ class GeneralizedAnomalyScoreV2(Standard_Scaler):
     def kexecute(self, entity, df_copy):
 
         # per entity - copy for later inplace operations
-        dfe = df_copy.loc[[entity]].dropna(how='all')
-        dfe_orig = df_copy.loc[[entity]].copy()
+        with stage(self, 'split', entity):
+            dfe = df_copy.loc[[entity]].dropna(how='all')
+            dfe_orig = df_copy.loc[[entity]].copy()
 
-        # get rid of entityid part of the index
-        # do it inplace as we copied the data before
-        dfe.reset_index(level=[0], inplace=True)
-        dfe.sort_index(inplace=True)
-        dfe_orig.reset_index(level=[0], inplace=True)
-        dfe_orig.sort_index(inplace=True)
+            # get rid of entityid part of the index
+            # do it inplace as we copied the data before
+            dfe.reset_index(level=[0], inplace=True)
+            dfe.sort_index(inplace=True)
+            dfe_orig.reset_index(level=[0], inplace=True)
+            dfe_orig.sort_index(inplace=True)
 
-        # minimal time delta for merging
-        mindelta, dfe_orig = min_delta(dfe_orig)
+            # minimal time delta for merging
+            mindelta, dfe_orig = min_delta(dfe_orig)
 
         logger.debug('Timedelta:' + str(mindelta))
 
         # interpolate gaps - data imputation by default
         #   for missing data detection we look at the timestamp gradient instead
-        dfe, temperature = self.prepare_data(dfe)
+        with stage(self, 'prepare_data', entity):
+            dfe, temperature = self.prepare_data(dfe)
 
         logger.debug('Module ' + self.whoami + ', Entity: ' + str(entity) + ', Input: ' + str(
             self.input_item) + ', Windowsize: ' + str(self.windowsize) + ', Output: ' + str(
@@ -1707,13 +2153,16 @@ class GeneralizedAnomalyScoreV2(Standard_Scaler):
             mcd = MinCovDet()
 
             # Chop into overlapping windows (default) or run through FFT first
-            slices = self.feature_extract(temperature)
+            with stage(self, 'windowing', entity):
+                slices = self.feature_extract(temperature)
 
             pred_score = None
 
             try:
-                mcd.fit(slices)
-                pred_score = mcd.mahalanobis(slices).copy() * self.normalizer
+                with stage(self, 'fit', entity):
+                    mcd.fit(slices)
+                with stage(self, 'score', entity):
+                    pred_score = mcd.mahalanobis(slices).copy() * self.normalizer
 
             except ValueError as ve:
 
@@ -1745,17 +2194,20 @@ class GeneralizedAnomalyScoreV2(Standard_Scaler):
             logger.debug(self.whoami + '   Entity: ' + str(entity) + ', result shape: ' + str(
                 time_series_temperature.shape) + ' score shape: ' + str(pred_score.shape))
 
-            linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind="linear",
-                                                           fill_value="extrapolate")
+            with stage(self, 'interpolation', entity):
+                linear_interpolate_k = sp.interpolate.interp1d(time_series_temperature, pred_score, kind="linear",
+                                                               fill_value="extrapolate")
 
-            gam_scoreI = linear_interpolate_k(np.arange(0, temperature.size, 1))
+                gam_scoreI = linear_interpolate_k(np.arange(0, temperature.size, 1))
 
             dampen_anomaly_score(gam_scoreI, self.dampening)
 
-            zScoreII = merge_score(dfe, dfe_orig, self.output_item, gam_scoreI, mindelta)
+            with stage(self, 'merge_score', entity):
+                zScoreII = merge_score(dfe, dfe_orig, self.output_item, gam_scoreI, mindelta)
 
             idx = pd.IndexSlice
-            df_copy.loc[idx[entity, :], self.output_item] = zScoreII
+            with stage(self, 'write_back', entity):
+                df_copy.loc[idx[entity, :], self.output_item] = zScoreII
 
         msg = "GeneralizedAnomalyScore"
         self.trace_append(msg)
@@ -1861,6 +2313,7 @@ class SaliencybasedGeneralizedAnomalyScoreV2(GeneralizedAnomalyScoreV2):
 
         return slices
 
+    @stage_timing
     def execute(self, df):
         df_copy = super().execute(df)
 
@@ -1895,37 +2348,266 @@ GeneralizedAnomalyScorev2 = GeneralizedAnomalyScoreV2
 # Regressors
 #######################################################################################
 
-class BayesRidgeRegressor(BaseEstimatorFunction):
+class IncrementalBayesRidge(object):
     """
-    Linear regressor based on a probabilistic model as provided by sklearn
+    Bayesian ridge regression updated from sufficient statistics (X^T X, X^T y, y^T y, sums and counts)
+      Hyperparameters follow the evidence maximization of sklearn's BayesianRidge, computed from the
+      statistics alone, so an update costs O(batch) instead of O(history).
+    Features can be expanded to polynomials of the given degree after scaling them with the statistics
+      of the first batch - scaling must not change afterwards as it would invalidate the statistics.
     """
-    eval_metric = staticmethod(metrics.r2_score)
 
-    # class variables
-    train_if_no_model = True
-    num_rounds_per_estimator = 3
+    def __init__(self, degree=None, max_iter=300, tol=1e-3, alpha_1=1e-6, alpha_2=1e-6, lambda_1=1e-6,
+                 lambda_2=1e-6):
+        self.degree = degree
+        self.max_iter = max_iter
+        self.tol = tol
+        self.alpha_1 = alpha_1
+        self.alpha_2 = alpha_2
+        self.lambda_1 = lambda_1
+        self.lambda_2 = lambda_2
 
-    def BRidgePipeline(self):
-        steps = [('scaler', StandardScaler()), ('bridge', linear_model.BayesianRidge(compute_score=True))]
-        return Pipeline(steps)
+        self.build_time = pd.Timestamp.now()
+        self.last_timestamp = None
+
+        self.offset = None
+        self.norm = None
+        self.poly = None
+
+        self.n = 0
+        self.sum_x = None
+        self.sum_y = 0.0
+        self.xtx = None
+        self.xty = None
+        self.yty = 0.0
+
+        self.alpha = None
+        self.lambda_ = 1.0
+        self.coef = None
+        self.intercept = 0.0
+        self.sigma = None
+        self.x_mean = None
+
+    def expand(self, X):
+        if self.degree is None or self.degree < 2:
+            return X
+        return self.poly.transform((X - self.offset) / self.norm)
+
+    def partial_fit(self, X, y):
+        """
+        Add a batch of observations to the sufficient statistics and update the posterior
+        """
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).reshape(-1, )
+        if y.size == 0:
+            return self
+
+        if self.degree is not None and self.degree >= 2 and self.poly is None:
+            self.offset = X.mean(axis=0)
+            norm = X.std(axis=0)
+            self.norm = np.where(norm > 0, norm, 1.0)
+            self.poly = PolynomialExpansion(degree=self.degree, include_bias=False).fit(X)
+
+        Xe = self.expand(X)
+
+        if self.xtx is None:
+            self.sum_x = np.zeros(Xe.shape[1])
+            self.xtx = np.zeros((Xe.shape[1], Xe.shape[1]))
+            self.xty = np.zeros(Xe.shape[1])
+
+        self.n += y.size
+        self.sum_x += Xe.sum(axis=0)
+        self.sum_y += y.sum()
+        self.xtx += Xe.T @ Xe
+        self.xty += Xe.T @ y
+        self.yty += y @ y
+
+        self.update_posterior()
+        return self
 
-    def set_estimators(self):
-        params = {}
-        self.estimators['bayesianridge'] = (self.BRidgePipeline, params)
+    def update_posterior(self):
+        n = self.n
+        x_mean = self.sum_x / n
+        y_mean = self.sum_y / n
+
+        # center the statistics - this is how the intercept is fitted
+        sxx = self.xtx - n * np.outer(x_mean, x_mean)
+        sxy = self.xty - n * x_mean * y_mean
+        syy = max(self.yty - n * y_mean ** 2, 0.0)
+
+        eigen_vals, eigen_vecs = np.linalg.eigh(sxx)
+        eigen_vals = np.maximum(eigen_vals, 0)
+        vt_sxy = eigen_vecs.T @ sxy
+
+        alpha = self.alpha
+        if alpha is None:
+            alpha = 1.0 / (syy / n + np.finfo(np.float64).eps)
+        lambda_ = self.lambda_
+
+        coef_old = None
+        for _ in range(self.max_iter):
+            # posterior mean in the eigen basis of sxx
+            coef = eigen_vecs @ (alpha * vt_sxy / (lambda_ + alpha * eigen_vals))
+            rmse = max(syy - 2 * coef @ sxy + coef @ sxx @ coef, 0.0)
+
+            gamma = np.sum(alpha * eigen_vals / (lambda_ + alpha * eigen_vals))
+            lambda_ = (gamma + 2 * self.lambda_1) / (np.sum(coef ** 2) + 2 * self.lambda_2)
+            alpha = (n - gamma + 2 * self.alpha_1) / (rmse + 2 * self.alpha_2)
+
+            if coef_old is not None and np.sum(np.abs(coef_old - coef)) < self.tol:
+                break
+            coef_old = coef
+
+        self.alpha = alpha
+        self.lambda_ = lambda_
+        self.coef = eigen_vecs @ (alpha * vt_sxy / (lambda_ + alpha * eigen_vals))
+        self.intercept = y_mean - x_mean @ self.coef
+        self.sigma = (eigen_vecs / (lambda_ + alpha * eigen_vals)) @ eigen_vecs.T
+        self.x_mean = x_mean
+
+    @property
+    def fitted(self):
+        return self.coef is not None
+
+    def predict(self, X, return_std=False):
+        Xe = self.expand(np.asarray(X, dtype=np.float64))
+        y_mean = Xe @ self.coef + self.intercept
+        if not return_std:
+            return y_mean
+
+        Xc = Xe - self.x_mean
+        y_std = np.sqrt(np.sum((Xc @ self.sigma) * Xc, axis=1) + 1.0 / self.alpha)
+        return y_mean, y_std
+
+
+def execute_incremental_regressor(regressor, df_copy, new_model, suffix, stddev=False, fill_value=0.0):
+    """
+    Update per entity and target models with the rows not seen before and predict
+      models provide partial_fit, predict, fitted and last_timestamp; they are kept in the model store
+      under the regressor's model name with the given suffix and the entity appended.
+      predictions (and deviations) are collected for all entities and written in one go
+    """
+    db = regressor._entity_type.db
 
-        logger.info('Bayesian Ridge Regressor start searching for best model')
+    codes, entities = entity_codes(df_copy)
+    order = np.argsort(codes, kind='stable')
+    entity_rows = np.split(order, np.flatnonzero(np.diff(codes[order])) + 1) if codes.size > 0 else []
 
-    def __init__(self, features, targets, predictions=None, deviations=None):
-        super().__init__(features=features, targets=targets, predictions=predictions, stddev=True)
+    timestamps = df_copy.index.get_level_values(1).to_numpy(dtype='datetime64[ns]')
+    try:
+        X = df_copy[regressor.features].to_numpy(dtype=np.float64)
+        Y = df_copy[regressor.targets].to_numpy(dtype=np.float64)
+    except Exception as e:
+        logger.error('Found non numeric values in feature or target columns error: ' + str(e))
+        return df_copy
 
-        if deviations is not None:
-            self.pred_stddev = deviations
+    predictions = np.full(Y.shape, fill_value)
+    deviations = np.full(Y.shape, fill_value)
 
-        self.experiments_per_execution = 1
-        self.auto_train = True
-        self.correlation_threshold = 0
-        self.stop_auto_improve_at = -2
+    for rows in entity_rows:
+        entity = entities[codes[rows[0]]]
+        for i, target in enumerate(regressor.targets):
+            try:
+                model_name = regressor.get_model_name(regressor.features, target, suffix=suffix + '.' + str(entity))
 
+                model = None
+                try:
+                    with stage(regressor, 'model_io', entity):
+                        model = db.model_store.retrieve_model(model_name)
+                    logger.info('load model %s' % str(model))
+                except Exception as e:
+                    logger.error('Model retrieval failed with ' + str(e))
+                    pass
+
+                if model is None:
+                    model = new_model()
+
+                finite = np.isfinite(X[rows]).all(axis=1)
+                new = finite & np.isfinite(Y[rows, i])
+                if model.last_timestamp is not None:
+                    new &= timestamps[rows] > model.last_timestamp
+
+                if new.any() and regressor.auto_train:
+                    with stage(regressor, 'fit', entity):
+                        model.partial_fit(X[rows][new], Y[rows, i][new])
+                    model.last_timestamp = timestamps[rows][new].max()
+                    logger.debug(regressor.__class__.__name__ + ': Entity ' + str(entity) + ' updated with ' +
+                                 str(new.sum()) + ' rows, ' + str(model.n) + ' in total')
+                    try:
+                        with stage(regressor, 'model_io', entity):
+                            db.model_store.store_model(model_name, model)
+                    except Exception as e:
+                        logger.error('Model store failed with ' + str(e))
+                        pass
+
+                if model.fitted and finite.any():
+                    with stage(regressor, 'score', entity):
+                        if stddev:
+                            pred, std = model.predict(X[rows][finite], return_std=True)
+                            deviations[rows[finite], i] = std
+                        else:
+                            pred = model.predict(X[rows][finite])
+                        predictions[rows[finite], i] = pred
+
+            except Exception as e:
+                logger.info(regressor.__class__.__name__ + ' for entity ' + str(entity) + ' failed with: ' + str(e))
+
+    with stage(regressor, 'write_back'):
+        df_copy[regressor.predictions] = predictions
+        if stddev:
+            df_copy[regressor.pred_stddev] = deviations
+
+    return df_copy
+
+
+def execute_incremental_bayes_ridge(regressor, df_copy, degree=None):
+    """
+    Update per entity and target Bayesian ridge models with the rows not seen before and predict in closed form
+    """
+    return execute_incremental_regressor(regressor, df_copy, lambda: IncrementalBayesRidge(degree=degree),
+                                         'incremental', stddev=True)
+
+
+class BayesRidgeRegressor(BaseEstimatorFunction):
+    """
+    Linear regressor based on a probabilistic model as provided by sklearn
+    """
+    eval_metric = staticmethod(metrics.r2_score)
+
+    # class variables
+    train_if_no_model = True
+
+    # number of processes and threads per process to train entities in parallel
+    n_jobs = 1
+    threads_per_job = 1
+    num_rounds_per_estimator = 3
+
+    def BRidgePipeline(self):
+        steps = [('scaler', StandardScaler()), ('bridge', linear_model.BayesianRidge(compute_score=True))]
+        return Pipeline(steps)
+
+    def set_estimators(self):
+        params = {}
+        self.estimators['bayesianridge'] = (self.BRidgePipeline, params)
+
+        logger.info('Bayesian Ridge Regressor start searching for best model')
+
+    def __init__(self, features, targets, predictions=None, deviations=None, incremental=False):
+        super().__init__(features=features, targets=targets, predictions=predictions, stddev=True)
+
+        if deviations is not None:
+            self.pred_stddev = deviations
+
+        self.experiments_per_execution = 1
+        self.auto_train = True
+        self.correlation_threshold = 0
+        self.stop_auto_improve_at = -2
+
+        # update the posterior from sufficient statistics with each batch instead of refitting
+        self.incremental = incremental
+
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -1938,19 +2620,26 @@ class BayesRidgeRegressor(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        if self.incremental:
+            return execute_incremental_bayes_ridge(self, df_copy, degree=None)
+
+        # train entities without a model over a process pool, the loop below only predicts them
+        train_entities(self, df_copy, entities)
+
         for entity in entities:
             try:
                 #check_array(df_copy.loc[[entity]][self.features].values, allow_nd=2)
                 logger.debug('check passed')
-                dfe = super()._execute(df_copy.loc[[entity]], entity)
+                dfe = execute_estimator(self, df_copy.loc[[entity]], entity)
 
                 logger.debug('BayesianRidge: Entity ' + str(entity) + ' Type of pred, stddev arrays ' + \
                              str(type(dfe[self.predictions])) + str(type(dfe[self.pred_stddev].values)))
 
                 dfe.fillna(0, inplace=True)
 
-                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
-                df_copy.loc[entity, self.pred_stddev] = dfe[self.pred_stddev]
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+                    df_copy.loc[entity, self.pred_stddev] = dfe[self.pred_stddev]
 
             except Exception as e:
                 logger.info('Bayesian Ridge regressor for entity ' + str(entity) + ' failed with: ' + str(e))
@@ -1967,6 +2656,8 @@ class BayesRidgeRegressor(BaseEstimatorFunction):
                                   is_output_datatype_derived=True))
         inputs.append(UIMultiItem(name='targets', datatype=float, required=True, output_item='predictions',
                                   is_output_datatype_derived=True))
+        inputs.append(UISingle(name='incremental', datatype=bool, required=False,
+                               description='Update the model with each batch instead of retraining'))
 
         # define arguments that behave as function outputs
         outputs = []
@@ -1981,11 +2672,15 @@ class BayesRidgeRegressorExt(BaseEstimatorFunction):
 
     # class variables
     train_if_no_model = True
+
+    # number of processes and threads per process to train entities in parallel
+    n_jobs = 1
+    threads_per_job = 1
     num_rounds_per_estimator = 3
 
     def BRidgePipelineDeg(self):
         steps = [('scaler', StandardScaler()),
-                 ('poly', PolynomialFeatures(degree=self.degree)),
+                 ('poly', PolynomialExpansion(degree=self.degree)),
                  ('bridge', linear_model.BayesianRidge(compute_score=True))]
         return Pipeline(steps)
 
@@ -1994,7 +2689,7 @@ class BayesRidgeRegressorExt(BaseEstimatorFunction):
         self.estimators['bayesianridge'] = (self.BRidgePipelineDeg, params)
         logger.info('Bayesian Ridge Regressor start searching for best polynomial model of degree ' + str(self.degree))
 
-    def __init__(self, features, targets, predictions=None, deviations=None, degree=3):
+    def __init__(self, features, targets, predictions=None, deviations=None, degree=3, incremental=False):
         super().__init__(features=features, targets=targets, predictions=predictions, stddev=True)
 
         if deviations is not None:
@@ -2006,6 +2701,11 @@ class BayesRidgeRegressorExt(BaseEstimatorFunction):
         self.stop_auto_improve_at = -2
         self.degree = degree
 
+        # update the posterior from sufficient statistics with each batch instead of refitting
+        self.incremental = incremental
+
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -2018,19 +2718,26 @@ class BayesRidgeRegressorExt(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        if self.incremental:
+            return execute_incremental_bayes_ridge(self, df_copy, degree=self.degree)
+
+        # train entities without a model over a process pool, the loop below only predicts them
+        train_entities(self, df_copy, entities)
+
         for entity in entities:
             try:
                 #check_array(df_copy.loc[[entity]][self.features].values, allow_nd=2)
                 logger.debug('check passed')
-                dfe = super()._execute(df_copy.loc[[entity]], entity)
+                dfe = execute_estimator(self, df_copy.loc[[entity]], entity)
 
                 logger.debug('BayesianRidge: Entity ' + str(entity) + ' Type of pred, stddev arrays ' + \
                              str(type(dfe[self.predictions])) + str(type(dfe[self.pred_stddev].values)))
 
                 dfe.fillna(0, inplace=True)
 
-                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
-                df_copy.loc[entity, self.pred_stddev] = dfe[self.pred_stddev]
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+                    df_copy.loc[entity, self.pred_stddev] = dfe[self.pred_stddev]
 
             except Exception as e:
                 logger.info('Bayesian Ridge regressor for entity ' + str(entity) + ' failed with: ' + str(e))
@@ -2049,12 +2756,357 @@ class BayesRidgeRegressorExt(BaseEstimatorFunction):
                                   is_output_datatype_derived=True))
         inputs.append(
             UISingle(name='degree', datatype=int, required=False, description=('Degree of polynomial')))
+        inputs.append(UISingle(name='incremental', datatype=bool, required=False,
+                               description='Update the model with each batch instead of retraining'))
 
         # define arguments that behave as function outputs
         outputs = []
         return (inputs, outputs)
 
 
+class WarmStartGBM(object):
+    """
+    LightGBM booster that continues boosting from its previous trees on new data only
+      Bins are derived once from a bounded sample of the first batch, later batches are binned against
+      this reference instead of rebuilding the bin mappers.
+      The number of trees is capped by pruning the oldest trees and refitting the leaf values of the rest on the
+      new batch and a bounded reservoir sample of the earlier rows, a leaf keeps decay_rate of its value
+      (LightGBM's refit default 0.9).
+    """
+
+    # reservoir sample of the rows seen so far, refitted along with the new batch when pruning
+    history_X = None
+    history_y = None
+
+    def __init__(self, params=None, n_estimators=500, update_estimators=50, max_trees=None, decay_rate=0.9,
+                 sample_size=20000, seed=None):
+        self.params = {'objective': 'regression', 'verbosity': -1}
+        if params is not None:
+            self.params.update(params)
+        self.n_estimators = n_estimators
+        self.update_estimators = update_estimators
+        self.max_trees = max_trees
+        self.decay_rate = decay_rate
+        self.sample_size = sample_size
+        self.seed = seed
+
+        self.build_time = pd.Timestamp.now()
+        self.last_timestamp = None
+        self.n = 0
+
+        self.sample = None
+        self.booster = None
+        self.reference = None
+
+    def __getstate__(self):
+        # the constructed reference dataset lives in native memory, rebuild it from the sample after loading
+        state = self.__dict__.copy()
+        state['reference'] = None
+        return state
+
+    def reference_dataset(self):
+        if self.reference is None:
+            self.reference = lightgbm.Dataset(self.sample, params=self.params, free_raw_data=False).construct()
+        return self.reference
+
+    def partial_fit(self, X, y):
+        """
+        Boost the initial model or continue boosting the previous one with a batch of new observations
+        """
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).reshape(-1, )
+        if y.size == 0:
+            return self
+
+        if self.sample is None:
+            rng = np.random.default_rng(self.seed)
+            rows = rng.choice(y.size, self.sample_size, replace=False) if y.size > self.sample_size else slice(None)
+            self.sample = X[rows]
+
+        train_set = lightgbm.Dataset(X, y, reference=self.reference_dataset(), params=self.params,
+                                     free_raw_data=False)
+
+        num_boost_round = self.n_estimators if self.booster is None else self.update_estimators
+        self.booster = lightgbm.train(self.params, train_set, num_boost_round=num_boost_round,
+                                      init_model=self.booster, keep_training_booster=False)
+
+        if self.max_trees is not None and self.booster.current_iteration() > self.max_trees:
+            self.prune(X, y)
+
+        self.remember(X, y)
+        self.n += y.size
+        return self
+
+    def remember(self, X, y):
+        """
+        Keep each row seen so far in the history with the same probability, sample_size rows at most
+        """
+        if self.history_X is None:
+            self.history_X = X[:0].copy()
+            self.history_y = y[:0].copy()
+
+        free = max(0, self.sample_size - self.history_y.size)
+        if free > 0:
+            self.history_X = np.concatenate([self.history_X, X[:free]])
+            self.history_y = np.concatenate([self.history_y, y[:free]])
+
+        # reservoir sampling of the remaining rows, row i of the stream replaces a random row with p = size / i
+        seen = self.n + free + np.arange(1, y.size - free + 1)
+        rng = np.random.default_rng(None if self.seed is None else self.seed + self.n)
+        keep = np.flatnonzero(rng.random(seen.size) < self.sample_size / seen) + free
+        slots = rng.integers(0, self.sample_size, keep.size)
+        self.history_X[slots] = X[keep]
+        self.history_y[slots] = y[keep]
+
+    def prune(self, X, y):
+        """
+        Drop the oldest trees beyond max_trees and refit the leaf values of the remaining trees
+        """
+        drop = self.booster.current_iteration() - self.max_trees
+        logger.debug('WarmStartGBM: prune ' + str(drop) + ' trees')
+        self.booster = lightgbm.Booster(model_str=self.booster.model_to_string(start_iteration=drop))
+        if self.history_X is not None:
+            X = np.concatenate([self.history_X, X])
+            y = np.concatenate([self.history_y, y])
+        self.booster = self.booster.refit(X, y, decay_rate=self.decay_rate)
+        return self
+
+    @property
+    def fitted(self):
+        return self.booster is not None
+
+    def predict(self, X):
+        return self.booster.predict(np.asarray(X, dtype=np.float64))
+
+
+def lightgbm_params(regressor, n_estimators=500):
+    """
+    Translate the sklearn style parameter grid of a LightGBM pipeline into booster parameters
+    """
+    params = {}
+    for key, value in getattr(regressor, 'params', {}).items():
+        key = key.replace('gbm__', '')
+        if value[0] is None:
+            continue
+        if key == 'n_estimators':
+            n_estimators = value[0]
+        elif key != 'verbosity':
+            params[key] = value[0]
+    return params, n_estimators
+
+
+def execute_warm_start_gbm(regressor, df_copy):
+    """
+    Continue boosting per entity and target LightGBM models with the rows not seen before and predict
+    """
+    params, n_estimators = lightgbm_params(regressor)
+
+    return execute_incremental_regressor(
+        regressor, df_copy, lambda: WarmStartGBM(params=params, n_estimators=n_estimators,
+                                                 update_estimators=max(1, n_estimators // 10),
+                                                 max_trees=regressor.max_trees, decay_rate=regressor.decay_rate),
+        'warmstart', fill_value=np.nan)
+
+
+class GlobalGBM(object):
+    """
+    One LightGBM model for all entities with the entity encoded as categorical feature
+      With entity scaling features and target are standardized per entity, predictions are scaled back.
+      Rows of entities not seen in training are predicted with the entity as missing category - or NaN
+      with entity scaling as there are no scaling parameters for them.
+      Trained and evaluated on a split of the rows like the models of BaseEstimatorFunction, with trained_date,
+      expiry_date and eval_metric_test for its training decision.
+    """
+
+    # models stored before they were evaluated
+    trained_date = None
+    expiry_date = None
+    eval_metric_test = None
+
+    def __init__(self, features, target, params=None, n_estimators=500, entity_scaling=False):
+        self.features = list(features)
+        self.target = target
+        self.params = {'objective': 'regression', 'verbosity': -1}
+        if params is not None:
+            self.params.update(params)
+        self.n_estimators = n_estimators
+        self.entity_scaling = entity_scaling
+
+        self.build_time = pd.Timestamp.now()
+        self.n = 0
+
+        self.entities = None
+        self.scaler = None
+        self.booster = None
+
+    def design(self, df, X):
+        codes, _ = entity_codes(df, self.entities)
+        if self.scaler is not None:
+            X = self.scaler.transform(df, np.column_stack([X, np.zeros(X.shape[0])]))[:, :-1]
+        return np.column_stack([X, np.where(codes >= 0, codes, np.nan)])
+
+    def fit(self, df, X, y, previous=None, test_size=0.0, eval_metric=None, shelf_life_days=None, seed=None):
+        """
+        Train on the rows of all entities at once, df provides the entity index of X and y
+          Entities of a previous model keep their category and scaling parameters, entities new to it are added.
+          test_size rows are held out to compute eval_metric_test (r2 score by default).
+        """
+        _, entities = entity_codes(df)
+        if previous is not None and previous.entities is not None:
+            entities = pd.unique(np.concatenate([np.asarray(previous.entities, dtype=object),
+                                                 np.asarray(entities, dtype=object)]))
+        self.entities = np.asarray(entities)
+
+        test = np.zeros(y.size, dtype=bool)
+        if test_size is not None and test_size > 0:
+            test = np.random.default_rng(seed).random(y.size) < test_size
+            if test.all():
+                test[:] = False
+        train = ~test
+
+        if self.entity_scaling:
+            if previous is not None and previous.scaler is not None:
+                self.scaler = copy.deepcopy(previous.scaler)
+            else:
+                self.scaler = EntityScaler('standard', self.features + [self.target])
+            self.scaler.fit(pd.DataFrame(np.column_stack([X[train], y[train]]), index=df.index[train],
+                                         columns=self.scaler.features))
+            y_train = self.scaler.transform(df[train], np.column_stack([X[train], y[train]]))[:, -1]
+        else:
+            y_train = y[train]
+
+        train_set = lightgbm.Dataset(self.design(df[train], X[train]), y_train,
+                                     categorical_feature=[len(self.features)], params=self.params)
+        self.booster = lightgbm.train(self.params, train_set, num_boost_round=self.n_estimators)
+        self.n = y_train.size
+
+        if eval_metric is None:
+            eval_metric = metrics.r2_score
+        # without test rows the model is evaluated on its training rows
+        rows = test if test.any() else train
+        prediction = self.predict(df[rows], X[rows])
+        known = np.isfinite(prediction)
+        self.eval_metric_test = eval_metric(y[rows][known], prediction[known]) if known.sum() > 1 else None
+
+        self.trained_date = dt.datetime.utcnow()
+        if shelf_life_days is not None:
+            self.expiry_date = self.trained_date + dt.timedelta(days=shelf_life_days)
+        return self
+
+    def predict(self, df, X):
+        """
+        Predict the rows of all entities with a single call
+        """
+        prediction = self.booster.predict(self.design(df, X))
+        if self.scaler is not None:
+            codes, _ = entity_codes(df, self.scaler.entities)
+            known = codes >= 0
+            prediction = np.where(known, prediction * self.scaler.scale[np.maximum(codes, 0), -1] +
+                                  self.scaler.center[np.maximum(codes, 0), -1], np.nan)
+        return prediction
+
+
+def global_training_required(function, model, df, rows):
+    """
+    Training decision for a model of all entities - as for models per entity (no model, expired model, eval metric
+    below stop_auto_improve_at) and when entities with training rows show up that the model does not know
+    """
+    if model is not None and model.eval_metric_test is None and function.auto_train:
+        return True, 'Training required because the model has not been evaluated'
+
+    required, msg = function.decide_training_required(model)
+    if not required and model is not None and function.auto_train:
+        codes, _ = entity_codes(df[rows], model.entities)
+        if (codes < 0).any():
+            return True, 'Training required for entities the model does not know yet'
+    return required, msg
+
+
+def fit_global_gbm(function, target, previous, df, X, y):
+    """
+    Train a global model for target, extending the entities of the previous model
+    """
+    params, n_estimators = lightgbm_params(function)
+    model = GlobalGBM(function.features, target, params=params, n_estimators=n_estimators,
+                      entity_scaling=function.entity_scaling)
+    return model.fit(df, X, y, previous=previous, test_size=function.test_size, eval_metric=function.eval_metric,
+                     shelf_life_days=function.shelf_life_days)
+
+
+def execute_global_gbm(regressor, df_copy, models=None, train=True, retrain=False):
+    """
+    Train one LightGBM model per target for all entities when required and predict the whole frame at once
+      The training decision follows BaseEstimatorFunction (see global_training_required), retrain trains without
+      asking. models caches models across calls within one execution.
+    """
+    db = regressor._entity_type.db
+
+    try:
+        X = df_copy[regressor.features].to_numpy(dtype=np.float64)
+        Y = df_copy[regressor.targets].to_numpy(dtype=np.float64)
+    except Exception as e:
+        logger.error('Found non numeric values in feature or target columns error: ' + str(e))
+        return df_copy
+
+    finite = np.isfinite(X).all(axis=1)
+    predictions = np.full(Y.shape, np.nan)
+
+    for i, target in enumerate(regressor.targets):
+        model_name = regressor.get_model_name(regressor.features, target, suffix='global')
+
+        model = None
+        if models is not None:
+            model = models.get(model_name)
+
+        if model is None and not regressor.delete_existing_models:
+            try:
+                with stage(regressor, 'model_io'):
+                    model = db.model_store.retrieve_model(model_name)
+                logger.info('load model %s' % str(model))
+            except Exception as e:
+                logger.error('Model retrieval failed with ' + str(e))
+                pass
+
+        rows = finite & np.isfinite(Y[:, i])
+
+        required = retrain and regressor.auto_train
+        if train and not retrain:
+            required, msg = global_training_required(regressor, model, df_copy, rows)
+            logger.info(msg)
+
+        if required and rows.any():
+            trained = None
+            try:
+                with stage(regressor, 'fit'):
+                    trained = fit_global_gbm(regressor, target, model, df_copy[rows], X[rows], Y[rows, i])
+                logger.debug(regressor.__class__.__name__ + ': global model trained on ' + str(trained.n) +
+                             ' rows of ' + str(trained.entities.size) + ' entities, eval metric ' +
+                             str(trained.eval_metric_test))
+            except Exception as e:
+                logger.info(regressor.__class__.__name__ + ' global model failed with: ' + str(e))
+
+            if trained is not None:
+                model = trained
+                try:
+                    with stage(regressor, 'model_io'):
+                        db.model_store.store_model(model_name, model)
+                except Exception as e:
+                    logger.error('Model store failed with ' + str(e))
+                    pass
+
+        if models is not None and model is not None:
+            models[model_name] = model
+
+        if model is not None and finite.any():
+            with stage(regressor, 'score'):
+                predictions[finite, i] = model.predict(df_copy[finite], X[finite])
+
+    with stage(regressor, 'write_back'):
+        df_copy[regressor.predictions] = predictions
+
+    return df_copy
+
+
 class GBMRegressor(BaseEstimatorFunction):
     """
     Regressor based on gradient boosting method as provided by lightGBM
@@ -2064,6 +3116,10 @@ class GBMRegressor(BaseEstimatorFunction):
     # class variables
     train_if_no_model = True
 
+    # number of processes and threads per process to train entities in parallel
+    n_jobs = 1
+    threads_per_job = 1
+
     def GBMPipeline(self):
         steps = [('scaler', StandardScaler()), ('gbm', lightgbm.LGBMRegressor())]
         return Pipeline(steps=steps)
@@ -2074,7 +3130,8 @@ class GBMRegressor(BaseEstimatorFunction):
         logger.info('GBMRegressor start searching for best model')
 
     def __init__(self, features, targets, predictions=None, n_estimators=None, num_leaves=None, learning_rate=None,
-                 max_depth=None):
+                 max_depth=None, warm_start=False, max_trees=None, decay_rate=None, global_model=False,
+                 entity_scaling=False):
         super().__init__(features=features, targets=targets, predictions=predictions, keep_current_models=True)
         self.experiments_per_execution = 1
         self.correlation_threshold = 0
@@ -2093,6 +3150,17 @@ class GBMRegressor(BaseEstimatorFunction):
 
         self.stop_auto_improve_at = -2
 
+        # continue boosting the stored booster on new data instead of retraining from scratch
+        self.warm_start = warm_start
+        self.max_trees = max_trees
+        self.decay_rate = 0.9 if decay_rate is None else float(decay_rate)
+
+        # one model for all entities instead of one per entity
+        self.global_model = global_model
+        self.entity_scaling = entity_scaling
+
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -2103,6 +3171,15 @@ class GBMRegressor(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        if self.global_model:
+            return execute_global_gbm(self, df_copy)
+
+        if self.warm_start:
+            return execute_warm_start_gbm(self, df_copy)
+
+        # train entities without a model over a process pool, the loop below only predicts them
+        train_entities(self, df_copy, entities)
+
         for entity in entities:
             # per entity - copy for later inplace operations
             try:
@@ -2112,8 +3189,9 @@ class GBMRegressor(BaseEstimatorFunction):
                     'Found Nan or infinite value in feature columns for entity ' + str(entity) + ' error: ' + str(e))
                 continue
 
-            dfe = super()._execute(df_copy.loc[[entity]], entity)
-            df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+            dfe = execute_estimator(self, df_copy.loc[[entity]], entity)
+            with stage(self, 'write_back', entity):
+                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
 
         return df_copy
 
@@ -2131,11 +3209,60 @@ class GBMRegressor(BaseEstimatorFunction):
         inputs.append(UISingle(name='learning_rate', datatype=float, required=False, description=('Learning rate')))
         inputs.append(
             UISingle(name='max_depth', datatype=int, required=False, description=('Cut tree to prevent overfitting')))
+        inputs.append(UISingle(name='warm_start', datatype=bool, required=False,
+                               description='Continue boosting the stored model on new data instead of retraining'))
+        inputs.append(UISingle(name='max_trees', datatype=int, required=False,
+                               description='Cap on the number of trees, the oldest trees are pruned'))
+        inputs.append(UISingle(name='decay_rate', datatype=float, required=False,
+                               description='Share of the leaf values kept when the remaining trees are refitted '
+                                           'after pruning - 0.9 by default'))
+        inputs.append(UISingle(name='global_model', datatype=bool, required=False,
+                               description='Train one model for all entities with the entity as categorical feature'))
+        inputs.append(UISingle(name='entity_scaling', datatype=bool, required=False,
+                               description='Standardize features and target per entity for the global model'))
         # define arguments that behave as function outputs
         outputs = []
         return (inputs, outputs)
 
 
+class StreamingSGD(object):
+    """
+    Scaler and SGD regressor learning online with partial_fit, one pass over each batch
+      The scaler is fitted on the first batch and kept fixed afterwards, the coefficients learned so far would
+      not fit a changing feature scaling.
+      The decay of the learning rate depends on the number of samples seen so far (t_ of SGDRegressor),
+      which is persisted along with the model.
+    """
+
+    def __init__(self, eta0=0.01, decay=True, power_t=0.25, alpha=0.0001, seed=None):
+        self.scaler = StandardScaler()
+        self.sgd = linear_model.SGDRegressor(learning_rate='invscaling' if decay else 'constant', eta0=eta0,
+                                             power_t=power_t, alpha=alpha, random_state=seed)
+
+        self.build_time = pd.Timestamp.now()
+        self.last_timestamp = None
+        self.n = 0
+
+    def partial_fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).reshape(-1, )
+        if y.size == 0:
+            return self
+
+        if self.n == 0:
+            self.scaler.fit(X)
+        self.sgd.partial_fit(self.scaler.transform(X), y)
+        self.n += y.size
+        return self
+
+    @property
+    def fitted(self):
+        return hasattr(self.sgd, 'coef_')
+
+    def predict(self, X):
+        return self.sgd.predict(self.scaler.transform(np.asarray(X, dtype=np.float64)))
+
+
 class SimpleRegressor(BaseEstimatorFunction):
     """
     Regressor based on stochastic gradient descent and gradient boosting method as provided by sklearn
@@ -2144,6 +3271,10 @@ class SimpleRegressor(BaseEstimatorFunction):
 
     # class variables
     train_if_no_model = True
+
+    # number of processes and threads per process to train entities in parallel
+    n_jobs = 1
+    threads_per_job = 1
     num_rounds_per_estimator = 3
 
     def GBRPipeline(self):
@@ -2162,13 +3293,27 @@ class SimpleRegressor(BaseEstimatorFunction):
         logger.info('SimpleRegressor start searching for best model')
 
     def __init__(self, features, targets, predictions=None, n_estimators=None, num_leaves=None, learning_rate=None,
-                 max_depth=None):
+                 max_depth=None, streaming=False, global_model=False, entity_scaling=False, eta0=None):
         super().__init__(features=features, targets=targets, predictions=predictions)
 
         self.experiments_per_execution = 1
         self.auto_train = True
         self.correlation_threshold = 0
 
+        # update scaler and SGD regressor with each batch instead of searching for the best batch model,
+        #   eta0 is the SGD regressor's initial learning rate - learning_rate is the one of the boosted models
+        self.streaming = streaming
+        self.eta0 = 0.01 if eta0 is None else float(eta0)
+        self.learning_rate = learning_rate
+
+        # one LightGBM model for all entities instead of one model per entity
+        self.global_model = global_model
+        self.entity_scaling = entity_scaling
+        self.params = {'gbm__n_estimators': [n_estimators], 'gbm__num_leaves': [num_leaves],
+                       'gbm__learning_rate': [learning_rate], 'gbm__max_depth': [max_depth]}
+
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -2179,11 +3324,22 @@ class SimpleRegressor(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        if self.global_model:
+            return execute_global_gbm(self, df_copy)
+
+        if self.streaming:
+            return execute_incremental_regressor(self, df_copy, lambda: StreamingSGD(eta0=self.eta0), 'streaming',
+                                                 fill_value=np.nan)
+
+        # train entities without a model over a process pool, the loop below only predicts them
+        train_entities(self, df_copy, entities)
+
         for entity in entities:
             try:
                 check_array(df_copy.loc[[entity]][self.features].values)
-                dfe = super()._execute(df_copy.loc[[entity]], entity)
-                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+                dfe = execute_estimator(self, df_copy.loc[[entity]], entity)
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[entity, self.predictions] = dfe[self.predictions]
 
             except Exception as e:
                 logger.info('GBMRegressor for entity ' + str(entity) + ' failed with: ' + str(e))
@@ -2198,6 +3354,16 @@ class SimpleRegressor(BaseEstimatorFunction):
         inputs.append(UIMultiItem(name='features', datatype=float, required=True))
         inputs.append(UIMultiItem(name='targets', datatype=float, required=True, output_item='predictions',
                                   is_output_datatype_derived=True))
+        inputs.append(UISingle(name='learning_rate', datatype=float, required=False,
+                               description='Learning rate of the LightGBM models'))
+        inputs.append(UISingle(name='streaming', datatype=bool, required=False,
+                               description='Update an SGD regressor with each batch instead of retraining'))
+        inputs.append(UISingle(name='eta0', datatype=float, required=False,
+                               description='Initial learning rate of the streaming SGD regressor - 0.01 by default'))
+        inputs.append(UISingle(name='global_model', datatype=bool, required=False,
+                               description='Train one model for all entities with the entity as categorical feature'))
+        inputs.append(UISingle(name='entity_scaling', datatype=bool, required=False,
+                               description='Standardize features and target per entity for the global model'))
         # define arguments that behave as function outputs
         outputs = []
         return (inputs, outputs)
@@ -2222,6 +3388,7 @@ class SimpleAnomaly(BaseRegressor):
         self.threshold = threshold
         self.correlation_threshold = 0
 
+    @model_cache
     def execute(self, df):
 
         try:
@@ -2258,56 +3425,106 @@ class SimpleAnomaly(BaseRegressor):
 # Forecasting
 #######################################################################################
 
+def tail_state_key(function, items):
+    return '_'.join(['TailState', str(function._entity_type.name), function.__class__.__name__] +
+                    [str(item) for item in items])
+
+
+def retrieve_tail_state(function, key, columns, depth):
+    """
+    Get the tail state of a feature building function from the model store - a new one if there is none
+    or if it was kept for other columns or fewer rows
+    """
+    db = function._entity_type.db
+
+    state = None
+    try:
+        state = db.model_store.retrieve_model(key)
+    except Exception as e:
+        logger.error('Tail state retrieval failed with ' + str(e))
+        pass
+
+    if state is None or not state.matches(columns, depth):
+        state = TailState(columns, depth)
+    return state
+
+
+def store_tail_state(function, key, state):
+    db = function._entity_type.db
+    try:
+        db.model_store.store_model(key, state)
+    except Exception as e:
+        logger.error('Tail state store failed with ' + str(e))
+        pass
+
+
 class FeatureBuilder(BaseTransformer):
+    """
+    Lagged features - previous value (plain) and rolling mean, stddev, min and max over the previous rows
+      lag and method take a single value or a list, with lists one call builds the whole feature family,
+      i.e. all methods for all window lengths for all features. Output names default to
+      <feature>_<method>_<window> and <feature>_plain.
+    """
 
-    def __init__(self, features, lag, method, lagged_features):
+    def __init__(self, features, lag, method, lagged_features=None, persist_state=False):
         super().__init__()
 
         self.features = features
-        self.lagged_features = lagged_features
 
-        self.lag = lag   # list of integers (days) to define lags
+        self.lag = lag   # window length or list of window lengths
+        self.windows = [int(window) for window in (lag if isinstance(lag, (list, tuple)) else [lag or 1])]
+
+        self.method = method   # method or list of methods: plain, mean, stddev, min, max
+        methods = method if isinstance(method, (list, tuple)) else [method]
+        self.methods = [str(m).lower() if str(m).lower() in rolling_methods else 'plain' for m in methods]
+
+        names = [feature + '_plain' if method == 'plain' else feature + '_' + method + '_' + str(window)
+                 for feature in features for method in self.methods
+                 for window in (self.windows if method in rolling_methods else [None])]
+        if lagged_features is None:
+            lagged_features = names
+        elif len(lagged_features) != len(names):
+            raise ValueError('FeatureBuilder: expected ' + str(len(names)) + ' lagged features, got ' +
+                             str(len(lagged_features)))
+        self.lagged_features = lagged_features
 
-        self.method = method   #
+        # keep the last rows per entity between runs instead of loading history
+        self.persist_state = persist_state
 
         self.whoami = 'FeatureBuilder'
 
-        print(self.whoami, self.features, self.lagged_features, self.lag, self.method)
-
+        logger.debug(self.whoami + str(self.features) + str(self.lagged_features) + str(self.lag) + str(self.method))
 
+    @model_cache
     def execute(self, df):
 
-        df_copy = df.copy()
-        entities = np.unique(df_copy.index.levels[0])
-        logger.debug(str(entities))
+        if self.persist_state:
+            key = tail_state_key(self, self.lagged_features)
+            state = retrieve_tail_state(self, key, self.features, max(self.windows))
+            df_extended, from_df = state.extend(df)
 
-        missing_cols = [x for x in self.lagged_features if x not in df_copy.columns]
-        for m in missing_cols:
-            df_copy[m] = None
+            df_copy = self.build_features(df_extended)
 
-        for entity in entities:
-            # per entity - copy for later inplace operations
-            try:
-                check_array(df_copy.loc[[entity]][self.features].values, allow_nd=True)
-                dfe = df_copy.loc[[entity]]
-            except Exception as e:
-                logger.error(
-                    'Found Nan or infinite value in feature columns for entity ' + str(entity) + ' error: ' + str(e))
-                continue
+            store_tail_state(self, key, state.update(df_extended))
+            return df_copy[from_df]
 
-            dfroll = dfe[self.features].rolling(window=self.lag, min_periods=0)
-            if self.method == 'mean':
-                dfe[self.lagged_features] = dfroll.mean().shift(1)
-            elif self.method == 'stddev':
-                dfe[self.lagged_features] = dfroll.std().shift(1)
-            else:
-                dfe[self.lagged_features] = dfe[self.features].shift(1)
+        return self.build_features(df)
 
-            #dfe = super()._execute(df_copy.loc[[entity]], entity)
-            df_copy.loc[entity, self.lagged_features] = dfe[self.lagged_features]
+    def build_features(self, df):
 
-        return df_copy
+        df_copy = df.copy()
+
+        # all methods and windows for all entities in one go
+        groups = EntityGroups(df_copy.index)
+        X = df_copy[self.features].to_numpy(dtype=np.float64)
+        family = feature_family(groups, X, self.windows, self.methods)
 
+        # entities with NaN or infinite feature values are left alone
+        valid = entity_validity(X, groups.codes, len(groups.entities))
+        family[~valid[groups.codes]] = np.nan
+
+        df_copy[self.lagged_features] = family
+        return df_copy
 
     @classmethod
     def build_ui(cls):
@@ -2316,7 +3533,9 @@ class FeatureBuilder(BaseTransformer):
         inputs.append(UIMultiItem(name='features', datatype=float, required=True, output_item='lagged_features',
                                   is_output_datatype_derived=True))
         inputs.append(UISingle(name='lag', datatype=int, description='Lag for each input_item'))
-        inputs.append(UISingle(name='method', datatype=str, description='Method: Plain, Mean, Stddev'))
+        inputs.append(UISingle(name='method', datatype=str, description='Method: Plain, Mean, Stddev, Min, Max'))
+        inputs.append(UISingle(name='persist_state', datatype=bool, required=False,
+                               description='Keep the last rows per entity between runs instead of loading history'))
         # define arguments that behave as function outputs
         outputs = []
         return (inputs, outputs)
@@ -2330,6 +3549,10 @@ class GBMForecaster(BaseEstimatorFunction):
     # class variables
     train_if_no_model = True
 
+    # number of processes and threads per process to train entities in parallel
+    n_jobs = 1
+    threads_per_job = 1
+
     def GBMPipeline(self):
         steps = [('scaler', StandardScaler()), ('gbm', lightgbm.LGBMRegressor())]
         return Pipeline(steps=steps)
@@ -2341,73 +3564,50 @@ class GBMForecaster(BaseEstimatorFunction):
 
     #
     # return list of new columns for the lagged features and dataframe extended with these new columns
+    #   all (feature, lag) columns are built in one pass respecting entity boundaries, rows without
+    #   a complete set of lagged values are dropped
     #
     def lag_features(self, df=None, Train=True):
-        print ('lags ' + str(self.lags) + '  lagged_features ' + str(self.lagged_features) + ' Train mode: ' + str(Train))
-        create_feature_triplets = []
         new_features = []
 
         if self.lags is None or self.lagged_features is None:
             return (new_features, None)
 
-        for lagged_feature in self.lagged_features:
-            for lag in self.lags:
-                # collect triple of new column, original column and lag
-                if Train:
-                    create_feature_triplets.append((lagged_feature + '_' + str(lag), lagged_feature, lag))
-                else:
-                    create_feature_triplets.append((lagged_feature + '_' + str(lag), lagged_feature, lag - self.forecast))
-
-                new_features.append(lagged_feature + '_' + str(lag))
-
-        # find out proper timescale
-        mindelta, df_copy = min_delta(df)
-
-        # add day of week and month of year as two feature pairs for at least hourly timescales
-        include_day_of_week = False
-        include_hour_of_day = False
-        if mindelta >= pd.Timedelta('1h'):
-            logger.info('GBMForecaster adding day_of_week feature')
-            include_day_of_week = True
-        elif mindelta >= pd.Timedelta('1m'):
-            logger.info('GBMForecaster adding hour_of_day feature')
-            include_hour_of_day = True
-
-        # add day of week or hour of day if appropriate
+        new_features = [lagged_feature + '_' + str(lag) for lagged_feature in self.lagged_features
+                        for lag in self.lags]
+        if df is None:
+            return (new_features, None)
 
-        if df is not None:
-            df_copy = df.copy()
-            missing_cols = [x[0] for x in create_feature_triplets if x not in df_copy.columns]
-            for m in missing_cols:
-                df_copy[m] = None
+        # collect shifts for the new columns - inference shifts features back by the forecast horizon
+        if Train:
+            shifts = self.lags
+        else:
+            shifts = [lag - self.forecast for lag in self.lags]
 
-            # I hope I can do that for all entities in one fell swoop
-            for new_feature in create_feature_triplets:
-                df_copy[new_feature[0]] = df[new_feature[1]].shift(new_feature[2])
+        groups = EntityGroups(df.index)
+        timestamps = df.index.get_level_values(1).asi8
 
-            # get rid of NaN as result of shifting columns
-            df_copy.dropna(inplace=True)
+        lagged = lag_matrix(groups, df[self.lagged_features].to_numpy(dtype=np.float32), shifts)
 
-            # add day of week and month of year as two feature pairs
-            # operate on simple timestamp index
-            if include_day_of_week:
-                new_features = np.concatenate((new_features, ['_DayOfWeekCos_', '_DayOfWeekSin_', '_DayOfYearCos_', '_DayOfYearSin_']))
-                df_copy['_DayOfWeekCos_'] = np.cos(df_copy.index.get_level_values(1).dayofweek / 7)
-                df_copy['_DayOfWeekSin_'] = np.sin(df_copy.index.get_level_values(1).dayofweek / 7)
-                df_copy['_DayOfYearCos_'] = np.cos(df_copy.index.get_level_values(1).dayofyear / 365)
-                df_copy['_DayOfYearSin_'] = np.sin(df_copy.index.get_level_values(1).dayofyear / 365)
-            elif include_hour_of_day:
-                new_features = np.concatenate((new_features, ['_HourOfDayCos_', '_HourOfDaySin_']))
-                df_copy['_HourOfDayCos_'] = np.cos(df_copy.index.get_level_values(1).hour / 24)
-                df_copy['_HourOfDaySin_'] = np.sin(df_copy.index.get_level_values(1).hour / 24)
+        # get rid of NaN as result of shifting columns
+        complete = ~np.isnan(lagged).any(axis=1)
+        if Train:
+            # and of rows with missing readings, the estimators reject NaN targets
+            columns = list(dict.fromkeys(list(self.targets) + list(self.lagged_features)))
+            complete &= df[columns].notna().all(axis=1).to_numpy()
+        df_copy = df[complete].copy()
+        df_copy[new_features] = lagged[complete]
 
-        else:
-            df_copy = df
+        # add day of week and day of year or hour of day depending on the timescale
+        calendar, matrix = calendar_features(timestamps, groups.min_delta(timestamps))
+        if len(calendar) > 0:
+            df_copy[calendar] = matrix[complete]
+            new_features = new_features + calendar
 
         return (new_features, df_copy)
 
-
-    def __init__(self, features, targets, predictions=None, lags=None):
+    def __init__(self, features, targets, predictions=None, lags=None, global_model=False, entity_scaling=False,
+                 horizons=None, horizon_predictions=None, persist_state=False):
         #
         # from https://github.com/ashitole/Time-Series-Project/blob/main/Auto-Arima%20and%20LGBM.ipynb
         #   as taken from https://www.kaggle.com/rohanrao/ashrae-half-and-half
@@ -2447,66 +3647,226 @@ class GBMForecaster(BaseEstimatorFunction):
 
         self.stop_auto_improve_at = -2
 
-    def execute(self, df):
+        # one model for all entities instead of one per entity
+        self.global_model = global_model
+        self.entity_scaling = entity_scaling
 
-        #df_copy = df.copy()
-        _, df_copy = self.lag_features(df=df, Train=True)
+        # forecasts of the first target for several horizons, one booster per horizon
+        self.horizons = horizons
+        if horizons is not None and horizon_predictions is None:
+            horizon_predictions = [self.targets[0] + '_forecast_' + str(horizon) for horizon in horizons]
+        self.horizon_predictions = horizon_predictions
 
-        print('Here 1', type(df_copy))
+        # keep the last rows per entity between runs instead of loading max(lags) rows of history
+        self.persist_state = persist_state
 
-        entities = np.unique(df_copy.index.levels[0])
-        logger.debug(str(entities))
+    def load_models(self, entities):
+        """
+        Models per entity and target, each model is retrieved from the model store once and kept in active_models
+        """
+        db = self._entity_type.db
 
-        missing_cols = [x for x in self.predictions if x not in df_copy.columns]
+        models = {}
+        for entity in entities:
+            models[entity] = []
+            for target in self.targets:
+                model_name = self.get_model_name(self.features, target, suffix=entity)
+
+                model = None
+                if self.active_models is not None and model_name in self.active_models:
+                    model = self.active_models[model_name][0]
+                else:
+                    try:
+                        with stage(self, 'model_io', entity):
+                            model = db.model_store.retrieve_model(model_name)
+                    except Exception as e:
+                        logger.error('Model retrieval failed with ' + str(e))
+                        pass
+                    if model is not None and self.active_models is not None:
+                        self.active_models[model_name] = (model, None)
+
+                models[entity].append(model)
+
+        return models
+
+    def train_models(self, df, entities):
+        """
+        Train models for the given entities on the training lags
+        """
+        with stage(self, 'prepare_data'):
+            _, df_train = self.lag_features(df=df.loc[entities], Train=True)
+
+        missing_cols = [x for x in self.predictions if x not in df_train.columns]
         for m in missing_cols:
-            df_copy[m] = None
+            df_train[m] = None
+
+        # entities are trained over a process pool first if configured
+        train_entities(self, df_train, entities)
 
-        # make sure to train a model
         for entity in entities:
-            # per entity - copy for later inplace operations
             try:
-                print (self.features)
-                check_array(df_copy.loc[[entity]][self.features].values, allow_nd=True)
+                check_array(df_train.loc[[entity]][self.features].values, allow_nd=True)
             except Exception as e:
                 logger.error(
                     'Found Nan or infinite value in feature columns for entity ' + str(entity) + ' error: ' + str(e))
-                #print(df_copy.loc[[entity]][self.features].head(20))
                 continue
 
-            dfe = super()._execute(df_copy.loc[[entity]], entity)
-            df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+            # forget the model we know to pick up the trained one
+            if self.active_models is not None:
+                for target in self.targets:
+                    self.active_models.pop(self.get_model_name(self.features, target, suffix=entity), None)
 
-        # preserve predictions based on full lag
-        df_pred = df_copy[self.predictions].rename(columns={self.predictions[0] : '__forecast__'})
+            execute_estimator(self, df_train.loc[[entity]], entity)
 
-        # use the model for inferencing - with less lag
-        strip_features, df_copy = self.lag_features(df=df, Train=False)
+    @stage_timing
+    @model_cache
+    def execute(self, df):
 
-        missing_cols = [x for x in self.predictions if x not in df_copy.columns]
-        for m in missing_cols:
-            df_copy[m] = None
+        if self.persist_state:
+            key = tail_state_key(self, self.predictions)
+            columns = list(dict.fromkeys(list(self.lagged_features) + list(self.targets)))
+            with stage(self, 'model_io'):
+                state = retrieve_tail_state(self, key, columns, max(max(self.lags), 1))
+            df_extended, from_df = state.extend(df)
 
-        for entity in entities:
-            # per entity - copy for later inplace operations
-            try:
-                print (self.features)
-                check_array(df_copy.loc[[entity]][self.features].values, allow_nd=True)
-            except Exception as e:
-                logger.error(
-                    'Found Nan or infinite value in feature columns for entity ' + str(entity) + ' error: ' + str(e))
-                #print(df_copy.loc[[entity]][self.features].head(20))
+            df_copy = self.build_forecasts(df_extended)
+
+            with stage(self, 'model_io'):
+                store_tail_state(self, key, state.update(df_extended))
+            return df_copy[~df_copy.index.isin(df_extended.index[~from_df])]
+
+        return self.build_forecasts(df)
+
+    def build_forecasts(self, df):
+
+        # features for inferencing - lagged values shifted back by the forecast horizon
+        with stage(self, 'prepare_data'):
+            strip_features, df_copy = self.lag_features(df=df, Train=False)
+
+        if self.global_model:
+            models = {}
+            df_copy = execute_global_gbm(self, df_copy, models=models, train=False)
+
+            # training features are only built when a model is missing, outdated or lacks entities of df
+            rows = np.isfinite(df[self.targets].to_numpy(dtype=np.float64)).all(axis=1)
+            if self.delete_existing_models or any(global_training_required(
+                    self, models.get(self.get_model_name(self.features, target, suffix='global')), df, rows)[0]
+                    for target in self.targets):
+                with stage(self, 'prepare_data'):
+                    _, df_train = self.lag_features(df=df, Train=True)
+                execute_global_gbm(self, df_train, models=models, retrain=True)
+                df_copy = execute_global_gbm(self, df_copy, models=models, train=False)
+
+            if self.horizons is not None:
+                self.execute_horizons(df, df_copy)
+
+            df_copy.drop(columns=strip_features, inplace=True)
+            return df_copy
+
+        entities = np.unique(df.index.get_level_values(0))
+        logger.debug(str(entities))
+
+        # train only entities without a model or with a model that needs retraining
+        models = self.load_models(entities)
+        required = [entity for entity in entities if self.delete_existing_models or
+                    any(self.decide_training_required(model)[0] for model in models[entity])]
+        if len(required) > 0 and self.auto_train:
+            logger.info('GBMForecaster training ' + str(len(required)) + ' entities')
+            self.train_models(df, required)
+            models.update(self.load_models(required))
+
+        # predict all entities from the shared inference features
+        groups = EntityGroups(df_copy.index)
+        X = df_copy[self.features]
+        finite = np.isfinite(X.to_numpy(dtype=np.float64)).all(axis=1)
+        predictions = np.full((df_copy.shape[0], len(self.targets)), np.nan)
+
+        for code, entity in enumerate(groups.entities):
+            rows = groups.order[groups.starts[code]:groups.starts[code] + groups.sizes[code]]
+            rows = rows[finite[rows]]
+            if rows.size == 0:
                 continue
+            for i, model in enumerate(models.get(entity, [])):
+                if model is None:
+                    continue
+                try:
+                    with stage(self, 'score', entity):
+                        predictions[rows, i] = model.predict(X.iloc[rows])
+                except Exception as e:
+                    logger.info('GBMForecaster for entity ' + str(entity) + ' failed with: ' + str(e))
 
-            dfe = super()._execute(df_copy.loc[[entity]], entity)
-            df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+        with stage(self, 'write_back'):
+            df_copy[self.predictions] = predictions
 
-            #df_copy = pd.merge(df_copy, df_pred, left_index=True, right_index=True, how='outer')
+        if self.horizons is not None:
+            self.execute_horizons(df, df_copy)
 
         logger.debug('Drop artificial features ' + str(strip_features))
-        df_copy.drop(columns = strip_features, inplace=True)
+        df_copy.drop(columns=strip_features, inplace=True)
 
         return df_copy
 
+    def execute_horizons(self, df, df_copy):
+        """
+        Forecast the first target for all horizons and write them to df_copy in one go
+          Boosters share the inference feature matrix built by lag_features, the booster for horizon h learns the
+          target h steps ahead within each entity. Each booster covers all entities and is retrained like the
+          global model (see GlobalGBM and global_training_required).
+        """
+        db = self._entity_type.db
+        target = self.targets[0]
+
+        X = df_copy[self.features].to_numpy(dtype=np.float64)
+        # targets ahead are taken from the whole frame, rows of df_copy are a subset of its rows
+        Y = lag_matrix(EntityGroups(df.index), df[target].to_numpy(dtype=np.float32),
+                       [-horizon for horizon in self.horizons])[df.index.get_indexer(df_copy.index)]
+
+        finite = np.isfinite(X).all(axis=1)
+        forecasts = np.full((df_copy.shape[0], len(self.horizons)), np.nan)
+
+        for j, horizon in enumerate(self.horizons):
+            model_name = self.get_model_name(self.features, target, suffix='horizon.' + str(horizon))
+
+            model = None
+            if not self.delete_existing_models:
+                try:
+                    with stage(self, 'model_io'):
+                        model = db.model_store.retrieve_model(model_name)
+                    logger.info('load model %s' % str(model))
+                except Exception as e:
+                    logger.error('Model retrieval failed with ' + str(e))
+                    pass
+
+            rows = finite & np.isfinite(Y[:, j])
+            required, msg = global_training_required(self, model, df_copy, rows)
+            logger.info('GBMForecaster horizon ' + str(horizon) + ': ' + msg)
+
+            if required and rows.any():
+                trained = None
+                try:
+                    with stage(self, 'fit'):
+                        trained = fit_global_gbm(self, target, model, df_copy[rows], X[rows], Y[rows, j])
+                    logger.debug('GBMForecaster: horizon ' + str(horizon) + ' trained on ' + str(trained.n) +
+                                 ' rows')
+                except Exception as e:
+                    logger.info('GBMForecaster for horizon ' + str(horizon) + ' failed with: ' + str(e))
+
+                if trained is not None:
+                    model = trained
+                    try:
+                        with stage(self, 'model_io'):
+                            db.model_store.store_model(model_name, model)
+                    except Exception as e:
+                        logger.error('Model store failed with ' + str(e))
+                        pass
+
+            if model is not None and finite.any():
+                with stage(self, 'score'):
+                    forecasts[finite, j] = model.predict(df_copy[finite], X[finite])
+
+        with stage(self, 'write_back'):
+            df_copy[self.horizon_predictions] = forecasts
+
     @classmethod
     def build_ui(cls):
         # define arguments that behave as function inputs
@@ -2515,9 +3875,19 @@ class GBMForecaster(BaseEstimatorFunction):
         inputs.append(UIMultiItem(name='targets', datatype=float, required=True, output_item='predictions',
                                   is_output_datatype_derived=True))
         inputs.append(UIMulti(name='lags', datatype=int, description='Comma separated list of lags'))
+        inputs.append(UISingle(name='global_model', datatype=bool, required=False,
+                               description='Train one model for all entities with the entity as categorical feature'))
+        inputs.append(UISingle(name='entity_scaling', datatype=bool, required=False,
+                               description='Standardize features and target per entity for the global model'))
+        inputs.append(UIMulti(name='horizons', datatype=int, required=False,
+                              description='Comma separated list of forecast horizons for the first target'))
+        inputs.append(UISingle(name='persist_state', datatype=bool, required=False,
+                               description='Keep the last rows per entity between runs instead of loading history'))
 
         # define arguments that behave as function outputs
         outputs = []
+        outputs.append(UIFunctionOutMulti(name='horizon_predictions', datatype=float, cardinality_from='horizons',
+                                          is_datatype_derived=False))
         return (inputs, outputs)
 
 #
@@ -2556,6 +3926,8 @@ class KDEAnomalyScore(BaseTransformer):
         name = '.'.join(name)
         return name
 
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -2570,6 +3942,11 @@ class KDEAnomalyScore(BaseTransformer):
         for m in missing_cols:
             df_copy[m] = None
 
+        # load the models of all entities up front
+        with stage(self, 'model_io'):
+            models = ModelBatch(db, compact=True)
+            models.preload([self.get_model_name(suffix=entity) for entity in entities])
+
         # make sure to train a model
         for entity in entities:
             # check data okay
@@ -2583,13 +3960,8 @@ class KDEAnomalyScore(BaseTransformer):
 
             # per entity - copy for later inplace operations
             model_name = self.get_model_name(suffix=entity)
-            kde_model = None
-            try:
-                kde_model = db.model_store.retrieve_model(model_name)
-                logger.info('load model %s' % str(kde_model))
-            except Exception as e:
-                logger.error('Model retrieval failed with ' + str(e))
-                pass
+            kde_model = models.get(model_name)
+            logger.info('load model %s' % str(kde_model))
 
             xy = np.hstack([df_copy.loc[[entity]][self.features].values, df_copy.loc[[entity]][self.targets].values])
 
@@ -2597,21 +3969,23 @@ class KDEAnomalyScore(BaseTransformer):
             if kde_model is None:
 
                 # all variables should be continuous
-                kde_model = KDEMultivariate(xy, var_type= "c" * (len(self.features) + len(self.targets)))
+                with stage(self, 'fit', entity):
+                    kde_model = KDEMultivariate(xy, var_type= "c" * (len(self.features) + len(self.targets)))
                 logger.debug('Created KDE ' + str(kde_model))
-
-                try:
-                    db.model_store.store_model(model_name, kde_model)
-                except Exception as e:
-                    logger.error('Model store failed with ' + str(e))
-                    pass
+                models.put(model_name, kde_model)
 
             self.models[entity] = kde_model
 
-            predictions = kde_model.pdf(xy)
+            with stage(self, 'score', entity):
+                predictions = kde_model.pdf(xy)
             #predictions[predictions < SmallEnergy] = SmallEnergy
             #predictions = self.threshold / predictions
-            df_copy.loc[entity, self.predictions] = predictions
+            with stage(self, 'write_back', entity):
+                df_copy.loc[entity, self.predictions] = predictions
+
+        # write the newly trained models in one go
+        with stage(self, 'model_io'):
+            models.flush()
 
         return df_copy
 
@@ -2649,121 +4023,7 @@ class KDEAnomalyScore(BaseTransformer):
 # Variational Autoencoder
 #   to approximate probability distribution of targets with respect to features
 #######################################################################################
-# from https://www.ritchievink.com/blog/2019/09/16/variational-inference-from-scratch/
-#   usual ELBO with standard prior N(0,1), standard reparametrization
-
-# helper function
-def ll_gaussian(y, mu, log_var):
-    sigma = torch.exp(0.5 * log_var)
-    return -0.5 * torch.log(2 * np.pi * sigma**2) - (1 / (2 * sigma**2))* (y-mu)**2
-
-def l_gaussian(y, mu, log_var):
-    sigma = torch.exp(0.5 * log_var)
-    return 1/torch.sqrt(2 * np.pi * sigma**2) / torch.exp((1 / (2 * sigma**2))* (y-mu)**2)
-
-def kl_div(mu1, mu2, lg_sigma1, lg_sigma2):
-    return 0.5 * (2 * lg_sigma2 - 2 * lg_sigma1 + (lg_sigma1.exp() ** 2 + (mu1 - mu2)**2)/lg_sigma2.exp()**2 - 1)
-
-class VI(nn.Module):
-    def __init__(self, scaler, prior_mu=0.0, prior_sigma=1.0, beta=1.0, adjust_mean=0.0, version=None):
-        self.prior_mu = prior_mu
-        self.prior_sigma = prior_sigma
-        self.beta = beta
-        self.onnx_session = None
-        self.version = version
-        self.build_time = pd.Timestamp.now()
-        self.scaler = scaler
-        self.show_once = True
-        self.adjust_mean = adjust_mean
-        super().__init__()
-
-        self.q_mu = nn.Sequential(
-            nn.Linear(1, 20),
-            nn.ReLU(),
-            nn.Linear(20, 10),
-            nn.ReLU(),
-            nn.Linear(10, 1)
-        )
-
-        self.q_log_var = nn.Sequential(
-            nn.Linear(1, 50),    # more parameters for sigma
-            nn.ReLU(),
-            nn.Linear(50, 35),
-            nn.ReLU(),
-            nn.Linear(35, 10),
-            nn.ReLU(),
-            nn.Linear(10, 1)
-        )
-
-    # draw from N(mu, sigma)
-    def reparameterize(self, mu, log_var):
-        # std can not be negative, thats why we use log variance
-        sigma = torch.exp(0.5 * log_var) + 1e-7
-        eps = torch.randn_like(sigma)
-        return mu + sigma * eps
-
-    # sample from the one-dimensional normal distribution N(mu, exp(log_var))
-    def forward(self, x):
-        mu = self.q_mu(x)
-        log_var = self.q_log_var(x)
-        return self.reparameterize(mu, log_var), mu, log_var
-
-    # see 2.3 in https://arxiv.org/pdf/1312.6114.pdf
-    def elbo(self, y_pred, y, mu, log_var):
-        # likelihood of observing y given Variational mu and sigma - reconstruction error
-        loglikelihood = ll_gaussian(y, mu, log_var)
-
-        # KL - prior probability of y_pred N(0,1)
-        log_prior = ll_gaussian(y_pred, self.prior_mu, torch.log(torch.tensor(self.prior_sigma)))
-
-        # KL - variational probability of y_pred
-        log_p_q = ll_gaussian(y_pred, mu, log_var)
-
-        if self.show_once:
-            logger.info('Cardinalities: Mu: ' + str(mu.shape) + ' Sigma: ' + str(log_var.shape) +
-                        ' loglikelihood: ' + str(loglikelihood.shape) + ' KL value: ' +
-                        str((log_prior - log_p_q).mean()))
-
-        # by taking the mean we approximate the expectation according to the law of large numbers
-        return (loglikelihood + self.beta * (log_prior - log_p_q)).mean()
-
-    # simplified when everything is Gaussian
-    #  KL(q, p) = \log \frac{\sigma_1}{\sigma_2} + \frac{\sigma_2^2 + (\mu_2 - \mu_1)^2}{2 \sigma_1^2} - \frac{1}{2}
-    # unfortunately I don't get it to work properly
-    def elbo_gauss(self, y, y_pred, mu, log_var):
-        # likelihood of observing y given Variational mu and sigma - reconstruction error
-        loglikelihood = ll_gaussian(y, mu, log_var)
-
-        #kl_divergence = kl_div(mu, torch.tensor(self.prior_mu), log_var, torch.log(torch.tensor(self.prior_sigma)))
-        #  see 3 - https://arxiv.org/pdf/1312.6114.pdf
-        kl_divergence = (-0.5 * torch.sum(1 + log_var - mu**2 - log_var.exp()))
-
-        if self.show_once:
-            self.show_once = False
-            logger.info('Cardinalities: Mu: ' + str(mu.shape) + ' Sigma: ' + str(log_var.shape) +
-                        ' loglikelihood: ' + str(loglikelihood.shape) + ' KL: ' + str(kl_divergence.shape) +
-                        ' KL value: ' + str(kl_divergence))
-
-        return loglikelihood.mean() - kl_divergence
-
-
-    # Unfinished - the stuff here is crap !
-    def iwae(self, y_pred, y, mu, log_var):
-        # likelihood of observing y given Variational mu and sigma
-        likelihood = l_gaussian(y, mu, log_var)
-
-        # prior probability of y_pred N(0,1)
-        log_prior = ll_gaussian(y_pred, self.prior_mu, torch.log(torch.tensor(self.prior_sigma)))
-
-        # variational probability of y_pred
-        log_p_q = ll_gaussian(y_pred, mu, log_var)
-
-        # by taking the mean we approximate the expectation according to the law of large numbers
-        return (likelihood + self.beta * (log_prior - log_p_q)).mean()
-
-    # Minimizing negative ELBO
-    def det_loss_old(self, y_pred, y, mu, log_var):
-        return -elbo(y_pred, y, mu, log_var)
+# see mmfunctions.variational
 
 class SupervisedLearningTransformer(BaseTransformer):
 
@@ -2849,6 +4109,8 @@ class VIAnomalyScore(SupervisedLearningTransformer):
     # in super class
     #def get_model_name(self, prefix='model', suffix=None):
 
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -2863,6 +4125,11 @@ class VIAnomalyScore(SupervisedLearningTransformer):
         for m in missing_cols:
             df_copy[m] = None
 
+        # load the models of all entities up front
+        with stage(self, 'model_io'):
+            models = ModelBatch(db, compact=True)
+            models.preload([self.get_model_name(targets=self.targets, suffix=entity) for entity in entities])
+
         # make sure to train a model
         for entity in entities:
             # check data okay
@@ -2876,13 +4143,8 @@ class VIAnomalyScore(SupervisedLearningTransformer):
 
             # per entity - copy for later inplace operations
             model_name = self.get_model_name(targets=self.targets, suffix=entity)
-            vi_model = None
-            try:
-                vi_model = db.model_store.retrieve_model(model_name)
-                logger.info('load model %s' % str(vi_model))
-            except Exception as e:
-                logger.error('Model retrieval failed with ' + str(e))
-                pass
+            vi_model = models.get(model_name)
+            logger.info('load model %s' % str(vi_model))
 
             # ditch old model
             version = 1
@@ -2934,34 +4196,31 @@ class VIAnomalyScore(SupervisedLearningTransformer):
                 #self.prior_sigma = 1.0
                 #self.prior_sigma = 1.0 + (targets.std() - 1.0)/2
 
+                from mmfunctions.variational import VI
                 vi_model = VI(scaler, prior_mu=self.prior_mu, prior_sigma=self.prior_sigma,
                               beta=self.beta, adjust_mean=adjust_mean, version=version)
 
                 logger.debug('Training VI model ' + str(vi_model.version) + ' for entity: ' + str(entity) +
                              'Prior mean: ' + str(self.prior_mu) + ', sigma: ' + str(self.prior_sigma))
 
-                optim = torch.optim.Adam(vi_model.parameters(), lr=self.learning_rate)
-
-                for epoch in range(self.epochs):
-                    optim.zero_grad()
-                    y_pred, mu, log_var = vi_model(X)
-                    #loss = det_loss(y_pred, Y, mu, log_var)
-                    loss = -vi_model.elbo(y_pred, Y, mu, log_var)
-                    lossg = -vi_model.elbo_gauss(y_pred, Y, mu, log_var)
-                    if epoch % 10 == 0:
-                        logger.debug('Epoch: ' + str(epoch) + ', neg ELBO: ' + str(loss.item()) +
-                                     ' neg ELBO G: ' + str(lossg.item()))
-                    loss.backward()
-                    grad_norm = 0
-                    optim.step()
+                with stage(self, 'fit', entity):
+                    optim = torch.optim.Adam(vi_model.parameters(), lr=self.learning_rate)
+
+                    for epoch in range(self.epochs):
+                        optim.zero_grad()
+                        y_pred, mu, log_var = vi_model(X)
+                        #loss = det_loss(y_pred, Y, mu, log_var)
+                        loss = -vi_model.elbo(y_pred, Y, mu, log_var)
+                        lossg = -vi_model.elbo_gauss(y_pred, Y, mu, log_var)
+                        if epoch % 10 == 0:
+                            logger.debug('Epoch: ' + str(epoch) + ', neg ELBO: ' + str(loss.item()) +
+                                         ' neg ELBO G: ' + str(lossg.item()))
+                        loss.backward()
+                        grad_norm = 0
+                        optim.step()
 
                 logger.debug('Created VAE ' + str(vi_model))
-
-                try:
-                    db.model_store.store_model(model_name, vi_model)
-                except Exception as e:
-                    logger.error('Model store failed with ' + str(e))
-                    pass
+                models.put(model_name, vi_model)
 
             # if training was not allowed or failed
             if vi_model is not None:
@@ -2969,20 +4228,26 @@ class VIAnomalyScore(SupervisedLearningTransformer):
 
                 mu = None
                 q1 = None
-                with torch.no_grad():
-                    mu_and_log_sigma = vi_model(X)
-                    mue = mu_and_log_sigma[1]
-                    sigma = torch.exp(0.5 * mu_and_log_sigma[2]) + 1e-5
-                    mu = sp.stats.norm.ppf(0.5, loc=mue, scale=sigma).reshape(-1,)
-                    q1 = sp.stats.norm.ppf(0.95, loc=mue, scale=sigma).reshape(-1,)
-                    self.mu[entity] = mu
-                    self.quantile095[entity] = q1
-
-                df_copy.loc[entity, self.predictions] = mu[ind_r] + vi_model.adjust_mean
-                df_copy.loc[entity, self.pred_stddev] = q1[ind_r]
+                with stage(self, 'score', entity):
+                    with torch.no_grad():
+                        mu_and_log_sigma = vi_model(X)
+                        mue = mu_and_log_sigma[1]
+                        sigma = torch.exp(0.5 * mu_and_log_sigma[2]) + 1e-5
+                        mu = sp.stats.norm.ppf(0.5, loc=mue, scale=sigma).reshape(-1,)
+                        q1 = sp.stats.norm.ppf(0.95, loc=mue, scale=sigma).reshape(-1,)
+                        self.mu[entity] = mu
+                        self.quantile095[entity] = q1
+
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[entity, self.predictions] = mu[ind_r] + vi_model.adjust_mean
+                    df_copy.loc[entity, self.pred_stddev] = q1[ind_r]
             else:
                 logger.debug('No VI model for entity: ' + str(entity))
 
+        # write the newly trained models in one go
+        with stage(self, 'model_io'):
+            models.flush()
+
         return df_copy
 
 
@@ -3002,6 +4267,151 @@ class VIAnomalyScore(SupervisedLearningTransformer):
 # Crude change point detection
 #######################################################################################
 
+class OnlineChangePoint(BaseTransformer):
+    """
+    Streaming change point detection - CUSUM, Page-Hinkley or Bayesian online change point detection per entity.
+    Detector state is kept in the model store with a constant size per entity, so each run only processes
+    new data. Outputs a change flag and the length of the current run, i.e. the points since the last change.
+    """
+
+    def __init__(self, input_item, method=None, threshold=None, hazard=None, change_point='change_point',
+                 run_length='run_length'):
+        super().__init__()
+
+        self.input_item = input_item
+        self.method = 'cusum' if method is None else str(method).lower().replace('-', '').replace(' ', '')
+        self.threshold = threshold
+        self.hazard = hazard
+        self.change_point = change_point
+        self.run_length = run_length
+
+        self.whoami = 'OnlineChangePoint'
+
+    def make_detector(self):
+        if self.method not in detectors:
+            raise ValueError('OnlineChangePoint: unknown method ' + str(self.method))
+        if self.method == 'bayesian':
+            return BayesianOnline() if self.hazard is None else BayesianOnline(hazard=float(self.hazard))
+        detector = detectors[self.method]()
+        if self.threshold is not None:
+            detector.threshold = float(self.threshold)
+        return detector
+
+    @stage_timing
+    @model_cache
+    def execute(self, df):
+        df_copy = df.copy()
+        db = self._entity_type.db
+        detector = self.make_detector()
+
+        key = '_'.join(['ChangePointState', str(self._entity_type.name), self.whoami, self.input_item,
+                        self.change_point])
+        with stage(self, 'model_io'):
+            state = None
+            try:
+                state = db.model_store.retrieve_model(key)
+            except Exception as e:
+                logger.error('Change point state retrieval failed with ' + str(e))
+                pass
+
+        if state is None or not state.matches(detector):
+            state = ChangePointState(detector)
+
+        with stage(self, 'score'):
+            flags, run_lengths = detect_change_points(state, df_copy.index,
+                                                      df_copy[self.input_item].to_numpy(dtype=np.float64))
+        logger.debug(self.whoami + ' found ' + str(flags.sum()) + ' change points')
+
+        with stage(self, 'model_io'):
+            try:
+                db.model_store.store_model(key, state)
+            except Exception as e:
+                logger.error('Change point state store failed with ' + str(e))
+                pass
+
+        with stage(self, 'write_back'):
+            df_copy[self.change_point] = flags.astype(int)
+            df_copy[self.run_length] = run_lengths
+        return df_copy
+
+    @classmethod
+    def build_ui(cls):
+        # define arguments that behave as function inputs
+        inputs = []
+        inputs.append(UISingleItem(name='input_item', datatype=float, description='Data item to analyze'))
+        inputs.append(UISingle(name='method', datatype=str, required=False,
+                               description='Detector: CUSUM (default), Page-Hinkley or Bayesian'))
+        inputs.append(UISingle(name='threshold', datatype=float, required=False,
+                               description='CUSUM and Page-Hinkley - threshold in standard deviations, 8 by default'))
+        inputs.append(UISingle(name='hazard', datatype=float, required=False,
+                               description='Bayesian - expected number of points between changes, 1000 by default'))
+
+        # define arguments that behave as function outputs
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='change_point', datatype=int, description='1 at a change point'))
+        outputs.append(UIFunctionOutSingle(name='run_length', datatype=float,
+                                           description='Points since the last change point'))
+        return (inputs, outputs)
+
+
+class ChangePointSegmentation(BaseTransformer):
+    """
+    Offline change point segmentation of each entity's history with PELT (exact) or binary segmentation (fast).
+    Detects changes in mean or in mean and variance, outputs segment ids counting up per entity and a flag at
+    the first point of each new segment. Meant for backfill and investigation runs over long histories.
+    """
+
+    def __init__(self, input_item, method=None, model=None, penalty=None, min_size=None, segment='segment',
+                 change_point='change_point'):
+        super().__init__()
+
+        self.input_item = input_item
+        self.method = 'pelt' if method is None else str(method).lower()
+        self.model = 'mean' if model is None else str(model).lower()
+        self.penalty = None if penalty is None else float(penalty)
+        self.min_size = 2 if min_size is None else int(min_size)
+        self.segment = segment
+        self.change_point = change_point
+
+        self.whoami = 'ChangePointSegmentation'
+
+    @stage_timing
+    def execute(self, df):
+        df_copy = df.copy()
+
+        with stage(self, 'score'):
+            flags, segment_ids = segment_entities(df_copy.index, df_copy[self.input_item].to_numpy(dtype=np.float64),
+                                                  method=self.method, penalty=self.penalty, model=self.model,
+                                                  min_size=self.min_size)
+        logger.debug(self.whoami + ' found ' + str(flags.sum()) + ' change points')
+
+        with stage(self, 'write_back'):
+            df_copy[self.change_point] = flags.astype(int)
+            df_copy[self.segment] = segment_ids
+        return df_copy
+
+    @classmethod
+    def build_ui(cls):
+        # define arguments that behave as function inputs
+        inputs = []
+        inputs.append(UISingleItem(name='input_item', datatype=float, description='Data item to analyze'))
+        inputs.append(UISingle(name='method', datatype=str, required=False,
+                               description='Segmentation: pelt (default, exact) or binseg (fast)'))
+        inputs.append(UISingle(name='model', datatype=str, required=False,
+                               description='Changes in mean (default) or in meanvar'))
+        inputs.append(UISingle(name='penalty', datatype=float, required=False,
+                               description='Penalty per change point, larger finds fewer - BIC by default'))
+        inputs.append(UISingle(name='min_size', datatype=int, required=False,
+                               description='Minimal segment length, 2 by default'))
+
+        # define arguments that behave as function outputs
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='segment', datatype=int, description='Segment id per entity'))
+        outputs.append(UIFunctionOutSingle(name='change_point', datatype=int,
+                                           description='1 at the first point of a new segment'))
+        return (inputs, outputs)
+
+
 def make_histogram(t, bins):
     rv = ''
     if t is None:
@@ -3021,6 +4431,22 @@ def make_histogram(t, bins):
     return rv
 
 
+def bulk_histograms(grouped, bins, encoding='numeric'):
+    codes = grouped.ngroup().to_numpy()
+    keys = grouped.size().index
+    values = grouped.obj.to_numpy(dtype=np.float64)
+
+    # rows with missing group keys are not part of any group
+    in_group = codes >= 0
+    dtype = np.float32 if encoding == 'numeric' else np.float64
+    density = group_histograms(codes[in_group], len(keys), values[in_group], bins, dtype=dtype)
+
+    if encoding == 'numeric':
+        return pd.DataFrame(density, index=keys)
+
+    return pd.Series(['' if np.isnan(row).any() else str(row) for row in density], index=keys, dtype=object)
+
+
 class HistogramAggregator(BaseSimpleAggregator):
     """
     The docstring of the function will show as the function description in the UI.
@@ -3042,6 +4468,14 @@ class HistogramAggregator(BaseSimpleAggregator):
         #
         return make_histogram(group, self.bins)
 
+    def execute_bulk(self, grouped, encoding='numeric'):
+        """
+        Histograms for all groups of a SeriesGroupBy at once instead of one execute call per group
+          encoding 'numeric' returns a frame of float32 densities with one column per bin,
+          'string' returns the string encoding of execute (empty for groups with NaN)
+        """
+        return bulk_histograms(grouped, self.bins, encoding=encoding)
+
     @classmethod
     def build_ui(cls):
         inputs = []
@@ -3053,3 +4487,226 @@ class HistogramAggregator(BaseSimpleAggregator):
         outputs = []
         outputs.append(UIFunctionOutSingle(name='name', datatype=str, description='Histogram encoded as string'))
         return (inputs, outputs)
+
+
+class HistogramDirectAggregator(BaseAggregator):
+    """
+    Histogram per group like HistogramAggregator, computed for all groups in one pass over the data
+    instead of one call per group.
+      encoding 'string' (default) writes the string encoding of HistogramAggregator, 'numeric' writes the
+      float32 densities to one column per bin named <name>_0 .. <name>_<bins-1>
+    """
+    is_direct_aggregator = True
+
+    def __init__(self, source=None, bins=None, name=None, encoding=None):
+        super().__init__()
+
+        self.input_item = source
+        self.bins = 15 if bins is None else int(bins)
+        self.output_name = name
+        self.encoding = 'string' if encoding is None else str(encoding).lower()
+        if self.encoding not in ['string', 'numeric']:
+            raise ValueError('HistogramDirectAggregator encoding must be string or numeric, not ' + str(encoding))
+
+    def execute(self, df, group_base, group_base_names, start_ts=None, end_ts=None, entities=None, offset=None):
+        logger.debug('HistogramDirectAggregator for ' + str(group_base_names))
+
+        grouped = df.groupby(group_base)[self.input_item]
+        histograms = bulk_histograms(grouped, self.bins, encoding=self.encoding)
+        histograms.index.names = group_base_names
+
+        if self.encoding == 'numeric':
+            histograms.columns = [self.output_name + '_' + str(i) for i in range(self.bins)]
+            return histograms
+
+        return histograms.to_frame(self.output_name)
+
+    @classmethod
+    def build_ui(cls):
+        inputs = []
+        inputs.append(UISingleItem(name='source', datatype=float,
+                                   description='Choose the data items that you would like to aggregate'))
+        inputs.append(UISingle(name='bins', datatype=int, required=False,
+                               description='Histogram bins - 15 by default'))
+        inputs.append(UISingle(name='encoding', datatype=str, required=False,
+                               description='string (default) or numeric - one float column <name>_<bin> per bin'))
+
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='name', datatype=str, description='Histogram encoded as string'))
+        return (inputs, outputs)
+
+
+class HistogramSketchAggregator(BaseSimpleAggregator):
+    """
+    Histogram sketch per group - fixed edge bins between low and high or logarithmic buckets with relative accuracy.
+    Sketches of the same kind and parameters can be rolled up to coarser grains with HistogramSketchMerge.
+    """
+
+    def __init__(self, source=None, kind=None, bins=None, low=None, high=None, relative_accuracy=None):
+
+        self.input_item = source
+        self.kind = 'log' if kind is None else str(kind).lower()
+        self.bins = 15 if bins is None else int(bins)
+        self.low = 0.0 if low is None else float(low)
+        self.high = 1.0 if high is None else float(high)
+        self.relative_accuracy = 0.01 if relative_accuracy is None else float(relative_accuracy)
+
+    def make_sketch(self):
+        return HistogramSketch(kind=self.kind, low=self.low, high=self.high, bins=self.bins,
+                               relative_accuracy=self.relative_accuracy)
+
+    def execute(self, group):
+        return self.make_sketch().update(group.values).encode()
+
+    @classmethod
+    def build_ui(cls):
+        inputs = []
+        inputs.append(UISingleItem(name='source', datatype=float,
+                                   description='Choose the data items that you would like to aggregate'))
+        inputs.append(UISingle(name='kind', datatype=str, required=False,
+                               description='Sketch kind: log (default) or fixed'))
+        inputs.append(UISingle(name='bins', datatype=int, required=False,
+                               description='Fixed sketch - number of bins, 15 by default'))
+        inputs.append(UISingle(name='low', datatype=float, required=False,
+                               description='Fixed sketch - lower edge of the first bin, 0 by default'))
+        inputs.append(UISingle(name='high', datatype=float, required=False,
+                               description='Fixed sketch - upper edge of the last bin, 1 by default'))
+        inputs.append(UISingle(name='relative_accuracy', datatype=float, required=False,
+                               description='Log sketch - relative accuracy of the buckets, 0.01 by default'))
+
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='name', datatype=str, description='Histogram sketch encoded as string'))
+        return (inputs, outputs)
+
+
+class HistogramSketchMerge(BaseSimpleAggregator):
+    """
+    Merge histogram sketches of finer grains, for example hourly into daily sketches, without the raw data
+    """
+
+    def __init__(self, source=None):
+
+        self.input_item = source
+
+    def execute(self, group):
+        merged = None
+        for text in group.dropna():
+            if text == '':
+                continue
+            try:
+                sketch = HistogramSketch.decode(text)
+                merged = sketch if merged is None else merged.merge(sketch)
+            except Exception as e:
+                logger.warning('HistogramSketchMerge skipped sketch, failed with ' + str(e))
+        return '' if merged is None else merged.encode()
+
+    @classmethod
+    def build_ui(cls):
+        inputs = []
+        inputs.append(UISingleItem(name='source', datatype=str,
+                                   description='Choose the histogram sketches that you would like to merge'))
+
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='name', datatype=str, description='Merged histogram sketch'))
+        return (inputs, outputs)
+
+
+def merge_quantile_sketches(group, k):
+    """
+    Quantile sketch of a group of raw values or of a group of encoded sketches
+    """
+    sketch = KLLSketch(k=k, seed=0)
+    if group.dtype != object:
+        return sketch.update(group.values)
+
+    for text in group.dropna():
+        if text == '':
+            continue
+        try:
+            sketch.merge(KLLSketch.decode(text, seed=0))
+        except Exception as e:
+            logger.warning('Quantile sketch skipped, failed with ' + str(e))
+    return sketch
+
+
+class QuantileAggregator(BaseSimpleAggregator):
+    """
+    Approximate quantile per group from a KLL sketch built in a single pass with memory bounded by k.
+    Source can be raw values or quantile sketches of finer grains from QuantileSketchAggregator.
+    """
+
+    def __init__(self, source=None, quantile=None, k=None):
+
+        self.input_item = source
+        self.quantile = 0.5 if quantile is None else float(quantile)
+        self.k = 200 if k is None else int(k)
+
+    def execute(self, group):
+        return float(merge_quantile_sketches(group, self.k).quantile(self.quantile))
+
+    @classmethod
+    def build_ui(cls):
+        inputs = []
+        inputs.append(UISingleItem(name='source', datatype=None,
+                                   description='Choose the data items or quantile sketches to aggregate'))
+        inputs.append(UISingle(name='quantile', datatype=float, required=False,
+                               description='Quantile between 0 and 1, 0.5 (median) by default'))
+        inputs.append(UISingle(name='k', datatype=int, required=False,
+                               description='Sketch size - larger is more accurate, 200 by default'))
+
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='name', datatype=float, description='Approximate quantile'))
+        return (inputs, outputs)
+
+
+class QuantileSketchAggregator(BaseSimpleAggregator):
+    """
+    KLL quantile sketch per group to store and roll up to coarser grains with QuantileSketchMerge or
+    to evaluate with QuantileAggregator. Sketch size is bounded by k regardless of the number of events.
+    """
+
+    def __init__(self, source=None, k=None):
+
+        self.input_item = source
+        self.k = 200 if k is None else int(k)
+
+    def execute(self, group):
+        return merge_quantile_sketches(group, self.k).encode()
+
+    @classmethod
+    def build_ui(cls):
+        inputs = []
+        inputs.append(UISingleItem(name='source', datatype=float,
+                                   description='Choose the data items that you would like to aggregate'))
+        inputs.append(UISingle(name='k', datatype=int, required=False,
+                               description='Sketch size - larger is more accurate, 200 by default'))
+
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='name', datatype=str, description='Quantile sketch encoded as string'))
+        return (inputs, outputs)
+
+
+class QuantileSketchMerge(BaseSimpleAggregator):
+    """
+    Merge quantile sketches of finer grains, for example hourly into daily sketches, without the raw data
+    """
+
+    def __init__(self, source=None, k=None):
+
+        self.input_item = source
+        self.k = 200 if k is None else int(k)
+
+    def execute(self, group):
+        return merge_quantile_sketches(group, self.k).encode()
+
+    @classmethod
+    def build_ui(cls):
+        inputs = []
+        inputs.append(UISingleItem(name='source', datatype=str,
+                                   description='Choose the quantile sketches that you would like to merge'))
+        inputs.append(UISingle(name='k', datatype=int, required=False,
+                               description='Sketch size - larger is more accurate, 200 by default'))
+
+        outputs = []
+        outputs.append(UIFunctionOutSingle(name='name', datatype=str, description='Merged quantile sketch'))
+        return (inputs, outputs)
@@ -0,0 +1,415 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Online change point detection with constant state per entity
+
+Detectors keep a fixed number of values per entity (a fixed size array for the Bayesian detector) in a
+ChangePointState, so a batch is processed point by point over time while all entities are updated at once.
+Values are standardized with mean and standard deviation of the first min_samples points of an entity,
+or of the current segment, so thresholds are in units of standard deviations for all entities.
+"""
+
+import logging
+
+import numpy as np
+from scipy.special import gammaln
+
+from mmfunctions.features import EntityGroups
+
+logger = logging.getLogger(__name__)
+
+
+def segment_statistics(s, x, change):
+    """
+    Count, mean and sum of squared deviations of the current segment with x, a change starts a new segment
+    """
+    n = np.where(change, 0, s['n']) + 1
+    delta = x - np.where(change, x, s['mean'])
+    mean = np.where(change, x, s['mean'] + delta / n)
+    m2 = np.where(change, 0, s['m2'] + delta * (x - mean))
+    return n, mean, m2
+
+
+def segment_std(n, m2):
+    return np.sqrt(np.divide(m2, n - 1, out=np.zeros_like(m2), where=n > 1))
+
+
+class CUSUM(object):
+    """
+    Two sided cumulative sum control chart on the standardized deviation from the current segment's mean
+      a change is flagged when either sum exceeds threshold, drift is subtracted from each step
+    """
+
+    def __init__(self, threshold=8.0, drift=0.5, min_samples=30):
+        self.threshold = threshold
+        self.drift = drift
+        self.min_samples = min_samples
+
+    def initial_state(self):
+        return {'n': 0.0, 'mean': 0.0, 'm2': 0.0, 'up': 0.0, 'down': 0.0, 'run': 0.0}
+
+    def step(self, s, x):
+        ready = s['n'] >= self.min_samples
+        std = segment_std(s['n'], s['m2'])
+        z = np.divide(x - s['mean'], std, out=np.zeros_like(x), where=std > 0)
+
+        up = np.where(ready, np.maximum(0, s['up'] + z - self.drift), 0)
+        down = np.where(ready, np.maximum(0, s['down'] - z - self.drift), 0)
+        change = ready & ((up > self.threshold) | (down > self.threshold))
+
+        # segment statistics start over with the point that triggered the change
+        n, mean, m2 = segment_statistics(s, x, change)
+        new = {'n': n, 'mean': mean, 'm2': m2, 'up': np.where(change, 0, up), 'down': np.where(change, 0, down),
+               'run': np.where(change, 0, s['run'] + 1)}
+        return new, change, new['run']
+
+
+class PageHinkley(object):
+    """
+    Two sided Page-Hinkley test on the standardized deviation from the running mean of the current segment
+      cumulative deviations fade with the forgetting factor alpha, a change is flagged when they depart
+      more than threshold from their extreme so far
+    """
+
+    def __init__(self, threshold=8.0, drift=0.5, alpha=0.9999, min_samples=30):
+        self.threshold = threshold
+        self.drift = drift
+        self.alpha = alpha
+        self.min_samples = min_samples
+
+    def initial_state(self):
+        return {'n': 0.0, 'mean': 0.0, 'm2': 0.0, 'up': 0.0, 'up_min': 0.0, 'down': 0.0, 'down_max': 0.0,
+                'run': 0.0}
+
+    def step(self, s, x):
+        ready = s['n'] >= self.min_samples
+        n, mean, m2 = segment_statistics(s, x, np.zeros(x.shape, dtype=bool))
+        std = segment_std(n, m2)
+        z = np.divide(x - mean, std, out=np.zeros_like(x), where=std > 0)
+
+        up = np.where(ready, self.alpha * s['up'] + z - self.drift, 0)
+        down = np.where(ready, self.alpha * s['down'] + z + self.drift, 0)
+        up_min = np.minimum(s['up_min'], up)
+        down_max = np.maximum(s['down_max'], down)
+        change = ready & ((up - up_min > self.threshold) | (down_max - down > self.threshold))
+
+        n, mean, m2 = segment_statistics(s, x, change)
+        new = {'n': n, 'mean': mean, 'm2': m2, 'up': np.where(change, 0, up), 'up_min': np.where(change, 0, up_min),
+               'down': np.where(change, 0, down), 'down_max': np.where(change, 0, down_max),
+               'run': np.where(change, 0, s['run'] + 1)}
+        return new, change, new['run']
+
+
+class BayesianOnline(object):
+    """
+    Bayesian online change point detection (Adams, MacKay - https://arxiv.org/abs/0710.3742) with a normal
+    gamma model of segments and a constant hazard, run lengths are truncated at max_run_length so the
+    state per entity has a fixed size. Values are standardized with the first min_samples values of an entity.
+      Run length is the most probable run length, a change is flagged when it drops.
+    """
+
+    def __init__(self, hazard=1000, max_run_length=100, min_samples=30):
+        self.hazard = hazard
+        self.max_run_length = max_run_length
+        self.min_samples = min_samples
+
+    def initial_state(self):
+        # mean and m2 of the first values standardize the entity, one probability and posterior per run length
+        R = self.max_run_length
+        prob = np.zeros(R)
+        prob[0] = 1
+        return {'n': 0.0, 'mean': 0.0, 'm2': 0.0, 'run': 0.0, 'prob': prob, 'mu': np.zeros(R),
+                'kappa': np.ones(R), 'alpha': np.ones(R), 'beta': np.ones(R)}
+
+    def step(self, s, x):
+        ready = s['n'] >= self.min_samples
+
+        # standardization statistics stop changing once the entity is warmed up
+        n = np.where(ready, s['n'], s['n'] + 1)
+        delta = x - s['mean']
+        mean = np.where(ready, s['mean'], s['mean'] + delta / n)
+        m2 = np.where(ready, s['m2'], s['m2'] + delta * (x - mean))
+        std = np.sqrt(np.divide(m2, n - 1, out=np.ones_like(x), where=n > 1))
+        z = np.divide(x - mean, std, out=np.zeros_like(x), where=std > 0)[:, None]
+
+        # student t predictive of each run length
+        mu, kappa, alpha, beta = s['mu'], s['kappa'], s['alpha'], s['beta']
+        scale2 = beta * (kappa + 1) / (alpha * kappa)
+        log_pred = (gammaln(alpha + 0.5) - gammaln(alpha) - 0.5 * np.log(2 * np.pi * alpha * scale2) -
+                    (alpha + 0.5) * np.log1p((z - mu) ** 2 / (2 * alpha * scale2)))
+
+        log_joint = np.log(np.maximum(s['prob'], 1e-300)) + log_pred
+        joint = np.exp(log_joint - log_joint.max(axis=1, keepdims=True))
+        H = 1.0 / self.hazard
+        prob = np.empty_like(joint)
+        prob[:, 0] = joint.sum(axis=1) * H
+        prob[:, 1:] = joint[:, :-1] * (1 - H)
+        # the longest run length absorbs the runs growing beyond it
+        prob[:, -1] += joint[:, -1] * (1 - H)
+        prob /= prob.sum(axis=1, keepdims=True)
+
+        # posterior update, run length 0 starts from the prior
+        new_mu = np.concatenate([np.zeros((z.shape[0], 1)), ((kappa * mu + z) / (kappa + 1))[:, :-1]], axis=1)
+        new_beta = np.concatenate([np.ones((z.shape[0], 1)),
+                                   (beta + kappa * (z - mu) ** 2 / (2 * (kappa + 1)))[:, :-1]], axis=1)
+        new_kappa = np.concatenate([np.ones((z.shape[0], 1)), (kappa + 1)[:, :-1]], axis=1)
+        new_alpha = np.concatenate([np.ones((z.shape[0], 1)), (alpha + 0.5)[:, :-1]], axis=1)
+
+        run = prob.argmax(axis=1).astype(np.float64)
+        # the first step after warm up starts the run lengths, it is no change
+        change = ready & (s['prob'][:, 0] < 1) & (run < s['run'])
+
+        # nothing to detect before warm up
+        ready2 = ready[:, None]
+        new = {'n': n, 'mean': mean, 'm2': m2, 'run': np.where(ready, run, s['run'] + 1),
+               'prob': np.where(ready2, prob, s['prob']), 'mu': np.where(ready2, new_mu, mu),
+               'kappa': np.where(ready2, new_kappa, kappa), 'alpha': np.where(ready2, new_alpha, alpha),
+               'beta': np.where(ready2, new_beta, beta)}
+        return new, change, new['run']
+
+
+detectors = {'cusum': CUSUM, 'pagehinkley': PageHinkley, 'bayesian': BayesianOnline}
+
+
+class ChangePointState(object):
+    """
+    Detector state of all entities - one row per entity in arrays of the detector's state values,
+    along with the last timestamp processed per entity
+    """
+
+    def __init__(self, detector):
+        self.detector = detector
+        self.entities = {}
+        self.arrays = {name: np.zeros((0,) + np.shape(value)) for name, value in detector.initial_state().items()}
+        self.last_timestamp = np.zeros(0, dtype=np.int64)
+
+    def matches(self, detector):
+        return type(self.detector) is type(detector) and vars(self.detector) == vars(detector)
+
+    def rows(self, entities):
+        """
+        State rows of entities, new entities get an initial state
+        """
+        new = [entity for entity in entities if entity not in self.entities]
+        if len(new) > 0:
+            for entity in new:
+                self.entities[entity] = len(self.entities)
+            for name, value in self.detector.initial_state().items():
+                initial = np.broadcast_to(value, (len(new),) + np.shape(value))
+                self.arrays[name] = np.concatenate([self.arrays[name], initial])
+            self.last_timestamp = np.concatenate([self.last_timestamp,
+                                                  np.full(len(new), np.iinfo(np.int64).min, dtype=np.int64)])
+        return np.array([self.entities[entity] for entity in entities], dtype=np.intp)
+
+
+def detect_change_points(state, index, values):
+    """
+    Run the detector over a batch of a multi entity frame in time order per entity, skipping rows not
+    newer than the last timestamp processed for their entity
+    Returns change flags and run lengths in frame order, NaN run lengths for skipped rows
+    """
+    groups = EntityGroups(index)
+    values = np.asarray(values, dtype=np.float64)
+    timestamps = np.asarray(index.get_level_values(1).asi8, dtype=np.int64)
+
+    flags = np.zeros(values.size, dtype=bool)
+    run_lengths = np.full(values.size, np.nan)
+    if values.size == 0:
+        return flags, run_lengths
+
+    rows = state.rows(list(groups.entities))
+    fresh = timestamps > state.last_timestamp[rows][groups.codes]
+
+    # fresh rows ordered by time step, within a step by entity with most rows first so active entities are a
+    #   prefix of the state rows - a step is a contiguous block of rows, no entities x steps matrix is needed
+    sorted_rows = groups.order[fresh[groups.order]]
+    codes = groups.codes[sorted_rows]
+    counts = np.bincount(codes, minlength=len(groups.entities))
+    position = np.arange(sorted_rows.size) - np.concatenate([[0], np.cumsum(counts)[:-1]])[codes]
+
+    by_count = np.argsort(-counts, kind='stable')
+    slot = np.empty_like(by_count)
+    slot[by_count] = np.arange(by_count.size)
+    widths = np.bincount(position)
+    ends = np.cumsum(widths)
+    step_rows = np.empty_like(sorted_rows)
+    step_rows[ends[position] - widths[position] + slot[codes]] = sorted_rows
+
+    s = {name: array[rows[by_count]].copy() for name, array in state.arrays.items()}
+
+    for t, m in enumerate(widths):
+        block = step_rows[ends[t] - m:ends[t]]
+        x = values[block]
+        valid = ~np.isnan(x)
+        current = {name: array[:m] for name, array in s.items()}
+
+        new, change, run = state.detector.step(current, np.where(valid, x, 0))
+
+        # missing values leave the state alone
+        for name, array in current.items():
+            mask = valid.reshape((-1,) + (1,) * (array.ndim - 1))
+            array[...] = np.where(mask, new[name], array)
+        flags[block] = valid & change
+        run_lengths[block] = current['run']
+
+    for name, array in s.items():
+        state.arrays[name][rows[by_count]] = array
+
+    last = np.full(len(groups.entities), np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(last, groups.codes[fresh], timestamps[fresh])
+    state.last_timestamp[rows] = np.maximum(state.last_timestamp[rows], last)
+
+    return flags, run_lengths
+
+
+#
+# Offline segmentation
+#   segment costs come from cumulative sums so the cost of any candidate segment is O(1),
+#   PELT (Killick, Fearnhead, Eckley - https://arxiv.org/abs/1101.1438) finds the exact optimal segmentation
+#   and prunes candidates that cannot become optimal, binary segmentation splits recursively at the best point
+#
+class SegmentCost(object):
+    """
+    Gaussian segment costs over cumulative sums of a series
+      mean: sum of squared deviations from the segment mean - changes in mean with constant variance
+      meanvar: n log of the segment variance - changes in mean and variance
+    """
+
+    def __init__(self, values, model='mean'):
+        if model not in ['mean', 'meanvar']:
+            raise ValueError('SegmentCost: unknown model ' + str(model))
+        self.model = model
+        values = np.asarray(values, dtype=np.float64)
+        self.n = values.size
+        self.C1 = np.concatenate([[0], np.cumsum(values)])
+        self.C2 = np.concatenate([[0], np.cumsum(values ** 2)])
+
+    def __call__(self, start, stop):
+        """
+        Cost of the segments [start, stop), start or stop can be arrays
+        """
+        n = stop - start
+        S1 = self.C1[stop] - self.C1[start]
+        S2 = self.C2[stop] - self.C2[start]
+        if self.model == 'mean':
+            return S2 - S1 ** 2 / n
+        return n * np.log(np.maximum(S2 / n - (S1 / n) ** 2, 1e-12))
+
+
+def noise_scale(values):
+    """
+    Robust standard deviation of the noise from the median absolute first difference, not affected by level shifts
+    """
+    diffs = np.abs(np.diff(values))
+    scale = np.median(diffs) / 0.6745 / np.sqrt(2) if diffs.size > 0 else 0
+    if scale > 0:
+        return scale
+    return np.std(values) if np.std(values) > 0 else 1.0
+
+
+def default_penalty(n, model='mean'):
+    # BIC like penalty on standardized values, one more parameter per segment for mean and variance
+    return (2 if model == 'mean' else 3) * np.log(max(n, 2))
+
+
+def pelt(values, penalty=None, model='mean', min_size=2):
+    """
+    Exact optimal change points of a series with PELT, values are standardized with their noise scale
+    Returns the sorted indices where new segments start
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = values.size
+    if n < 2 * min_size:
+        return np.zeros(0, dtype=np.int64)
+    penalty = default_penalty(n, model) if penalty is None else penalty
+    cost = SegmentCost((values - values.mean()) / noise_scale(values), model)
+
+    F = np.empty(n + 1)
+    F[0] = -penalty
+    last = np.zeros(n + 1, dtype=np.int64)
+    candidates = np.zeros(1, dtype=np.int64)
+
+    for t in range(min_size, n + 1):
+        totals = F[candidates] + cost(candidates, t)
+        best = totals.argmin()
+        F[t] = totals[best] + penalty
+        last[t] = candidates[best]
+
+        # candidates that cannot start the last segment of an optimal segmentation anymore are pruned
+        candidates = candidates[totals <= F[t]]
+        if t - min_size + 1 >= min_size:
+            candidates = np.append(candidates, t - min_size + 1)
+
+    change_points = []
+    t = last[n]
+    while t > 0:
+        change_points.append(t)
+        t = last[t]
+    return np.array(change_points[::-1], dtype=np.int64)
+
+
+def binary_segmentation(values, penalty=None, model='mean', min_size=2, max_changes=None):
+    """
+    Change points of a series by recursive splits at the point of largest cost reduction while it exceeds
+    the penalty, values are standardized with their noise scale
+    Returns the sorted indices where new segments start
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = values.size
+    if n < 2 * min_size:
+        return np.zeros(0, dtype=np.int64)
+    penalty = default_penalty(n, model) if penalty is None else penalty
+    cost = SegmentCost((values - values.mean()) / noise_scale(values), model)
+
+    change_points = []
+    segments = [(0, n)]
+    while len(segments) > 0 and (max_changes is None or len(change_points) < max_changes):
+        start, stop = segments.pop()
+        if stop - start < 2 * min_size:
+            continue
+        splits = np.arange(start + min_size, stop - min_size + 1)
+        gains = cost(start, stop) - cost(start, splits) - cost(splits, stop)
+        best = gains.argmax()
+        if gains[best] <= penalty:
+            continue
+        change_points.append(splits[best])
+        segments.extend([(start, splits[best]), (splits[best], stop)])
+    return np.array(sorted(change_points), dtype=np.int64)
+
+
+segmentations = {'pelt': pelt, 'binseg': binary_segmentation}
+
+
+def segment_entities(index, values, method='pelt', penalty=None, model='mean', min_size=2):
+    """
+    Segment the series of each entity of a multi entity frame, NaNs are left out
+    Returns change flags, 1 at the first row of a new segment, and segment ids counting up per entity in frame order
+    """
+    groups = EntityGroups(index)
+    values = np.asarray(values, dtype=np.float64)
+    segment = segmentations[method]
+
+    flags = np.zeros(values.size, dtype=bool)
+    sorted_values = values[groups.order]
+    for start, size in zip(groups.starts, groups.sizes):
+        rows = groups.order[start:start + size]
+        valid = np.flatnonzero(~np.isnan(sorted_values[start:start + size]))
+        if valid.size == 0:
+            continue
+        change_points = segment(sorted_values[start:start + size][valid], penalty=penalty, model=model,
+                                min_size=min_size)
+        flags[rows[valid[change_points]]] = True
+
+    # segment ids count the change points so far within each entity
+    counts = np.cumsum(flags[groups.order])
+    segment_ids = np.empty(values.size, dtype=np.int64)
+    segment_ids[groups.order] = counts - np.concatenate([[0], counts])[groups.starts][groups.codes[groups.order]]
+    return flags, segment_ids
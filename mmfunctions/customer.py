@@ -23,7 +23,6 @@ import math
 # import re
 import pandas as pd
 import logging
-import wiotp.sdk
 
 # import warnings
 # import json
@@ -31,6 +30,12 @@ import wiotp.sdk
 from iotfunctions.base import (BaseTransformer)
 from iotfunctions.ui import (UIMultiItem, UISingle)
 
+from mmfunctions.lazy import lazy_import
+
+# Watson IoT Platform SDK, imported when a function first connects
+wiotp_device = lazy_import('wiotp.sdk.device')
+wiotp_application = lazy_import('wiotp.sdk.application')
+
 logger = logging.getLogger(__name__)
 PACKAGE_URL = 'git+https://github.com/sedgewickmm18/mmfunctions.git'
 _IS_PREINSTALLED = False
@@ -125,9 +130,9 @@ class UnrollData(BaseTransformer):
         if not USING_DB:
             client = None
             if i_am_device:
-                client = wiotp.sdk.device.DeviceClient(config=auth_token, logHandlers=None)
+                client = wiotp_device.DeviceClient(config=auth_token, logHandlers=None)
             else:
-                client = wiotp.sdk.application.ApplicationClient(config=auth_token, logHandlers=None)
+                client = wiotp_application.ApplicationClient(config=auth_token, logHandlers=None)
 
             client.on_connect = on_connect  # On Connect Callback.
             client.on_publish = on_publish  # On Publish Callback.
@@ -0,0 +1,440 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Feature engineering kernels shared by the regressors and forecasters
+"""
+
+import hashlib
+import itertools as it
+import logging
+
+import numpy as np
+import pandas as pd
+import scipy as sp
+import scipy.ndimage
+import scipy.sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+
+logger = logging.getLogger(__name__)
+
+
+class PolynomialExpansion(BaseEstimator, TransformerMixin):
+    """
+    Polynomial feature expansion as sklearn's PolynomialFeatures, with precomputed index arrays
+      Monomials of degree k sharing the leading feature f are x_f times a contiguous block of the
+      monomials of degree k-1, so the whole expansion is one broadcast multiplication per block
+      written in place into a column major output.
+      With sparse=True the expansion is a CSR matrix built from the nonzeros of the parent monomial and the
+      leading feature only, for mostly zero features it never holds the dense expansion. X may be sparse then.
+      The expansion of the last batch is kept, fit and predict on the same batch expand only once. It is
+      returned read-only as it is shared between calls, copy it before modifying it in place.
+    """
+
+    def __init__(self, degree=2, interaction_only=False, include_bias=True, dtype=np.float64, sparse=False):
+        self.degree = degree
+        self.interaction_only = interaction_only
+        self.include_bias = include_bias
+        self.dtype = dtype
+        self.sparse = sparse
+
+    def fit(self, X, y=None):
+        n_features = X.shape[1] if sp.sparse.issparse(X) else np.asarray(X).shape[1]
+        self.n_features_in_ = n_features
+
+        combinations = it.combinations if self.interaction_only else it.combinations_with_replacement
+
+        # output column of each monomial, the bias goes first
+        offset = 1 if self.include_bias else 0
+        columns = {}
+        powers = []
+
+        # one row per block: first column, last column + 1, leading feature, first column of the parent block
+        blocks = []
+        for degree in range(1, self.degree + 1):
+            for monomial in combinations(range(n_features), degree):
+                column = offset + len(powers)
+                columns[monomial] = column
+                powers.append(np.bincount(monomial, minlength=n_features))
+                if degree == 1:
+                    continue
+                if len(blocks) > 0 and blocks[-1][2] == monomial[0] and blocks[-1][1] == column:
+                    blocks[-1][1] = column + 1
+                else:
+                    blocks.append([column, column + 1, monomial[0], columns[monomial[1:]]])
+
+        self.blocks_ = np.array(blocks, dtype=np.intp).reshape(-1, 4)
+
+        powers = np.array(powers, dtype=np.intp).reshape(-1, n_features)
+        if self.include_bias:
+            powers = np.vstack([np.zeros((1, n_features), dtype=np.intp), powers])
+        self.powers_ = powers
+        self.n_output_features_ = powers.shape[0]
+
+        self._cache_key = None
+        self._cache = None
+        return self
+
+    def expand(self, X):
+        X = np.asfortranarray(X, dtype=self.dtype)
+        out = np.empty((X.shape[0], self.n_output_features_), dtype=self.dtype, order='F')
+
+        offset = 0
+        if self.include_bias:
+            out[:, 0] = 1
+            offset = 1
+        out[:, offset:offset + self.n_features_in_] = X
+
+        for start, stop, feature, parent in self.blocks_:
+            np.multiply(out[:, parent:parent + stop - start], X[:, feature:feature + 1], out=out[:, start:stop])
+        return out
+
+    def expand_sparse(self, X):
+        X = sp.sparse.csc_matrix(X, dtype=self.dtype)
+        X.sum_duplicates()
+        n_rows = X.shape[0]
+
+        # rows and values of the nonzeros per output column
+        rows = []
+        values = []
+        if self.include_bias:
+            rows.append(np.arange(n_rows))
+            values.append(np.ones(n_rows, dtype=self.dtype))
+        for feature in range(self.n_features_in_):
+            column = slice(X.indptr[feature], X.indptr[feature + 1])
+            rows.append(X.indices[column])
+            values.append(X.data[column])
+
+        # dense lookup of the leading feature, the product keeps the rows where the parent is nonzero
+        dense = np.zeros(n_rows, dtype=self.dtype)
+        for start, stop, feature, parent in self.blocks_:
+            column = slice(X.indptr[feature], X.indptr[feature + 1])
+            dense[X.indices[column]] = X.data[column]
+            for j in range(stop - start):
+                factor = dense[rows[parent + j]]
+                nonzero = factor != 0
+                rows.append(rows[parent + j][nonzero])
+                values.append(values[parent + j][nonzero] * factor[nonzero])
+            dense[X.indices[column]] = 0
+
+        indptr = np.concatenate([[0], np.cumsum([r.size for r in rows])])
+        out = sp.sparse.csc_matrix((np.concatenate(values).astype(self.dtype, copy=False), np.concatenate(rows),
+                                    indptr), shape=(n_rows, self.n_output_features_))
+        return out.tocsr()
+
+    def transform(self, X):
+        if sp.sparse.issparse(X):
+            X = sp.sparse.csr_matrix(X, dtype=self.dtype)
+            key = (X.shape,) + tuple(hashlib.blake2b(np.ascontiguousarray(part), digest_size=16).digest()
+                                     for part in [X.data, X.indices, X.indptr])
+        else:
+            X = np.ascontiguousarray(X, dtype=self.dtype)
+            key = (X.shape, hashlib.blake2b(memoryview(X).cast('B'), digest_size=16).digest())
+
+        if key != getattr(self, '_cache_key', None):
+            if self.sparse:
+                out = self.expand_sparse(X)
+                for part in [out.data, out.indices, out.indptr]:
+                    part.flags.writeable = False
+            else:
+                out = self.expand(X.toarray() if sp.sparse.issparse(X) else X)
+                out.flags.writeable = False
+            self._cache_key = key
+            self._cache = out
+        else:
+            logger.debug('PolynomialExpansion: reuse expansion of ' + str(X.shape))
+
+        return self._cache
+
+    def fit_transform(self, X, y=None, **fit_params):
+        return self.fit(X, y).transform(X)
+
+    def get_feature_names(self, input_features=None):
+        if input_features is None:
+            input_features = ['x%d' % i for i in range(self.n_features_in_)]
+        names = []
+        for row in self.powers_:
+            terms = [name if power == 1 else '%s^%d' % (name, power)
+                     for name, power in zip(input_features, row) if power > 0]
+            names.append(' '.join(terms) if len(terms) > 0 else '1')
+        return names
+
+    def __getstate__(self):
+        # never persist the cached expansion along with the model
+        state = self.__dict__.copy()
+        state['_cache_key'] = None
+        state['_cache'] = None
+        return state
+
+
+class EntityGroups(object):
+    """
+    Rows of a multi entity frame grouped by entity, computed once and shared by the feature kernels
+      Rows are kept in frame order within an entity, sorted rows are addressed through order.
+    """
+
+    def __init__(self, index):
+        self.codes, self.entities = pd.factorize(index.get_level_values(0), sort=True)
+        self.order = np.argsort(self.codes, kind='stable')
+        self.sizes = np.bincount(self.codes, minlength=len(self.entities))
+        self.starts = np.concatenate([[0], np.cumsum(self.sizes)[:-1]]).astype(np.intp)
+
+        # position of each sorted row within its entity and the size of its entity
+        sorted_codes = self.codes[self.order]
+        self.position = np.arange(self.codes.size) - self.starts[sorted_codes]
+        self.size = self.sizes[sorted_codes]
+
+    def __len__(self):
+        return self.codes.size
+
+    def min_delta(self, timestamps):
+        """
+        Smallest positive time step within entities of an int64 nanosecond timestamp array
+        """
+        deltas = np.diff(np.asarray(timestamps, dtype=np.int64)[self.order])
+        deltas = deltas[(self.position[1:] > 0) & (deltas > 0)]
+        if deltas.size == 0:
+            return pd.Timedelta('5 seconds')
+        return pd.Timedelta(int(deltas.min()), unit='ns')
+
+
+def lag_matrix(groups, values, lags, dtype=np.float32):
+    """
+    Lagged copies of all columns of values for all lags in one preallocated matrix
+      a positive lag takes the value lag rows earlier within the same entity, a negative one looks ahead,
+      rows without a value in their entity are NaN. Columns are ordered feature by feature, lag by lag.
+    """
+    values = np.asarray(values, dtype=dtype)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    n_rows, n_features = values.shape
+
+    out = np.full((n_rows, n_features * len(lags)), np.nan, dtype=dtype)
+    source = np.arange(n_rows)
+    for j, lag in enumerate(lags):
+        valid = (groups.position >= lag) & (groups.position - lag < groups.size)
+        rows = groups.order[valid]
+        source_rows = groups.order[source[valid] - lag]
+        out[rows, j::len(lags)] = values[source_rows]
+    return out
+
+
+rolling_methods = ['mean', 'stddev', 'min', 'max']
+
+
+def rolling_windows(groups, values, windows, methods, dtype=np.float64):
+    """
+    Trailing rolling statistics for all windows and methods over all entities at once
+      mean and stddev come from cumulative sums reset at entity boundaries (values centered per entity first
+      to keep the sums well conditioned), min and max from a running filter over entity blocks separated
+      by padding. Windows are partial at the start of an entity and skip NaNs like pandas' rolling with
+      min_periods=0. Columns are ordered feature by feature, method by method, window by window.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    n_rows, n_features = values.shape
+
+    V = values[groups.order]
+    finite = np.isfinite(V)
+    sorted_codes = groups.codes[groups.order]
+    rows = np.arange(n_rows)
+    row_start = rows - groups.position
+
+    stats = {}
+    if 'mean' in methods or 'stddev' in methods:
+        counts = np.add.reduceat(finite, groups.starts, axis=0) if n_rows > 0 else np.zeros((0, n_features))
+        sums = np.add.reduceat(np.where(finite, V, 0), groups.starts, axis=0) if n_rows > 0 else counts
+        center = np.divide(sums, counts, out=np.zeros(sums.shape), where=counts > 0)[sorted_codes]
+
+        centered = np.where(finite, V - center, 0)
+        N = np.vstack([np.zeros((1, n_features)), np.cumsum(finite, axis=0)])
+        C1 = np.vstack([np.zeros((1, n_features)), np.cumsum(centered, axis=0)])
+        C2 = np.vstack([np.zeros((1, n_features)), np.cumsum(centered ** 2, axis=0)])
+
+        for window in windows:
+            lo = np.maximum(row_start, rows - window + 1)
+            k = N[rows + 1] - N[lo]
+            s1 = C1[rows + 1] - C1[lo]
+            s2 = C2[rows + 1] - C2[lo]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats[('mean', window)] = np.where(k > 0, s1 / k + center, np.nan)
+                var = np.where(k > 1, (s2 - s1 ** 2 / k) / (k - 1), np.nan)
+            stats[('stddev', window)] = np.sqrt(np.maximum(var, 0))
+
+    for method, fill, running_filter in [('min', np.inf, sp.ndimage.minimum_filter1d),
+                                         ('max', -np.inf, sp.ndimage.maximum_filter1d)]:
+        if method not in methods:
+            continue
+        for window in windows:
+            # every entity block starts after window - 1 padding rows so no window reaches into another entity
+            padded_rows = rows + (sorted_codes + 1) * (window - 1)
+            padded = np.full((n_rows + len(groups.entities) * (window - 1), n_features), fill)
+            padded[padded_rows] = np.where(finite, V, fill)
+            result = running_filter(padded, window, axis=0, mode='constant', cval=fill, origin=(window - 1) // 2)
+            result = result[padded_rows]
+            stats[(method, window)] = np.where(np.isfinite(result), result, np.nan)
+
+    out = np.full((n_rows, n_features * len(methods) * len(windows)), np.nan, dtype=dtype)
+    column = 0
+    for feature in range(n_features):
+        for method in methods:
+            for window in windows:
+                out[groups.order, column] = stats[(method, window)][:, feature]
+                column += 1
+    return out
+
+
+def feature_family(groups, values, windows, methods, dtype=np.float64):
+    """
+    Features known before each row: rolling statistics of the previous rows and the previous value (plain)
+      Columns are ordered feature by feature and method by method, rolling methods contribute one column per
+      window, plain one column.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    n_features = values.shape[1]
+
+    rolling = [method for method in methods if method in rolling_methods]
+    stats = rolling_windows(groups, values, windows, rolling, dtype=dtype)
+    widths = [len(windows) if method in rolling_methods else 1 for method in methods]
+
+    # shift by one row within entities - a row never sees its own value
+    stats = lag_matrix(groups, stats, [1], dtype=dtype)
+    previous = lag_matrix(groups, values, [1], dtype=dtype)
+
+    out = np.empty((values.shape[0], n_features * sum(widths)), dtype=dtype)
+    column = 0
+    stats_column = 0
+    for feature in range(n_features):
+        for method, width in zip(methods, widths):
+            if method in rolling_methods:
+                out[:, column:column + width] = stats[:, stats_column:stats_column + width]
+                stats_column += width
+            else:
+                out[:, column] = previous[:, feature]
+            column += width
+    return out
+
+
+def calendar_features(timestamps, mindelta, dtype=np.float32):
+    """
+    Calendar features from an int64 nanosecond timestamp array, computed once for all rows
+      day of week and day of year for at least hourly data, hour of day for at least minutely data
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+
+    if mindelta >= pd.Timedelta('1h'):
+        logger.info('Adding day_of_week and day_of_year features')
+        days = timestamps.astype('datetime64[ns]').astype('datetime64[D]')
+        day_of_week = (days.astype(np.int64) + 3) % 7    # 1970-01-01 was a Thursday, Monday is 0
+        day_of_year = (days - days.astype('datetime64[Y]')).astype(np.int64) + 1
+        names = ['_DayOfWeekCos_', '_DayOfWeekSin_', '_DayOfYearCos_', '_DayOfYearSin_']
+        matrix = np.column_stack([np.cos(day_of_week / 7), np.sin(day_of_week / 7),
+                                  np.cos(day_of_year / 365), np.sin(day_of_year / 365)])
+    elif mindelta >= pd.Timedelta('1m'):
+        logger.info('Adding hour_of_day feature')
+        hour_of_day = (timestamps // 3600000000000) % 24
+        names = ['_HourOfDayCos_', '_HourOfDaySin_']
+        matrix = np.column_stack([np.cos(hour_of_day / 24), np.sin(hour_of_day / 24)])
+    else:
+        names = []
+        matrix = np.zeros((timestamps.size, 0))
+
+    return names, matrix.astype(dtype)
+
+
+class TailState(object):
+    """
+    Last rows of a set of columns per entity, kept between runs
+      Prepending the tail to a new batch computes lag and rolling features of the batch as if the history had
+      been loaded, so only new rows need to be retrieved. The tail holds raw values as rolling minima, maxima
+      and exact deviations need the values leaving the window.
+      Features are exact for batches starting after the stored rows, a batch overlapping them lacks the
+      history of its overlapping rows.
+    """
+
+    def __init__(self, columns, depth):
+        self.columns = list(columns)
+        self.depth = int(depth)
+        self.tail = None
+
+    def matches(self, columns, depth):
+        return self.columns == list(columns) and self.depth >= depth
+
+    def extend(self, df):
+        """
+        Prepend the stored rows older than the first row of their entity in df
+        Returns the extended frame and a mask of the rows taken from df
+        """
+        if self.tail is None or self.tail.shape[0] == 0:
+            return df, np.ones(df.shape[0], dtype=bool)
+
+        timestamps = pd.Series(df.index.get_level_values(1), index=df.index.get_level_values(0))
+        first = timestamps.groupby(level=0).min()
+        entity_first = first.reindex(self.tail.index.get_level_values(0)).to_numpy(dtype='datetime64[ns]')
+        older = self.tail.index.get_level_values(1).to_numpy(dtype='datetime64[ns]') < entity_first
+
+        prepend = self.tail[older].reindex(columns=df.columns)
+        logger.debug('TailState: prepend ' + str(prepend.shape[0]) + ' rows')
+
+        extended = pd.concat([prepend, df])
+        from_df = np.concatenate([np.zeros(prepend.shape[0], dtype=bool), np.ones(df.shape[0], dtype=bool)])
+        return extended, from_df
+
+    def update(self, df):
+        """
+        Keep the last depth rows per entity of df, entities not in df keep their tail
+        """
+        tail = df[self.columns].groupby(level=0, sort=False).tail(self.depth)
+        if self.tail is not None:
+            others = ~self.tail.index.get_level_values(0).isin(tail.index.get_level_values(0))
+            tail = pd.concat([self.tail[others], tail])
+        self.tail = tail
+        return self
+
+
+def group_histograms(codes, n_groups, values, bins, dtype=np.float32):
+    """
+    Histograms of min max scaled values for all groups in one pass
+      codes are group numbers in [0, n_groups), as from pd.factorize or GroupBy.ngroup.
+      Returns an (n_groups, bins) array of densities over [0, 1] like np.histogram(density=True)
+      of minmax_scale'd group values, rows of empty groups or groups with NaN or infinite values are NaN.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+
+    finite = np.isfinite(values)
+    sizes = np.bincount(codes, minlength=n_groups)
+    valid = (sizes > 0) & (np.bincount(codes, weights=~finite, minlength=n_groups) == 0)
+    values = np.where(finite, values, 0)
+
+    # per group min and max from one sort by group
+    order = np.argsort(codes, kind='stable')
+    present = np.flatnonzero(sizes)
+    starts = np.concatenate([[0], np.cumsum(sizes[present])[:-1]])
+    minimum = np.zeros(n_groups)
+    maximum = np.zeros(n_groups)
+    if values.size > 0:
+        minimum[present] = np.minimum.reduceat(values[order], starts)
+        maximum[present] = np.maximum.reduceat(values[order], starts)
+
+    # bin index of each value - constant groups scale to 0, np.histogram puts them into the middle bin
+    spread = (maximum - minimum)[codes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = np.floor((values - minimum[codes]) / spread * bins)
+    index = np.where(spread > 0, np.clip(index, 0, bins - 1), bins // 2).astype(np.int64)
+
+    counts = np.bincount(codes * bins + index, minlength=n_groups * bins).reshape(n_groups, bins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = (counts * bins / sizes[:, None]).astype(dtype)
+    density[~valid] = np.nan
+    return density
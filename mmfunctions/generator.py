@@ -25,6 +25,9 @@ import logging
 from iotfunctions.base import (BaseTransformer)
 from iotfunctions.ui import (UISingle, UIFunctionOutSingle, UISingleItem)
 
+from mmfunctions.modelstore import model_cache, ModelBatch
+from mmfunctions.timing import stage, stage_timing
+
 logger = logging.getLogger(__name__)
 PACKAGE_URL = 'git+https://github.com/sedgewickmm18/mmfunctions.git@'
 _IS_PREINSTALLED = False
@@ -54,6 +57,7 @@ class AnomalyGenerator(BaseTransformer):
         self.width = 0
         self.size = 1
         self.counts_by_entity_id = None
+        self.model_batch = None
         super().__init__()
 
     def injectAnomaly(self, input_array, offset=None, remainder=None, flatline=None,
@@ -170,21 +174,20 @@ class AnomalyGenerator(BaseTransformer):
             db.model_store.delete_model(self.key)
             logger.debug('Reintialize count')
 
-        self.counts_by_entity_id = None
-        try:
-            self.counts_by_entity_id = db.model_store.retrieve_model(self.key)
-        except Exception as e2:
+        self.model_batch = ModelBatch(db)
+        models = self.model_batch.preload([self.key])
+        if self.key in models:
+            self.counts_by_entity_id = models[self.key]
+        else:
             self.counts_by_entity_id = self.count
-            logger.error('Counts by entity id not yet initialized - error: ' + str(e2))
-            pass
+            logger.error('Counts by entity id not yet initialized')
 
     def save_key(self):
-        db = self._entity_type.db
-        try:
-            db.model_store.store_model(self.key, self.counts_by_entity_id)
-        except Exception as e3:
+        if self.model_batch is None:
+            self.model_batch = ModelBatch(self._entity_type.db)
+        self.model_batch.put(self.key, self.counts_by_entity_id)
+        for key, e3 in self.model_batch.flush().items():
             logger.error('Counts by entity id cannot be stored - error: ' + str(e3))
-            pass
         return
 
     def extractOffset(self, entity_grp_id):
@@ -219,13 +222,16 @@ class AnomalyGeneratorExtremeValue(AnomalyGenerator):
         self.size = int(size)
         self.count = None   # allow to set count != 0 for unit testing
 
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         logger.debug('Dataframe shape {}'.format(df.shape))
 
         # initialize per entity offset and remainder
         entity_type = self.get_entity_type()
-        self.check_and_init_key(entity_type)
+        with stage(self, 'model_io'):
+            self.check_and_init_key(entity_type)
 
         timeseries = df.reset_index()
         timeseries[self.output_item] = timeseries[self.input_item]
@@ -244,9 +250,10 @@ class AnomalyGeneratorExtremeValue(AnomalyGenerator):
 
             # Prepare numpy array for marking anomalies
             actual = df_entity_grp[self.output_item].values
-            offset, remainder, flatline, output_array = \
-                self.injectAnomaly(actual, offset=offset, remainder=remainder, flatline=flatline,
-                                   entity_name=entity_grp_id, anomaly_extreme=True)
+            with stage(self, 'generate', entity_grp_id):
+                offset, remainder, flatline, output_array = \
+                    self.injectAnomaly(actual, offset=offset, remainder=remainder, flatline=flatline,
+                                       entity_name=entity_grp_id, anomaly_extreme=True)
 
             # Update group counts for storage
             self.counts_by_entity_id[entity_grp_id] = (offset, remainder, flatline)
@@ -256,7 +263,8 @@ class AnomalyGeneratorExtremeValue(AnomalyGenerator):
             # final = np.append(actual[:strt_idx], a2)
             # Set values in the original dataframe
             try:
-                timeseries.loc[df_entity_grp.index, self.output_item] = output_array
+                with stage(self, 'write_back', entity_grp_id):
+                    timeseries.loc[df_entity_grp.index, self.output_item] = output_array
             except Exception as ee:
                 logger.error('Could not set anomaly because of ' + str(ee) + '\nSizes are ' + str(output_array.shape))
                 pass
@@ -264,7 +272,8 @@ class AnomalyGeneratorExtremeValue(AnomalyGenerator):
         logger.debug('Final Grp Counts {}'.format(self.counts_by_entity_id))
 
         # save the group counts to db
-        self.save_key()
+        with stage(self, 'model_io'):
+            self.save_key()
 
         timeseries.set_index(df.index.names, inplace=True)
         return timeseries
@@ -314,12 +323,15 @@ class AnomalyGeneratorNoData(AnomalyGenerator):
         self.factor = int(factor)
         self.count = None   # allow to set count != 0 for unit testing
 
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         logger.debug('Dataframe shape {}'.format(df.shape))
 
         entity_type = self.get_entity_type()
-        self.check_and_init_key(entity_type)
+        with stage(self, 'model_io'):
+            self.check_and_init_key(entity_type)
 
         # mark Anomalies
         timeseries = df.reset_index()
@@ -338,9 +350,10 @@ class AnomalyGeneratorNoData(AnomalyGenerator):
 
             # Prepare numpy array for marking anomalies
             actual = df_entity_grp[self.output_item].values
-            offset, remainder, flatline, output_array = \
-                self.injectAnomaly(actual, offset=offset, remainder=remainder, flatline=flatline,
-                                   entity_name=entity_grp_id, filler=np.nan, anomaly_extreme=False)
+            with stage(self, 'generate', entity_grp_id):
+                offset, remainder, flatline, output_array = \
+                    self.injectAnomaly(actual, offset=offset, remainder=remainder, flatline=flatline,
+                                       entity_name=entity_grp_id, filler=np.nan, anomaly_extreme=False)
 
             self.counts_by_entity_id[entity_grp_id] = (offset, remainder, flatline)
 
@@ -348,7 +361,8 @@ class AnomalyGeneratorNoData(AnomalyGenerator):
             # final = np.append(actual[:strt_idx], a2)
             # Set values in the original dataframe
             try:
-                timeseries.loc[df_entity_grp.index, self.output_item] = output_array
+                with stage(self, 'write_back', entity_grp_id):
+                    timeseries.loc[df_entity_grp.index, self.output_item] = output_array
             except Exception as ee:
                 logger.error('Could not set anomaly because of ' + str(ee) + '\nSizes are ' + str(output_array.shape))
                 pass
@@ -356,7 +370,8 @@ class AnomalyGeneratorNoData(AnomalyGenerator):
         logger.debug('Final Grp Counts {}'.format(self.counts_by_entity_id))
 
         # save the group counts to db
-        self.save_key()
+        with stage(self, 'model_io'):
+            self.save_key()
 
         timeseries.set_index(df.index.names, inplace=True)
         return timeseries
@@ -406,12 +421,15 @@ class AnomalyGeneratorFlatline(AnomalyGenerator):
         self.factor = int(factor)
         self.count = None   # allow to set count != 0 for unit testing
 
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         logger.debug('Dataframe shape {}'.format(df.shape))
 
         entity_type = self.get_entity_type()
-        self.check_and_init_key(entity_type)
+        with stage(self, 'model_io'):
+            self.check_and_init_key(entity_type)
         logger.debug('Initial Grp Counts {}'.format(self.counts_by_entity_id))
 
         # mark Anomalies
@@ -431,9 +449,10 @@ class AnomalyGeneratorFlatline(AnomalyGenerator):
 
             # Prepare numpy array for marking anomalies
             actual = df_entity_grp[self.output_item].values
-            remainder, offset, flatline, output_array = \
-                self.injectAnomaly(actual, offset=offset, remainder=remainder, flatline=flatline,
-                                   entity_name=entity_grp_id, filler=None, anomaly_extreme=False)
+            with stage(self, 'generate', entity_grp_id):
+                remainder, offset, flatline, output_array = \
+                    self.injectAnomaly(actual, offset=offset, remainder=remainder, flatline=flatline,
+                                       entity_name=entity_grp_id, filler=None, anomaly_extreme=False)
 
             # Update group counts for storage
             self.counts_by_entity_id[entity_grp_id] = (offset, remainder, flatline)
@@ -442,7 +461,8 @@ class AnomalyGeneratorFlatline(AnomalyGenerator):
             # final = np.append(actual[:strt_idx], a2)
             # Set values in the original dataframe
             try:
-                timeseries.loc[df_entity_grp.index, self.output_item] = output_array
+                with stage(self, 'write_back', entity_grp_id):
+                    timeseries.loc[df_entity_grp.index, self.output_item] = output_array
             except Exception as ee:
                 logger.error('Could not set anomaly because of ' + str(ee) + '\nSizes are ' + str(output_array.shape))
                 pass
@@ -450,7 +470,8 @@ class AnomalyGeneratorFlatline(AnomalyGenerator):
         logger.debug('Final Grp Counts {}'.format(self.counts_by_entity_id))
 
         # save the group counts to db
-        self.save_key()
+        with stage(self, 'model_io'):
+            self.save_key()
 
         timeseries.set_index(df.index.names, inplace=True)
         return timeseries
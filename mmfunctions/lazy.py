@@ -0,0 +1,93 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Deferred imports of heavy dependencies
+
+Function modules import torch, keras, lightgbm and friends through these stand-ins so importing the module,
+for example to register functions with the catalog, does not pay for the dependencies of every function.
+The real module is imported when a function first uses it.
+"""
+
+import importlib
+import logging
+import types
+
+logger = logging.getLogger(__name__)
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported on first attribute access
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            logger.debug('Import ' + self.__name__ + ' on first use')
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<lazy module ' + self.__name__ + '>'
+
+
+class LazyAttribute(object):
+    """
+    Stand-in for a class or function imported from a module, the module is imported on first call
+    or attribute access
+    """
+
+    def __init__(self, module, name):
+        self._module = module
+        self._name = name
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            logger.debug('Import ' + self._module + '.' + self._name + ' on first use')
+            self._target = getattr(importlib.import_module(self._module), self._name)
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return '<lazy ' + self._module + '.' + self._name + '>'
+
+
+def lazy_import(name):
+    """
+    Module stand-in for import name
+    """
+    return LazyModule(name)
+
+
+def lazy_attribute(module, name):
+    """
+    Stand-in for from module import name
+    """
+    return LazyAttribute(module, name)
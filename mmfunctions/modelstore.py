@@ -0,0 +1,647 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+In-process model cache in front of the model store
+
+Long-lived pipeline workers retrieve and deserialize the same models with every run. CachingModelStore keeps
+deserialized models in a size-bounded LRU shared by all functions using the same underlying store, and before
+reusing a cached model it compares a cheap version of the stored model - the update timestamp in the database,
+modification time and size of a file - with the version the model was cached with. Stores are written through.
+
+Every retrieval hands out a copy of the cached model, functions change the models they retrieve and only what
+they store again reaches the cache. A failed store drops the model from the cache, a failed execute run drops
+the models it retrieved. Models of stores that cannot tell a version are reused for unversioned_ttl seconds.
+The model_cache decorator puts the cache in front of the model store of the database for the duration of an
+execute run only, other users of the database see the model store as it is.
+
+ModelBatch retrieves the models of all entities of a run before the entity loop and writes the changed ones
+in one flush afterwards - in bulk where the store supports it, concurrently where it only supports single models.
+
+LocalModelStore and LocalDatabase stand in for the database model store in tests, notebooks and offline runs.
+"""
+
+import copy
+import functools
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import dill
+
+from mmfunctions.serialization import dumps, is_bundle, loads
+
+logger = logging.getLogger(__name__)
+
+# size of the shared caches in number of models
+max_models = 256
+
+# model store versions - None if the store cannot tell, MISSING if there is no stored model
+MISSING = False
+
+# seconds a cached model without a version is reused before it is retrieved again
+unversioned_ttl = 300
+
+
+def file_model_path(store, model_name):
+    return store.path + store.STORE_TABLENAME + model_name.replace('/', ':')
+
+
+def db_select(store, column, model_names, chunk_size=100):
+    """
+    Column of the model store table for many models of a DBModelStore with one query per chunk of names
+    Returns a dict of model name to value, models not in the store are left out
+    """
+    from iotfunctions import dbhelper, dbtables
+
+    result = {}
+    model_names = list(model_names)
+    for start in range(0, len(model_names), chunk_size):
+        chunk = model_names[start:start + chunk_size]
+        if not store.is_postgre_sql:
+            sql_statement = "SELECT MODEL_NAME, %s FROM %s.%s WHERE ENTITY_TYPE_ID = ? AND MODEL_NAME IN (%s)" % (
+                column, store.quoted_schema, store.quoted_store_tablename, ', '.join(['?'] * len(chunk)))
+            stmt = dbtables.ibm_db.prepare(store.db_connection, sql_statement)
+            try:
+                for i, param in enumerate([store.entity_type_id] + chunk):
+                    dbtables.ibm_db.bind_param(stmt, i + 1, param)
+                dbtables.ibm_db.execute(stmt)
+                row = dbtables.ibm_db.fetch_tuple(stmt)
+                while row is not False:
+                    result[row[0]] = row[1]
+                    row = dbtables.ibm_db.fetch_tuple(stmt)
+            finally:
+                dbtables.ibm_db.free_result(stmt)
+        else:
+            sql_statement = 'SELECT model_name, %s FROM %s.%s' % (column.lower(), store.quoted_schema,
+                                                                  store.quoted_store_tablename)
+            sql_statement += ' WHERE entity_type_id = %s AND model_name IN (' + ', '.join(['%s'] * len(chunk)) + ')'
+            rows = dbhelper.execute_postgre_sql_select_query(store.db_connection, sql_statement,
+                                                             tuple([store.entity_type_id] + chunk))
+            for row in rows:
+                result[row[0]] = row[1]
+    return result
+
+
+def decode_model(model):
+    """
+    Models stored as compact bundles are rebuilt on first use
+    """
+    if is_bundle(model):
+        return loads(model, lazy=True)
+    return model
+
+
+def model_version(store, model_name):
+    """
+    Cheap version of a stored model without retrieving it, None if the store cannot tell
+    """
+    # stores can provide their own version lookup
+    if hasattr(store, 'model_version'):
+        return store.model_version(model_name)
+
+    store_class = store.__class__.__name__
+    if store_class == 'FileModelStore':
+        try:
+            stat = os.stat(file_model_path(store, model_name))
+        except FileNotFoundError:
+            return MISSING
+        return (stat.st_mtime_ns, stat.st_size)
+
+    if store_class == 'DBModelStore':
+        row = db_select(store, 'UPDATED_TS', [model_name]).get(model_name)
+        return MISSING if row is None else str(row)
+
+    return None
+
+
+def model_versions(store, model_names):
+    """
+    Versions of many stored models, one query for a DBModelStore
+    """
+    if store.__class__.__name__ == 'DBModelStore' and not hasattr(store, 'model_version'):
+        rows = db_select(store, 'UPDATED_TS', model_names)
+        return {name: (str(rows[name]) if name in rows else MISSING) for name in model_names}
+    return {name: model_version(store, name) for name in model_names}
+
+
+def retrieve_models(store, model_names, max_workers=8):
+    """
+    Retrieve many models in one go - with the store's bulk retrieval, one query per chunk of names for a
+    DBModelStore or concurrent single retrievals otherwise.
+    Returns a dict of model name to model, None for models not in the store. Models that fail to load are logged
+    and left out.
+    """
+    model_names = list(model_names)
+    if len(model_names) == 0:
+        return {}
+
+    if hasattr(store, 'retrieve_models'):
+        return store.retrieve_models(model_names)
+
+    if store.__class__.__name__ == 'DBModelStore':
+        from iotfunctions import dbtables
+
+        models = dict.fromkeys(model_names)
+        for model_name, blob in db_select(store, 'MODEL', model_names).items():
+            try:
+                models[model_name] = decode_model(dbtables.pickle.loads(bytes(blob)))
+            except Exception as e:
+                logger.error('Model retrieval of ' + str(model_name) + ' failed with ' + str(e))
+                del models[model_name]
+        return models
+
+    failed = object()
+
+    def retrieve(model_name):
+        try:
+            return decode_model(store.retrieve_model(model_name))
+        except Exception as e:
+            logger.error('Model retrieval of ' + str(model_name) + ' failed with ' + str(e))
+            return failed
+
+    if max_workers <= 1 or len(model_names) == 1:
+        models = [retrieve(model_name) for model_name in model_names]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(model_names))) as pool:
+            models = list(pool.map(retrieve, model_names))
+    return {model_name: model for model_name, model in zip(model_names, models) if model is not failed}
+
+
+def store_models(store, models, max_workers=8):
+    """
+    Store many models in one go - with the store's bulk store, one after the other over the single connection
+    of a DBModelStore or concurrently otherwise
+    Returns a dict of model name to exception for the models that could not be stored
+    """
+    if len(models) == 0:
+        return {}
+
+    if hasattr(store, 'store_models'):
+        return store.store_models(models)
+
+    def store_one(item):
+        try:
+            store.store_model(item[0], item[1])
+            return None
+        except Exception as e:
+            return e
+
+    if store.__class__.__name__ == 'DBModelStore' or max_workers <= 1 or len(models) == 1:
+        errors = [store_one(item) for item in models.items()]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(models))) as pool:
+            errors = list(pool.map(store_one, models.items()))
+    return {model_name: error for model_name, error in zip(models.keys(), errors) if error is not None}
+
+
+def store_key(store):
+    """
+    Identity of the underlying store, functions with the same store share a cache
+    """
+    store_class = store.__class__.__name__
+    if store_class == 'DBModelStore':
+        return (store_class, store.tenant_id, store.entity_type_id, store.schema)
+    if store_class in ['FileModelStore', 'LocalModelStore']:
+        return (store_class, os.path.abspath(store.path or '.'))
+    return (store_class, id(store))
+
+
+class LocalModelStore(object):
+    """
+    Model store backed by a directory with one file per model, same interface as the database model store
+
+    Models are written as uncompressed bundles, see mmfunctions.serialization, falling back to dill for models
+    the bundle pickler cannot handle. Files are replaced atomically and read memory-mapped copy on write, so the
+    arrays of a retrieved bundle are backed by the file, only paged in when used and copied when changed.
+    """
+
+    suffix = '.model'
+
+    def __init__(self, path, codec='none'):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.codec = codec
+        logger.info('Init LocalModelStore with path: ' + str(path))
+
+    def __str__(self):
+        return 'LocalModelStore path: ' + self.path + '\n'
+
+    def model_path(self, model_name):
+        return os.path.join(self.path, quote(model_name, safe='') + self.suffix)
+
+    def model_names(self):
+        return sorted(unquote(name[:-len(self.suffix)]) for name in os.listdir(self.path) if name.endswith(self.suffix))
+
+    def model_version(self, model_name):
+        try:
+            stat = os.stat(self.model_path(model_name))
+        except FileNotFoundError:
+            return MISSING
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def store_model(self, model_name, model, user_name=None, serialize=True):
+        if serialize and not is_bundle(model):
+            try:
+                model = dumps(model, codec=self.codec)
+            except Exception as e:
+                logger.debug('Model ' + model_name + ' cannot be bundled, pickle it: ' + str(e))
+                try:
+                    model = dill.dumps(model)
+                except Exception as ex:
+                    raise Exception('Serialization of model %s that is supposed to be stored in ModelStore '
+                                    'failed.' % model_name) from ex
+
+        # write a temporary file next to the model and move it in place, readers see the old or the new model
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='.' + quote(model_name, safe='')[:64], suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(model)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.model_path(model_name))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logger.debug('Model ' + model_name + ' of size ' + str(len(model)) + ' bytes stored in ' + self.path)
+
+    def retrieve_model(self, model_name, deserialize=True):
+        try:
+            f = open(self.model_path(model_name), 'rb')
+        except FileNotFoundError:
+            logger.info('Model ' + model_name + ' does not exist in ' + self.path)
+            return None
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                model = b''
+            else:
+                # the mapping stays open as long as arrays of the model refer to it, copy on write keeps
+                # the arrays writable without changing the file
+                model = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+        if not deserialize:
+            return bytes(model)
+        if is_bundle(model):
+            return loads(model)
+        try:
+            return dill.loads(model)
+        except Exception as ex:
+            raise Exception('Deserialization of model %s that has been retrieved from ModelStore failed.' %
+                            model_name) from ex
+
+    def delete_model(self, model_name):
+        try:
+            os.remove(self.model_path(model_name))
+        except FileNotFoundError:
+            pass
+        logger.info('Model ' + model_name + ' has been deleted from ' + self.path)
+
+
+class LocalDatabase(object):
+    """
+    Database stand-in with a local model store - pass as db to _build_entity_type to run functions that
+    store models without a database
+    """
+
+    def __init__(self, path, tenant_id='local', db_type='local'):
+        self.model_store = LocalModelStore(path)
+        self.tenant_id = tenant_id
+        self.db_type = db_type
+        self.credentials = {}
+        self.entity_type_metadata = {}
+
+
+class ModelCache(object):
+    """
+    Size-bounded LRU of deserialized models with their store version, time cached and hit/miss counters
+    """
+
+    counters = ['hits', 'misses', 'stale', 'stores', 'evictions']
+
+    def __init__(self, max_models=max_models):
+        self.max_models = max_models
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        for counter in self.counters:
+            setattr(self, counter, 0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def counts(self):
+        return {counter: getattr(self, counter) for counter in self.counters}
+
+    def get(self, model_name):
+        with self.lock:
+            entry = self.entries.get(model_name)
+            if entry is not None:
+                self.entries.move_to_end(model_name)
+            return entry
+
+    def put(self, model_name, version, model):
+        with self.lock:
+            self.entries[model_name] = (version, model, time.monotonic())
+            self.entries.move_to_end(model_name)
+            while len(self.entries) > self.max_models:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, model_name):
+        with self.lock:
+            self.entries.pop(model_name, None)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+def private_copy(model):
+    """
+    Copy of a cached model for one caller, cached models are never handed out
+    """
+    return copy.deepcopy(model)
+
+
+class CachingModelStore(object):
+    """
+    Model store wrapper - retrieves copies from the shared cache if the stored version did not change,
+    writes through to the model store
+    """
+
+    def __init__(self, store, cache=None, validate=True, ttl=unversioned_ttl):
+        self.store = store
+        self.cache = ModelCache() if cache is None else cache
+        self.validate = validate
+        self.ttl = ttl
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        # everything else goes to the model store
+        return getattr(self.store, name)
+
+    def counts(self):
+        return self.cache.counts()
+
+    def version(self, model_name):
+        if not self.validate:
+            return None
+        try:
+            return model_version(self.store, model_name)
+        except Exception as e:
+            logger.debug('Model version lookup failed with ' + str(e))
+            return None
+
+    def is_current(self, entry, version):
+        if version is None:
+            # the store cannot tell if the model changed, the cached model is reused for ttl seconds
+            return self.ttl is None or time.monotonic() - entry[2] < self.ttl
+        return version == entry[0]
+
+    def begin_run(self):
+        """
+        Start recording the names of the models retrieved by this thread, returns the set they are added to
+        """
+        runs = getattr(self.local, 'runs', None)
+        if runs is None:
+            runs = self.local.runs = []
+        runs.append(set())
+        return runs[-1]
+
+    def end_run(self):
+        self.local.runs.pop()
+
+    def served(self, model_name):
+        for run in getattr(self.local, 'runs', []):
+            run.add(model_name)
+
+    def retrieve_model(self, model_name, deserialize=True):
+        if not deserialize:
+            return self.store.retrieve_model(model_name, deserialize=False)
+
+        self.served(model_name)
+        version = None
+        entry = self.cache.get(model_name)
+        if entry is not None:
+            version = self.version(model_name)
+            if self.is_current(entry, version):
+                self.cache.count('hits')
+                return private_copy(entry[1])
+            self.cache.count('stale')
+            self.cache.invalidate(model_name)
+        else:
+            version = self.version(model_name)
+
+        self.cache.count('misses')
+        if version is MISSING:
+            return None
+
+        model = decode_model(self.store.retrieve_model(model_name))
+        if model is None:
+            return None
+        self.cache.put(model_name, version, model)
+        return private_copy(model)
+
+    def store_model(self, model_name, model, user_name=None, serialize=True):
+        try:
+            self.store.store_model(model_name, model, user_name=user_name, serialize=serialize)
+        except Exception:
+            self.cache.invalidate(model_name)
+            raise
+        self.cache.count('stores')
+        if serialize:
+            self.cache.put(model_name, self.version(model_name), self.cached(model))
+        else:
+            self.cache.invalidate(model_name)
+
+    def cached(self, model):
+        # bundles decode to a new model, models the caller keeps are copied
+        return decode_model(model) if is_bundle(model) else private_copy(model)
+
+    def delete_model(self, model_name):
+        self.cache.invalidate(model_name)
+        self.store.delete_model(model_name)
+
+    def retrieve_models(self, model_names):
+        versions = {}
+        if self.validate:
+            try:
+                versions = model_versions(self.store, model_names)
+            except Exception as e:
+                logger.debug('Model version lookup failed with ' + str(e))
+
+        models = {}
+        load = []
+        for model_name in model_names:
+            self.served(model_name)
+            entry = self.cache.get(model_name)
+            version = versions.get(model_name)
+            if entry is not None and self.is_current(entry, version):
+                self.cache.count('hits')
+                models[model_name] = private_copy(entry[1])
+                continue
+            if entry is not None:
+                self.cache.count('stale')
+                self.cache.invalidate(model_name)
+            self.cache.count('misses')
+            if version is MISSING:
+                models[model_name] = None
+            else:
+                load.append(model_name)
+
+        for model_name, model in retrieve_models(self.store, load).items():
+            models[model_name] = model
+            if model is not None:
+                self.cache.put(model_name, versions.get(model_name), model)
+                models[model_name] = private_copy(model)
+        return models
+
+    def store_models(self, models):
+        failures = store_models(self.store, models)
+        stored = [model_name for model_name in models if model_name not in failures]
+        versions = {}
+        if self.validate:
+            try:
+                versions = model_versions(self.store, stored)
+            except Exception as e:
+                logger.debug('Model version lookup failed with ' + str(e))
+        for model_name in stored:
+            self.cache.count('stores')
+            self.cache.put(model_name, versions.get(model_name), self.cached(models[model_name]))
+        for model_name in failures:
+            self.cache.invalidate(model_name)
+        return failures
+
+
+# shared caches by underlying store
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def cache_model_store(db):
+    """
+    Put the shared model cache in front of the model store of db, returns the caching store or None without one
+    """
+    store = getattr(db, 'model_store', None)
+    if store is None:
+        return None
+    if isinstance(store, CachingModelStore):
+        return store
+
+    with _caches_lock:
+        cache = _caches.setdefault(store_key(store), ModelCache())
+    db.model_store = CachingModelStore(store, cache)
+    return db.model_store
+
+
+class ModelBatch(object):
+    """
+    Models of one execute run - retrieved in bulk before the entity loop, the models changed in the loop
+    are written in one flush at the end. With compact=True models are written as compressed bundles,
+    see mmfunctions.serialization
+    """
+
+    def __init__(self, db, max_workers=8, compact=False, codec=None):
+        self.store = getattr(db, 'model_store', None)
+        self.max_workers = max_workers
+        self.compact = compact
+        self.codec = codec
+        self.models = {}
+        self.changed = OrderedDict()
+
+    def preload(self, model_names):
+        try:
+            self.models.update(retrieve_models(self.store, model_names, max_workers=self.max_workers))
+        except Exception as e:
+            logger.error('Model retrieval failed with ' + str(e))
+        return self.models
+
+    def get(self, model_name):
+        return self.models.get(model_name)
+
+    def put(self, model_name, model):
+        self.models[model_name] = model
+        self.changed[model_name] = model
+
+    def flush(self):
+        """
+        Write the changed models, returns a dict of model name to exception for the models that failed
+        """
+        if len(self.changed) == 0:
+            return {}
+        failures = {}
+        models = self.changed
+        if self.compact:
+            models = OrderedDict()
+            for model_name, model in self.changed.items():
+                try:
+                    models[model_name] = dumps(model, codec=self.codec)
+                except Exception as e:
+                    failures[model_name] = e
+        try:
+            failures.update(store_models(self.store, models, max_workers=self.max_workers))
+        except Exception as e:
+            failures.update({model_name: e for model_name in models})
+        for model_name, error in failures.items():
+            logger.error('Model store of ' + str(model_name) + ' failed with ' + str(error))
+        logger.debug('Stored ' + str(len(self.changed) - len(failures)) + ' of ' + str(len(self.changed)) + ' models')
+        self.changed = OrderedDict()
+        return failures
+
+
+def model_cache(execute):
+    """
+    Decorator for execute methods - retrieve models through the shared cache and add the cache hits and misses
+    of the run to the function trace. Models retrieved by a run that raises are dropped from the cache.
+    The model store of the database is restored after the run
+    """
+
+    @functools.wraps(execute)
+    def cached_execute(self, df, *args, **kwargs):
+        try:
+            db = self._entity_type.db
+            original = db.model_store
+            store = cache_model_store(db)
+        except Exception as e:
+            logger.debug('No model cache: ' + str(e))
+            store = None
+
+        if store is None:
+            return execute(self, df, *args, **kwargs)
+
+        before = store.counts()
+        served = store.begin_run()
+        try:
+            return execute(self, df, *args, **kwargs)
+        except Exception:
+            # models retrieved in a failed run may have been changed without being stored again
+            for model_name in served:
+                store.cache.invalidate(model_name)
+            raise
+        finally:
+            store.end_run()
+            # the run that put the cache in front restores the store, nested runs found the cache in place
+            if db.model_store is store:
+                db.model_store = original
+            after = store.counts()
+            delta = {counter: after[counter] - before[counter] for counter in after}
+            if any(delta.values()):
+                self.trace_append(msg='Model cache ' + ', '.join(k + ': ' + str(v) for k, v in delta.items()),
+                                  **{'model_cache_' + k: v for k, v in delta.items()})
+
+    return cached_execute
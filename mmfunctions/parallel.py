@@ -0,0 +1,319 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Parallel per entity training for BaseEstimatorFunction based functions
+
+Entities that need a model are trained in a pool of processes, largest entities first.
+Jobs train against a model store stand-in that collects the models instead of writing them,
+the parent writes all collected models to the model store in one go afterwards.
+The regular per entity loop of the function then finds the models and only predicts. The models of all entities
+are retrieved in one go to decide which entities need training, the loop is served these and the trained models
+from memory (see prefetched_models) instead of retrieving them again.
+
+Workers are started from a fork server (or spawned) instead of being forked from the pipeline process: a fork
+after LightGBM, OpenMP or torch have started their thread pools can deadlock in the child. The function is
+pickled for the workers with a database stand-in that carries the plain attributes of the database (type,
+tenant, schema, credentials) but no connections. Models that cannot be pickled back from a job, some Keras
+models for example, are left to the function's serial loop.
+"""
+
+import contextlib
+import copy
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from mmfunctions.modelstore import retrieve_models
+from mmfunctions.timing import stage
+
+logger = logging.getLogger(__name__)
+
+# function and database of a worker process, unpickled by _init_worker when the worker starts
+_worker_function = None
+_worker_database = None
+
+
+class CollectingModelStore(object):
+    """
+    Model store stand-in for training jobs, models are collected instead of written
+    """
+
+    def __init__(self):
+        self.stored = {}
+
+    def retrieve_model(self, model_name, deserialize=True):
+        return self.stored.get(model_name)
+
+    def store_model(self, model_name, model, user_name=None, serialize=True):
+        self.stored[model_name] = model
+
+    def delete_model(self, model_name):
+        self.stored.pop(model_name, None)
+
+
+class CollectingDatabase(object):
+    """
+    Database stand-in for training jobs - plain attributes of the database like db_type, tenant_id, schema and
+    credentials are carried over, connections are not, models go to a CollectingModelStore
+    """
+
+    plain_types = (str, bytes, int, float, bool, type(None))
+
+    def __init__(self, db=None):
+        self.credentials = {}
+        if db is not None:
+            for name, value in vars(db).items():
+                if isinstance(value, self.plain_types) or (name == 'credentials' and isinstance(value, dict)):
+                    setattr(self, name, value)
+        self.model_store = CollectingModelStore()
+
+
+class PrefetchedModelStore(object):
+    """
+    Model store wrapper serving models retrieved before from memory, everything else goes to the model store
+    """
+
+    def __init__(self, store, models):
+        self.store = store
+        self.models = models
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def retrieve_model(self, model_name, deserialize=True):
+        if deserialize and model_name in self.models:
+            return self.models[model_name]
+        return self.store.retrieve_model(model_name, deserialize=deserialize)
+
+    def store_model(self, model_name, model, user_name=None, serialize=True):
+        self.models.pop(model_name, None)
+        self.store.store_model(model_name, model, user_name=user_name, serialize=serialize)
+
+    def delete_model(self, model_name):
+        self.models.pop(model_name, None)
+        self.store.delete_model(model_name)
+
+
+@contextlib.contextmanager
+def prefetched_models(function, entity):
+    """
+    Serve the models of entity that train_entities retrieved or trained from memory while the function runs for it
+      Each entity's models are handed out for one run of the entity and dropped afterwards.
+    """
+    prefetched = getattr(function, '_prefetched_models', None)
+    models = prefetched.pop(entity, None) if prefetched is not None else None
+    if models is None:
+        yield
+        return
+
+    db = function._entity_type.db
+    original = db.model_store
+    db.model_store = PrefetchedModelStore(original, models)
+    try:
+        yield
+    finally:
+        db.model_store = original
+
+
+class DiscardingTrace(object):
+    """
+    Trace stand-in for training jobs, the pipeline process keeps the trace and entries of jobs are dropped
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self.discard
+
+    def discard(self, *args, **kwargs):
+        return None
+
+
+def worker_payload(function):
+    """
+    Pickled copy of the function for the training jobs, its database replaced by a CollectingDatabase
+      Entity type attributes that cannot be pickled stay with the pipeline process, jobs see None or, for the
+      trace, a DiscardingTrace.
+    """
+    entity_type = copy.copy(function._entity_type)
+    entity_type.db = CollectingDatabase(function._entity_type.db)
+    for name, value in list(vars(entity_type).items()):
+        try:
+            pickle.dumps(value)
+        except Exception:
+            logger.debug('Entity type attribute ' + name + ' is not passed to training jobs')
+            setattr(entity_type, name, DiscardingTrace() if name == '_trace' else None)
+
+    worker_function = copy.copy(function)
+    worker_function._entity_type = entity_type
+    # stage timings are reported by the pipeline process, jobs retrieve their models themselves
+    worker_function._stage_timings = None
+    worker_function._prefetched_models = None
+    return pickle.dumps(worker_function)
+
+
+def _init_worker(payload, threads_per_job):
+    global _worker_function, _worker_database
+
+    # keep LightGBM, BLAS and torch from oversubscribing the cores - before they are loaded along with the function
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[variable] = str(threads_per_job)
+
+    _worker_function = pickle.loads(payload)
+    _worker_database = _worker_function._entity_type.db
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads_per_job)
+    except Exception as e:
+        logger.debug('Could not limit threads with threadpoolctl: ' + str(e))
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(threads_per_job)
+
+
+def _train_entity(entity, df_entity):
+    _worker_database.model_store = CollectingModelStore()
+    _worker_function._execute(df_entity, entity)
+
+    # models are returned pickled, those that cannot be pickled are trained again by the parent
+    stored = {}
+    for model_name, model in _worker_database.model_store.stored.items():
+        try:
+            stored[model_name] = pickle.dumps(model)
+        except Exception as e:
+            logger.warning('Model ' + model_name + ' cannot be returned from the training job: ' + str(e))
+    return entity, stored
+
+
+def start_method():
+    """
+    Fork server if available, otherwise spawned processes - never a plain fork of the pipeline process
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return 'forkserver' if 'forkserver' in methods else 'spawn'
+
+
+def training_model_names(function, df, entity):
+    """
+    Names of the models of entity per target as BaseEstimatorFunction.get_models_for_training builds them
+    """
+    names = []
+    unprocessed_targets = list(function.targets)
+    for target in function.targets:
+        if function.is_scaler:
+            features = function.features
+        else:
+            features = function.make_feature_list(features=function.features, df=df,
+                                                  unprocessed_targets=unprocessed_targets)
+        names.append(function.get_model_name(features, target, suffix=entity))
+        unprocessed_targets.append(target)
+    return names
+
+
+def entities_to_train(function, df, entities):
+    """
+    Entities with at least one model that requires training, largest entities first, along with the models of
+    all entities by entity and model name - retrieved from the model store in one go
+    """
+    db = function._entity_type.db
+
+    training_names = {}
+    names = {}
+    for entity in entities:
+        try:
+            training_names[entity] = training_model_names(function, df, entity)
+            predict_names = [function.get_model_name(function.features, target, suffix=entity)
+                             for target in function.targets]
+            names[entity] = list(dict.fromkeys(training_names[entity] + predict_names))
+        except Exception as e:
+            logger.debug('Could not name the models of entity ' + str(entity) + ': ' + str(e))
+
+    try:
+        retrieved = retrieve_models(db.model_store, [name for entity in names for name in names[entity]])
+    except Exception as e:
+        logger.error('Model retrieval failed with ' + str(e))
+        return [], {}
+
+    # models that failed to load are left to the store, the function retrieves them again
+    models = {entity: {name: retrieved[name] for name in names[entity] if name in retrieved} for entity in names}
+
+    sizes = df.groupby(level=0).size()
+    required = []
+    for entity in training_names:
+        try:
+            if any(function.decide_training_required(retrieved.get(name))[0] for name in training_names[entity]):
+                required.append(entity)
+        except Exception as e:
+            logger.debug('Could not decide whether entity ' + str(entity) + ' requires training: ' + str(e))
+
+    return sorted(required, key=lambda entity: sizes.get(entity, 0), reverse=True), models
+
+
+def train_entities(function, df, entities, n_jobs=None, threads_per_job=None):
+    """
+    Train the models of all entities that require training over a process pool and write them to the model store
+      Does nothing for a single job, prediction only runs or functions that delete their models with each run,
+      the function's serial per entity loop handles these as before. Otherwise the models retrieved to decide on
+      training and the trained models are kept for the serial loop, see prefetched_models.
+    Returns the names of the models written to the model store
+    """
+    function._prefetched_models = None
+
+    n_jobs = getattr(function, 'n_jobs', 1) if n_jobs is None else n_jobs
+    threads_per_job = getattr(function, 'threads_per_job', 1) if threads_per_job is None else threads_per_job
+
+    if n_jobs is None or n_jobs <= 1 or len(entities) < 2 or function.delete_existing_models:
+        return []
+
+    with stage(function, 'model_io'):
+        required, prefetched = entities_to_train(function, df, entities)
+    function._prefetched_models = prefetched
+    if len(required) < 2:
+        return []
+
+    try:
+        payload = worker_payload(function)
+    except Exception as e:
+        logger.info('Function cannot be passed to training jobs, continue serially: ' + str(e))
+        return []
+
+    logger.info('Train ' + str(len(required)) + ' entities with ' + str(n_jobs) + ' jobs')
+
+    models = {}
+    with stage(function, 'fit'), \
+            ProcessPoolExecutor(max_workers=min(n_jobs, len(required)),
+                                mp_context=multiprocessing.get_context(start_method()),
+                                initializer=_init_worker, initargs=(payload, threads_per_job)) as pool:
+        futures = [pool.submit(_train_entity, entity, df.loc[[entity]]) for entity in required]
+        for future in as_completed(futures):
+            try:
+                entity, stored = future.result()
+                logger.debug('Trained entity ' + str(entity) + ' models ' + str(list(stored.keys())))
+                models.update({model_name: (entity, pickled) for model_name, pickled in stored.items()})
+            except Exception as e:
+                logger.error('Training job failed with ' + str(e))
+
+    db = function._entity_type.db
+    written = []
+    with stage(function, 'model_io'):
+        for model_name, (entity, pickled) in models.items():
+            try:
+                model = pickle.loads(pickled)
+                db.model_store.store_model(model_name, model)
+                written.append(model_name)
+                prefetched.setdefault(entity, {})[model_name] = model
+            except Exception as e:
+                logger.error('Model store failed with ' + str(e))
+
+    return written
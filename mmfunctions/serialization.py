@@ -0,0 +1,293 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Compact model serialization
+
+Models are written as bundles: a small pickle (protocol 5) of the model structure with all larger NumPy arrays
+kept out-of-band as raw buffers, optionally compressed with zstd, lz4 or zlib. Known model classes - the
+KDE of KDEAnomalyScore, the VI network of VIAnomalyScore and the sklearn scalers - are reduced to versioned
+array states (data and bandwidths, state dict, scaler parameters) instead of pickling the whole object.
+
+    | magic | format version | codec | number of sections | section table (raw, stored sizes) | sections ... |
+
+The first section holds the pickled structure, the others the array buffers. Uncompressed buffers are used in
+place when writable, so arrays loaded from a copy on write memory-mapped bundle are backed by the file. Buffers
+of read-only data are copied, models update their arrays in place.
+
+dumps returns the bundle as Bundle, bytes that unpickle as the model, so stores that pickle what they are given
+return the model to any caller of retrieve_model.
+"""
+
+import importlib
+import importlib.util
+import io
+import logging
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MMSB'
+FORMAT_VERSION = 1
+
+_header = struct.Struct('<4sBBI')
+_section = struct.Struct('<QQ')
+
+codecs = {'none': 0, 'zlib': 1, 'lz4': 2, 'zstd': 3}
+_codec_names = {v: k for k, v in codecs.items()}
+_codec_modules = {'lz4': 'lz4.frame', 'zstd': 'zstandard'}
+
+# arrays smaller than this stay inside the pickled structure
+min_buffer_size = 1024
+
+
+def codec_available(codec):
+    if codec not in codecs:
+        return False
+    if codec not in _codec_modules:
+        return True
+    return importlib.util.find_spec(_codec_modules[codec].split('.')[0]) is not None
+
+
+def default_codec():
+    """
+    Best compression codec installed - zstd, lz4 or zlib from the standard library
+    """
+    for codec in ['zstd', 'lz4']:
+        if codec_available(codec):
+            return codec
+    return 'zlib'
+
+
+def compress(codec, data, level=None):
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    if codec == 'lz4':
+        lz4_frame = importlib.import_module('lz4.frame')
+        return lz4_frame.compress(data, compression_level=0 if level is None else level)
+    if codec == 'zstd':
+        zstandard = importlib.import_module('zstandard')
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError('Unknown codec ' + str(codec))
+
+
+def decompress(codec, data, size):
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.decompress(data, bufsize=size)
+    if codec == 'lz4':
+        return importlib.import_module('lz4.frame').decompress(data)
+    if codec == 'zstd':
+        return importlib.import_module('zstandard').ZstdDecompressor().decompress(data, max_output_size=size)
+    raise ValueError('Unknown codec ' + str(codec))
+
+
+#
+# reducers - model classes stored as array states, looked up by module and class name so the model
+#  libraries are only imported when such a model is written or read
+#
+
+def _reduce_standard_scaler(scaler):
+    return {'params': scaler.get_params(), 'attributes': {k: v for k, v in scaler.__dict__.items() if k.endswith('_')}}
+
+
+def build_scaler(version, class_path, state):
+    check_version(version, class_path)
+    module, name = class_path.rsplit('.', 1)
+    scaler = getattr(importlib.import_module(module), name)(**state['params'])
+    scaler.__dict__.update(state['attributes'])
+    return scaler
+
+
+def _reduce_kde(kde):
+    return {'data': kde.data, 'var_type': kde.var_type, 'bw': np.asarray(kde.bw)}
+
+
+def build_kde(version, class_path, state):
+    check_version(version, class_path)
+    from statsmodels.nonparametric.kernel_density import KDEMultivariate
+    # given bandwidths are taken as they are, no bandwidth estimation
+    return KDEMultivariate(state['data'], var_type=state['var_type'], bw=state['bw'])
+
+
+def _reduce_vi(vi):
+    return {'args': {'scaler': vi.scaler, 'prior_mu': vi.prior_mu, 'prior_sigma': vi.prior_sigma, 'beta': vi.beta,
+                     'adjust_mean': vi.adjust_mean, 'version': vi.version},
+            'build_time': vi.build_time,
+            'state_dict': {k: v.detach().cpu().numpy() for k, v in vi.state_dict().items()}}
+
+
+def build_vi(version, class_path, state):
+    check_version(version, class_path)
+    import torch
+    from mmfunctions.variational import VI
+    vi = VI(**state['args'])
+    vi.build_time = state['build_time']
+    vi.load_state_dict({k: torch.tensor(np.asarray(v)) for k, v in state['state_dict'].items()})
+    return vi
+
+
+# class path: (state version, reduce, build)
+reducers = {
+    'sklearn.preprocessing._data.StandardScaler': (1, _reduce_standard_scaler, build_scaler),
+    'sklearn.preprocessing._data.RobustScaler': (1, _reduce_standard_scaler, build_scaler),
+    'sklearn.preprocessing._data.MinMaxScaler': (1, _reduce_standard_scaler, build_scaler),
+    'statsmodels.nonparametric.kernel_density.KDEMultivariate': (1, _reduce_kde, build_kde),
+    'mmfunctions.variational.VI': (1, _reduce_vi, build_vi),
+}
+
+
+def check_version(version, class_path):
+    if version > reducers[class_path][0]:
+        raise ValueError('Model state version ' + str(version) + ' of ' + class_path + ' is newer than supported')
+
+
+def class_path(obj):
+    return type(obj).__module__ + '.' + type(obj).__qualname__
+
+
+class BundlePickler(pickle.Pickler):
+    """
+    Pickler that writes model classes with a reducer as their array state
+    """
+
+    def reducer_override(self, obj):
+        if type(obj) is LazyModel:
+            obj = obj.model
+        path = class_path(obj)
+        if path in reducers:
+            version, reduce, build = reducers[path]
+            return build, (version, path, reduce(obj))
+        return NotImplemented
+
+
+def dumps(model, codec=None, level=None):
+    """
+    Bundle of a model, compressed with codec - default the best one installed
+    """
+    if codec is None:
+        codec = default_codec()
+    if codec not in codecs:
+        raise ValueError('Unknown codec ' + str(codec))
+    if isinstance(model, LazyModel):
+        model = model.model
+
+    buffers = []
+
+    def out_of_band(buffer):
+        if buffer.raw().nbytes < min_buffer_size:
+            return True
+        buffers.append(buffer)
+        return False
+
+    stream = io.BytesIO()
+    BundlePickler(stream, protocol=5, buffer_callback=out_of_band).dump(model)
+
+    sections = [stream.getvalue()] + [buffer.raw() for buffer in buffers]
+    stored = [compress(codec, section, level) for section in sections]
+
+    out = io.BytesIO()
+    out.write(_header.pack(MAGIC, FORMAT_VERSION, codecs[codec], len(sections)))
+    for section, data in zip(sections, stored):
+        out.write(_section.pack(len(section) if isinstance(section, bytes) else section.nbytes, len(data)))
+    for data in stored:
+        out.write(data)
+    return Bundle(out.getvalue())
+
+
+class Bundle(bytes):
+    """
+    Bytes of a bundle that unpickle as the model - stores that pickle what they are given, like the database
+    model store, hand out the model and not the bundle
+    """
+
+    def __reduce__(self):
+        return loads, (bytes(self),)
+
+
+def is_bundle(data):
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == MAGIC
+
+
+def loads(data, lazy=False):
+    """
+    Model from a bundle, with lazy=True a stand-in that rebuilds the model on first use
+    """
+    if lazy:
+        return LazyModel(data)
+
+    data = memoryview(data)
+    magic, version, codec, n_sections = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a model bundle')
+    if version > FORMAT_VERSION:
+        raise ValueError('Model bundle format ' + str(version) + ' is newer than supported')
+    codec = _codec_names[codec]
+
+    offset = _header.size + n_sections * _section.size
+    sections = []
+    for i in range(n_sections):
+        raw, size = _section.unpack_from(data, _header.size + i * _section.size)
+        section = data[offset:offset + size]
+        if codec != 'none':
+            # decompressed buffers are writable
+            section = bytearray(decompress(codec, section, raw))
+        elif i > 0 and section.readonly:
+            section = bytearray(section)
+        sections.append(section)
+        offset += size
+
+    return pickle.loads(sections[0], buffers=sections[1:])
+
+
+def model_of(model):
+    return model
+
+
+class LazyModel(object):
+    """
+    Stand-in for a model in a bundle, decompressed and rebuilt on first attribute access or call
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            logger.debug('Rebuild model from bundle of ' + str(len(self._data)) + ' bytes')
+            self._model = loads(self._data)
+            self._data = None
+        return self._model
+
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def __reduce__(self):
+        # pickled as the model itself
+        return model_of, (self.model,)
+
+    def __repr__(self):
+        if self._model is None:
+            return '<lazy model bundle>'
+        return repr(self._model)
@@ -0,0 +1,385 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Compact mergeable sketches to summarize data streams with bounded memory
+"""
+
+import base64
+import logging
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+#
+# KLL quantile sketch
+#   Karnin, Lang, Liberty - Optimal Quantile Approximation in Streams, https://arxiv.org/abs/1603.05346
+#   following the reference implementation https://github.com/edoliberty/streaming-quantiles
+#
+# Level h holds items of weight 2**h, the capacity of a level shrinks geometrically with its depth so
+#   the memory of a sketch stays bounded by about k / (1 - c) items regardless of the number of updates
+#
+class KLLSketch(object):
+    """
+    Streaming quantile sketch with bounded memory, can be updated with batches and merged
+    """
+
+    _magic = b'MKLL'
+    _version = 1
+    _header = struct.Struct('<4sBIdQI')
+
+    def __init__(self, k=200, c=2.0 / 3.0, seed=None):
+        self.k = int(k)
+        self.c = c
+        self.n = 0
+        self.compactors = []
+        self.max_size = 0
+        self.rng = np.random.default_rng(seed)
+        self.grow()
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def size(self):
+        return sum(compactor.size for compactor in self.compactors)
+
+    def capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(np.ceil(self.c ** depth * self.k)) + 1
+
+    def grow(self):
+        self.compactors.append(np.array([], dtype=np.float64))
+        self.max_size = sum(self.capacity(height) for height in range(len(self.compactors)))
+
+    def update(self, values):
+        """
+        Add a batch of values, NaNs are ignored
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, )
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self.n += values.size
+        self.compress()
+        return self
+
+    def compress(self):
+        while self.size >= self.max_size:
+            for height in range(len(self.compactors)):
+                if self.compactors[height].size >= self.capacity(height):
+                    if height + 1 >= len(self.compactors):
+                        self.grow()
+                    self.compact(height)
+                    if self.size < self.max_size:
+                        break
+
+    def compact(self, height):
+        # sort the level and promote every other item with doubled weight, an odd item stays behind
+        items = np.sort(self.compactors[height])
+        keep = items[-1:] if items.size % 2 == 1 else items[:0]
+        items = items[:items.size - keep.size]
+        offset = self.rng.integers(0, 2)
+        self.compactors[height + 1] = np.concatenate([self.compactors[height + 1], items[offset::2]])
+        self.compactors[height] = keep
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height] = np.concatenate([self.compactors[height], compactor])
+        self.n += other.n
+        self.compress()
+        return self
+
+    def weighted_items(self):
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(compactor.size, 2 ** height, dtype=np.float64)
+                                  for height, compactor in enumerate(self.compactors)])
+        order = np.argsort(items, kind='mergesort')
+        return items[order], weights[order]
+
+    def quantile(self, q):
+        """
+        Approximate quantile(s) of all values seen so far, NaN for an empty sketch
+        """
+        q = np.asarray(q, dtype=np.float64)
+        items, weights = self.weighted_items()
+        if items.size == 0:
+            return np.full(q.shape, np.nan) if q.ndim > 0 else np.nan
+
+        cumulative = np.cumsum(weights)
+        idx = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        return items[np.minimum(idx, items.size - 1)]
+
+    def cdf(self, x):
+        """
+        Approximate fraction of values <= x
+        """
+        items, weights = self.weighted_items()
+        if items.size == 0:
+            return np.nan
+        cumulative = np.cumsum(weights)
+        idx = np.searchsorted(items, x, side='right')
+        return np.where(idx > 0, cumulative[np.maximum(idx - 1, 0)], 0) / cumulative[-1]
+
+    def to_bytes(self):
+        header = self._header.pack(self._magic, self._version, self.k, self.c, self.n, len(self.compactors))
+        sizes = np.array([compactor.size for compactor in self.compactors], dtype='<u4')
+        return header + sizes.tobytes() + np.concatenate(self.compactors).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, seed=None):
+        magic, version, k, c, n, levels = cls._header.unpack_from(data, 0)
+        if magic != cls._magic or version != cls._version:
+            raise ValueError('KLLSketch: not a quantile sketch or unsupported version')
+        offset = cls._header.size
+        sizes = np.frombuffer(data, dtype='<u4', count=levels, offset=offset).astype(np.int64)
+        items = np.frombuffer(data, dtype='<f8', count=int(sizes.sum()), offset=offset + 4 * levels)
+
+        sketch = cls(k=k, c=c, seed=seed)
+        while len(sketch.compactors) < levels:
+            sketch.grow()
+        sketch.compactors = [items[start:start + size].copy()
+                             for start, size in zip(np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes)]
+        sketch.n = n
+        return sketch
+
+    def encode(self):
+        """
+        Text encoding to store a sketch in a string column
+        """
+        return base64.b64encode(self.to_bytes()).decode('ascii')
+
+    @classmethod
+    def decode(cls, text, seed=None):
+        return cls.from_bytes(base64.b64decode(text), seed=seed)
+
+
+#
+# Histogram sketch
+#   fixed: counts over equal width bins between low and high plus underflow and overflow counts
+#   log: counts over logarithmic buckets with relative accuracy alpha, bucket i covers (gamma**(i-1), gamma**i]
+#     with gamma = (1 + alpha) / (1 - alpha), separately for positive and negative values, like DDSketch
+#     (Masson, Rim, Lee - DDSketch, https://arxiv.org/abs/1908.10693)
+#
+# Sketches with the same kind and parameters merge by adding counts, so hourly sketches roll up to days and weeks
+#   Encoded as base64 text of a fixed header (kind, parameters, count, min, max, sum) and the non empty buckets
+#
+class HistogramSketch(object):
+    """
+    Mergeable histogram with fixed edges or logarithmic buckets
+    """
+
+    kinds = ['fixed', 'log']
+
+    _magic = b'MMHS'
+    _version = 1
+    _header = struct.Struct('<4sBBdddQddd')
+
+    # values closer to zero than this are counted as zero by log sketches
+    min_value = 1e-12
+
+    def __init__(self, kind='log', low=0.0, high=1.0, bins=15, relative_accuracy=0.01):
+        if kind not in self.kinds:
+            raise ValueError('HistogramSketch: unknown kind ' + str(kind))
+        self.kind = kind
+        self.low = float(low)
+        self.high = float(high)
+        self.bins = int(bins)
+        self.relative_accuracy = float(relative_accuracy)
+
+        self.n = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.total = 0.0
+
+        # fixed: bins + 2 counts with underflow first and overflow last, log: bucket index -> count
+        self.counts = np.zeros(self.bins + 2, dtype=np.int64) if kind == 'fixed' else None
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def gamma(self):
+        return (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+
+    def parameters(self):
+        if self.kind == 'fixed':
+            return (self.kind, self.low, self.high, self.bins)
+        return (self.kind, self.relative_accuracy)
+
+    def update(self, values):
+        """
+        Add a batch of values, NaNs are ignored
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, )
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+
+        self.n += values.size
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self.total += values.sum()
+
+        if self.kind == 'fixed':
+            index = np.floor((values - self.low) / (self.high - self.low) * self.bins)
+            # high belongs to the last bin like with np.histogram
+            index[values == self.high] = self.bins - 1
+            index = np.clip(index, -1, self.bins).astype(np.int64) + 1
+            self.counts += np.bincount(index, minlength=self.bins + 2)
+            return self
+
+        magnitude = np.abs(values)
+        self.zero += int(np.count_nonzero(magnitude < self.min_value))
+        for buckets, selected in [(self.positive, values >= self.min_value), (self.negative, values <= -self.min_value)]:
+            keys, counts = np.unique(np.ceil(np.log(magnitude[selected]) / np.log(self.gamma)).astype(np.int64),
+                                     return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                buckets[key] = buckets.get(key, 0) + count
+        return self
+
+    def merge(self, other):
+        """
+        Merge another sketch with the same kind and parameters into this one
+        """
+        if self.parameters() != other.parameters():
+            raise ValueError('HistogramSketch: cannot merge ' + str(other.parameters()) + ' into ' +
+                             str(self.parameters()))
+
+        self.n += other.n
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.total += other.total
+
+        if self.kind == 'fixed':
+            self.counts += other.counts
+            return self
+
+        self.zero += other.zero
+        for buckets, other_buckets in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for key, count in other_buckets.items():
+                buckets[key] = buckets.get(key, 0) + count
+        return self
+
+    def histogram(self):
+        """
+        Buckets and counts in ascending order of values
+          fixed sketches return the bins + 1 edges and leave out underflow and overflow,
+          log sketches return lower and upper bound of each non empty bucket and the zero bucket
+        """
+        if self.kind == 'fixed':
+            return np.linspace(self.low, self.high, self.bins + 1), self.counts[1:-1].copy()
+
+        negative = sorted(self.negative.items(), reverse=True)
+        positive = sorted(self.positive.items())
+        lower = ([-self.gamma ** key for key, _ in negative] + [-self.min_value] +
+                 [self.gamma ** (key - 1) for key, _ in positive])
+        upper = ([-self.gamma ** (key - 1) for key, _ in negative] + [self.min_value] +
+                 [self.gamma ** key for key, _ in positive])
+        counts = [count for _, count in negative] + [self.zero] + [count for _, count in positive]
+        return np.column_stack([lower, upper]), np.array(counts, dtype=np.int64)
+
+    def quantile(self, q):
+        """
+        Approximate quantile(s) from bucket midpoints, NaN for an empty sketch
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan) if q.ndim > 0 else np.nan
+
+        edges, counts = self.histogram()
+        if self.kind == 'fixed':
+            lower, upper = edges[:-1], edges[1:]
+            # underflow and overflow are represented by the observed minimum and maximum
+            lower = np.concatenate([[self.minimum], lower, [self.high]])
+            upper = np.concatenate([[self.low], upper, [self.maximum]])
+            counts = self.counts
+        else:
+            lower, upper = edges[:, 0], edges[:, 1]
+
+        cumulative = np.cumsum(counts)
+        idx = np.minimum(np.searchsorted(cumulative, q * self.n, side='left'), counts.size - 1)
+        return np.clip((lower[idx] + upper[idx]) / 2, self.minimum, self.maximum)
+
+    def to_bytes(self):
+        kind = self.kinds.index(self.kind)
+        header = self._header.pack(self._magic, self._version, kind, self.low, self.high, self.relative_accuracy,
+                                   self.n, self.minimum, self.maximum, self.total)
+        if self.kind == 'fixed':
+            keys = np.flatnonzero(self.counts)
+            counts = self.counts[keys]
+            buckets = [(keys, counts)]
+        else:
+            buckets = [(np.array(list(b.keys()), dtype=np.int64), np.array(list(b.values()), dtype=np.int64))
+                       for b in [self.positive, self.negative]]
+            buckets.append((np.zeros(1, dtype=np.int64), np.array([self.zero], dtype=np.int64)))
+
+        # counts as 32 bit unless a bucket does not fit
+        wide = any(counts.size > 0 and counts.max() >= 2 ** 32 for _, counts in buckets)
+        body = [struct.pack('<IB', self.bins, wide)]
+        for keys, counts in buckets:
+            body.append(struct.pack('<I', keys.size))
+            body.append(keys.astype('<i4').tobytes())
+            body.append(counts.astype('<u8' if wide else '<u4').tobytes())
+        return header + b''.join(body)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, kind, low, high, relative_accuracy, n, minimum, maximum, total = \
+            cls._header.unpack_from(data, 0)
+        if magic != cls._magic or version != cls._version:
+            raise ValueError('HistogramSketch: not a histogram sketch or unsupported version')
+        offset = cls._header.size
+        bins, wide = struct.unpack_from('<IB', data, offset)
+        offset += 5
+
+        sketch = cls(kind=cls.kinds[kind], low=low, high=high, bins=bins, relative_accuracy=relative_accuracy)
+        sketch.n, sketch.minimum, sketch.maximum, sketch.total = n, minimum, maximum, total
+
+        buckets = []
+        for _ in range(1 if sketch.kind == 'fixed' else 3):
+            size, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            keys = np.frombuffer(data, dtype='<i4', count=size, offset=offset).astype(np.int64)
+            offset += 4 * size
+            counts = np.frombuffer(data, dtype='<u8' if wide else '<u4', count=size, offset=offset).astype(np.int64)
+            offset += (8 if wide else 4) * size
+            buckets.append((keys, counts))
+
+        if sketch.kind == 'fixed':
+            sketch.counts[buckets[0][0]] = buckets[0][1]
+        else:
+            sketch.positive = dict(zip(buckets[0][0].tolist(), buckets[0][1].tolist()))
+            sketch.negative = dict(zip(buckets[1][0].tolist(), buckets[1][1].tolist()))
+            sketch.zero = int(buckets[2][1][0])
+        return sketch
+
+    def encode(self):
+        """
+        Text encoding to store a sketch in a string column
+        """
+        return base64.b64encode(self.to_bytes()).decode('ascii')
+
+    @classmethod
+    def decode(cls, text):
+        return cls.from_bytes(base64.b64decode(text))
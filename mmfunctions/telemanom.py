@@ -9,14 +9,26 @@ from iotfunctions.ui import (UIMultiItem)
 # from sklearn.utils.validation import check_X_y  # , check_array, check_is_fitted
 import logging
 import pandas as pd
-import more_itertools as mit
 import os
 import yaml
 
-from keras.models import Sequential, load_model
-from keras.callbacks import History, EarlyStopping
-from keras.layers.recurrent import LSTM
-from keras.layers.core import Dense, Activation, Dropout
+from mmfunctions.lazy import lazy_attribute, lazy_import
+from mmfunctions.modelstore import model_cache
+from mmfunctions.parallel import prefetched_models, train_entities
+from mmfunctions.timing import stage, stage_timing
+
+# keras and tensorflow are imported when a model is first built or loaded
+Sequential = lazy_attribute('keras.models', 'Sequential')
+load_model = lazy_attribute('keras.models', 'load_model')
+History = lazy_attribute('keras.callbacks', 'History')
+EarlyStopping = lazy_attribute('keras.callbacks', 'EarlyStopping')
+LSTM = lazy_attribute('keras.layers.recurrent', 'LSTM')
+Dense = lazy_attribute('keras.layers.core', 'Dense')
+Activation = lazy_attribute('keras.layers.core', 'Activation')
+Dropout = lazy_attribute('keras.layers.core', 'Dropout')
+
+# anomaly sequences are grouped with more_itertools when scoring
+mit = lazy_import('more_itertools')
 
 # suppress tensorflow CPU speedup warnings
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -954,6 +966,10 @@ class LSTMRegressor(BaseEstimatorFunction):
     num_rounds_per_estimator = 1
     test_size = 0.05
 
+    # number of processes and threads per process to train entities in parallel
+    n_jobs = 1
+    threads_per_job = 1
+
     def LSTMPipeline(self):
         tconf = TelemanomConfig('./config.yaml')
         steps = [('scaler', StandardScaler()), ('lstm', TelemanomEstimator(tconf))]
@@ -984,6 +1000,8 @@ class LSTMRegressor(BaseEstimatorFunction):
         self.estimator = estimator
         return estimator
 
+    @stage_timing
+    @model_cache
     def execute(self, df):
 
         df_copy = df.copy()
@@ -994,15 +1012,21 @@ class LSTMRegressor(BaseEstimatorFunction):
         for m in missing_cols:
             df_copy[m] = None
 
+        # train entities without a model over a process pool, the loop below only predicts them
+        with stage(self, 'fit'):
+            train_entities(self, df_copy, entities)
+
         for entity in entities:
             # per entity - copy for later inplace operations
             # dfe = df_copy.loc[[entity]].dropna(how='all')
             # dfe = df_copy.loc[[entity]].copy()
             # try:
-                dfe = super()._execute(df_copy.loc[[entity]], entity)
+                with stage(self, 'score', entity), prefetched_models(self, entity):
+                    dfe = super()._execute(df_copy.loc[[entity]], entity)
                 print(df_copy.columns)
                 # for c in self.predictions:
-                df_copy.loc[entity, self.predictions] = dfe[self.predictions]
+                with stage(self, 'write_back', entity):
+                    df_copy.loc[entity, self.predictions] = dfe[self.predictions]
                 # df_copy = df_copy.loc[[entity]] = dfe
                 print(df_copy.columns)
             # except Exception as e:
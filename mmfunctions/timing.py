@@ -0,0 +1,252 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Per-stage timings of pipeline functions
+
+Functions mark the stages of their execute method - data preparation, windowing, model fit, scoring,
+merging scores back, writing to the result frame - with
+
+    with stage(self, 'fit', entity):
+        ...
+
+and decorate execute with stage_timing. Stages nest, a stage is charged the time of its block less the time of
+the stages inside it, so the stage times of a run add up to at most its duration. Timing is off by default, then
+stage() hands out a shared no-op context manager. Switch it on with enable() or the environment variable
+MMFUNCTIONS_TIMING=1: each run then appends a summary with per-stage totals and the slowest entities per stage
+to the function trace, keeps it in recent_runs and adds it to the totals since process start and, with
+MMFUNCTIONS_TIMING_FILE or enable(path=...), writes the recent runs to a JSON file or the totals to an
+OpenMetrics text file.
+"""
+
+import contextlib
+import copy
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+enabled = os.environ.get('MMFUNCTIONS_TIMING', '0') not in ['', '0', 'false', 'False']
+export_path = os.environ.get('MMFUNCTIONS_TIMING_FILE')
+
+# summaries of the latest runs, oldest first
+recent_runs = deque(maxlen=256)
+_export_lock = threading.Lock()
+
+# calls and seconds per function and stage of all runs since process start, they only grow
+cumulative = OrderedDict()
+_cumulative_lock = threading.Lock()
+
+# entities listed per stage in a summary
+top_entities = 5
+
+_no_timing = contextlib.nullcontext()
+
+
+def enable(on=True, path=None):
+    """
+    Switch stage timing on or off, with path the recent runs are written there after every run
+    """
+    global enabled, export_path
+    enabled = on
+    if path is not None:
+        export_path = path
+
+
+class StageTimings(object):
+    """
+    Stage timings of one function run, per stage and per entity
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.stages = OrderedDict()
+        self.entities = {}
+        self.started = time.perf_counter()
+        self.seconds = None
+        # stages entered and not left yet, innermost last
+        self.active = []
+
+    def add(self, stage, entity, seconds):
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = [0, 0.0, 0.0]
+            self.entities[stage] = {}
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+        if entity is not None:
+            by_entity = self.entities[stage]
+            by_entity[entity] = by_entity.get(entity, 0.0) + seconds
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+
+    def summary(self):
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.started
+        stages = OrderedDict()
+        for stage, (calls, total, longest) in self.stages.items():
+            slowest = sorted(self.entities[stage].items(), key=lambda item: item[1], reverse=True)[:top_entities]
+            stages[stage] = {'calls': calls, 'seconds': total, 'max': longest,
+                             'share': total / seconds if seconds > 0 else 0.0,
+                             'slowest_entities': [[str(entity), t] for entity, t in slowest]}
+        return {'function': self.function, 'timestamp': time.time(), 'seconds': seconds, 'stages': stages}
+
+
+class Stage(object):
+    """
+    Context manager adding the time spent in its block, less the time of nested stages, to a stage
+    """
+    __slots__ = ['timings', 'stage', 'entity', 'start', 'nested']
+
+    def __init__(self, timings, stage, entity):
+        self.timings = timings
+        self.stage = stage
+        self.entity = entity
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.timings.active.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        active = self.timings.active
+        active.pop()
+        if len(active) > 0:
+            active[-1].nested += seconds
+        self.timings.add(self.stage, self.entity, seconds - self.nested)
+        return False
+
+
+def stage(function, name, entity=None):
+    """
+    Timer for a stage of the running function, a no-op unless timing is on
+    """
+    timings = getattr(function, '_stage_timings', None)
+    if timings is None:
+        return _no_timing
+    return Stage(timings, name, entity)
+
+
+def format_summary(summary):
+    return summary['function'] + ' ' + '%.3fs' % summary['seconds'] + ': ' + ', '.join(
+        stage + ' %.3fs' % totals['seconds'] for stage, totals in summary['stages'].items())
+
+
+def stage_timing(execute):
+    """
+    Decorator for execute - collects the stage timings of a run and reports them when timing is on.
+    Nested calls, like a subclass calling execute of its base class, count for the outer run.
+    """
+
+    @functools.wraps(execute)
+    def timed_execute(self, df, *args, **kwargs):
+        if not enabled or getattr(self, '_stage_timings', None) is not None:
+            return execute(self, df, *args, **kwargs)
+
+        timings = StageTimings(self.__class__.__name__)
+        self._stage_timings = timings
+        try:
+            return execute(self, df, *args, **kwargs)
+        finally:
+            self._stage_timings = None
+            timings.finish()
+            report(self, timings.summary())
+
+    return timed_execute
+
+
+def report(function, summary):
+    recent_runs.append(summary)
+    with _cumulative_lock:
+        add_totals(cumulative, summary)
+    msg = 'Stage timings ' + format_summary(summary)
+    logger.debug(msg)
+    try:
+        function.trace_append(msg=msg, stage_timings=summary)
+    except Exception as e:
+        logger.debug('Trace append failed with ' + str(e))
+    if export_path is not None:
+        try:
+            export(export_path)
+        except Exception as e:
+            logger.error('Export of stage timings to ' + str(export_path) + ' failed with ' + str(e))
+
+
+def add_totals(result, summary):
+    function = result.setdefault(summary['function'], {'runs': 0, 'seconds': 0.0, 'stages': OrderedDict()})
+    function['runs'] += 1
+    function['seconds'] += summary['seconds']
+    for stage, stage_totals in summary['stages'].items():
+        counts = function['stages'].setdefault(stage, {'calls': 0, 'seconds': 0.0})
+        counts['calls'] += stage_totals['calls']
+        counts['seconds'] += stage_totals['seconds']
+
+
+def totals(summaries=None):
+    """
+    Calls and seconds per function and stage over the given runs, over all runs since process start without
+    """
+    if summaries is None:
+        with _cumulative_lock:
+            return copy.deepcopy(cumulative)
+
+    result = OrderedDict()
+    for summary in summaries:
+        add_totals(result, summary)
+    return result
+
+
+def openmetrics(summaries=None):
+    """
+    Totals over runs in OpenMetrics text format - counters of all runs since process start by default,
+    recent_runs only holds the latest runs
+    """
+    aggregated = totals(summaries)
+    lines = ['# TYPE mmfunctions_function_runs counter',
+             '# HELP mmfunctions_function_runs Function runs with stage timing.']
+    lines += ['mmfunctions_function_runs_total{function="%s"} %d' % (f, t['runs']) for f, t in aggregated.items()]
+    lines += ['# TYPE mmfunctions_function_seconds counter', '# UNIT mmfunctions_function_seconds seconds',
+              '# HELP mmfunctions_function_seconds Time spent in execute.']
+    lines += ['mmfunctions_function_seconds_total{function="%s"} %.9g' % (f, t['seconds'])
+              for f, t in aggregated.items()]
+    lines += ['# TYPE mmfunctions_stage_seconds counter', '# UNIT mmfunctions_stage_seconds seconds',
+              '# HELP mmfunctions_stage_seconds Time spent in a stage of execute.']
+    lines += ['mmfunctions_stage_seconds_total{function="%s",stage="%s"} %.9g' % (f, s, c['seconds'])
+              for f, t in aggregated.items() for s, c in t['stages'].items()]
+    lines += ['# TYPE mmfunctions_stage_calls counter', '# HELP mmfunctions_stage_calls Entries into a stage.']
+    lines += ['mmfunctions_stage_calls_total{function="%s",stage="%s"} %d' % (f, s, c['calls'])
+              for f, t in aggregated.items() for s, c in t['stages'].items()]
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def export(path, summaries=None):
+    """
+    Write the runs to path - a list of the recent run summaries for .json, OpenMetrics text of the totals otherwise
+    """
+    if path.endswith('.json'):
+        text = json.dumps(list(recent_runs if summaries is None else summaries), indent=1)
+    else:
+        text = openmetrics(summaries)
+
+    # replace the file, a scraper never sees half of it
+    with _export_lock:
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
@@ -0,0 +1,140 @@
+# *****************************************************************************
+# © Copyright IBM Corp. 2018-2020.  All Rights Reserved.
+#
+# This program and the accompanying materials
+# are made available under the terms of the Apache V2.0
+# which accompanies this distribution, and is available at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# *****************************************************************************
+
+"""
+Variational inference model of VIAnomalyScore, kept apart from mmfunctions.anomaly so torch is only
+imported by functions that use it
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+# from https://www.ritchievink.com/blog/2019/09/16/variational-inference-from-scratch/
+#   usual ELBO with standard prior N(0,1), standard reparametrization
+
+# helper function
+def ll_gaussian(y, mu, log_var):
+    sigma = torch.exp(0.5 * log_var)
+    return -0.5 * torch.log(2 * np.pi * sigma**2) - (1 / (2 * sigma**2))* (y-mu)**2
+
+def l_gaussian(y, mu, log_var):
+    sigma = torch.exp(0.5 * log_var)
+    return 1/torch.sqrt(2 * np.pi * sigma**2) / torch.exp((1 / (2 * sigma**2))* (y-mu)**2)
+
+def kl_div(mu1, mu2, lg_sigma1, lg_sigma2):
+    return 0.5 * (2 * lg_sigma2 - 2 * lg_sigma1 + (lg_sigma1.exp() ** 2 + (mu1 - mu2)**2)/lg_sigma2.exp()**2 - 1)
+
+class VI(nn.Module):
+    def __init__(self, scaler, prior_mu=0.0, prior_sigma=1.0, beta=1.0, adjust_mean=0.0, version=None):
+        self.prior_mu = prior_mu
+        self.prior_sigma = prior_sigma
+        self.beta = beta
+        self.onnx_session = None
+        self.version = version
+        self.build_time = pd.Timestamp.now()
+        self.scaler = scaler
+        self.show_once = True
+        self.adjust_mean = adjust_mean
+        super().__init__()
+
+        self.q_mu = nn.Sequential(
+            nn.Linear(1, 20),
+            nn.ReLU(),
+            nn.Linear(20, 10),
+            nn.ReLU(),
+            nn.Linear(10, 1)
+        )
+
+        self.q_log_var = nn.Sequential(
+            nn.Linear(1, 50),    # more parameters for sigma
+            nn.ReLU(),
+            nn.Linear(50, 35),
+            nn.ReLU(),
+            nn.Linear(35, 10),
+            nn.ReLU(),
+            nn.Linear(10, 1)
+        )
+
+    # draw from N(mu, sigma)
+    def reparameterize(self, mu, log_var):
+        # std can not be negative, thats why we use log variance
+        sigma = torch.exp(0.5 * log_var) + 1e-7
+        eps = torch.randn_like(sigma)
+        return mu + sigma * eps
+
+    # sample from the one-dimensional normal distribution N(mu, exp(log_var))
+    def forward(self, x):
+        mu = self.q_mu(x)
+        log_var = self.q_log_var(x)
+        return self.reparameterize(mu, log_var), mu, log_var
+
+    # see 2.3 in https://arxiv.org/pdf/1312.6114.pdf
+    def elbo(self, y_pred, y, mu, log_var):
+        # likelihood of observing y given Variational mu and sigma - reconstruction error
+        loglikelihood = ll_gaussian(y, mu, log_var)
+
+        # KL - prior probability of y_pred N(0,1)
+        log_prior = ll_gaussian(y_pred, self.prior_mu, torch.log(torch.tensor(self.prior_sigma)))
+
+        # KL - variational probability of y_pred
+        log_p_q = ll_gaussian(y_pred, mu, log_var)
+
+        if self.show_once:
+            logger.info('Cardinalities: Mu: ' + str(mu.shape) + ' Sigma: ' + str(log_var.shape) +
+                        ' loglikelihood: ' + str(loglikelihood.shape) + ' KL value: ' +
+                        str((log_prior - log_p_q).mean()))
+
+        # by taking the mean we approximate the expectation according to the law of large numbers
+        return (loglikelihood + self.beta * (log_prior - log_p_q)).mean()
+
+    # simplified when everything is Gaussian
+    #  KL(q, p) = \log \frac{\sigma_1}{\sigma_2} + \frac{\sigma_2^2 + (\mu_2 - \mu_1)^2}{2 \sigma_1^2} - \frac{1}{2}
+    # unfortunately I don't get it to work properly
+    def elbo_gauss(self, y, y_pred, mu, log_var):
+        # likelihood of observing y given Variational mu and sigma - reconstruction error
+        loglikelihood = ll_gaussian(y, mu, log_var)
+
+        #kl_divergence = kl_div(mu, torch.tensor(self.prior_mu), log_var, torch.log(torch.tensor(self.prior_sigma)))
+        #  see 3 - https://arxiv.org/pdf/1312.6114.pdf
+        kl_divergence = (-0.5 * torch.sum(1 + log_var - mu**2 - log_var.exp()))
+
+        if self.show_once:
+            self.show_once = False
+            logger.info('Cardinalities: Mu: ' + str(mu.shape) + ' Sigma: ' + str(log_var.shape) +
+                        ' loglikelihood: ' + str(loglikelihood.shape) + ' KL: ' + str(kl_divergence.shape) +
+                        ' KL value: ' + str(kl_divergence))
+
+        return loglikelihood.mean() - kl_divergence
+
+
+    # Unfinished - the stuff here is crap !
+    def iwae(self, y_pred, y, mu, log_var):
+        # likelihood of observing y given Variational mu and sigma
+        likelihood = l_gaussian(y, mu, log_var)
+
+        # prior probability of y_pred N(0,1)
+        log_prior = ll_gaussian(y_pred, self.prior_mu, torch.log(torch.tensor(self.prior_sigma)))
+
+        # variational probability of y_pred
+        log_p_q = ll_gaussian(y_pred, mu, log_var)
+
+        # by taking the mean we approximate the expectation according to the law of large numbers
+        return (likelihood + self.beta * (log_prior - log_p_q)).mean()
+
+    # Minimizing negative ELBO
+    def det_loss_old(self, y_pred, y, mu, log_var):
+        return -elbo(y_pred, y, mu, log_var)
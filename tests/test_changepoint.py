@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, Float
+from mmfunctions.anomaly import OnlineChangePoint, ChangePointSegmentation
+from mmfunctions.changepoint import detectors, ChangePointState, detect_change_points
+from nose.tools import assert_true
+
+# constants
+Temperature = 'Temperature'
+
+
+def make_frame():
+    rng = np.random.default_rng(42)
+    frames = []
+    for i, entity in enumerate(['Pump1', 'Pump2', 'Pump3']):
+        ts = pd.date_range('2021-01-01', periods=400, freq='min')
+        values = rng.normal(10 * i, 1 + i, 400)
+        # level shift by 5 standard deviations half way
+        values[200:] += 5 * (1 + i)
+        frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts, Temperature: values}))
+    return pd.concat(frames).set_index(['entity', 'timestamp'])
+
+
+def test_online_change_point():
+
+    df_i = make_frame()
+
+    for method in ['CUSUM', 'Page-Hinkley', 'Bayesian']:
+        print('Detect change points with ' + method)
+        detector = OnlineChangePoint(Temperature, method=method)
+        et = detector._build_entity_type(columns=[Column(Temperature, Float())])
+        detector._entity_type = et
+        df_o = detector.execute(df=df_i)
+
+        for entity in ['Pump1', 'Pump2', 'Pump3']:
+            change_points = np.flatnonzero(df_o.loc[entity]['change_point'].values)
+            assert_true(np.any((change_points >= 200) & (change_points < 210)))
+            assert_true(not np.any(change_points < 200))
+
+
+def test_change_point_state():
+
+    df_i = make_frame()
+    timestamps = df_i.index.get_level_values(1)
+
+    for name, detector in detectors.items():
+        print('Detect change points with ' + name + ' in overlapping batches')
+        flags, run_lengths = detect_change_points(ChangePointState(detector()), df_i.index, df_i[Temperature].values)
+
+        # rows already processed are skipped, the state carries over
+        state = ChangePointState(detector())
+        batch_flags = np.zeros_like(flags)
+        batch_run_lengths = np.full(run_lengths.shape, np.nan)
+        for start, stop in [(0, 150), (100, 300), (300, 400)]:
+            batch = (timestamps >= timestamps[start]) & (timestamps <= timestamps[stop - 1])
+            f, r = detect_change_points(state, df_i.index[batch], df_i[Temperature].values[batch])
+            batch_flags[np.flatnonzero(batch)[~np.isnan(r)]] = f[~np.isnan(r)]
+            batch_run_lengths[np.flatnonzero(batch)[~np.isnan(r)]] = r[~np.isnan(r)]
+
+        assert_true(np.array_equal(flags, batch_flags))
+        assert_true(np.allclose(run_lengths, batch_run_lengths))
+        assert_true(all(array.shape[0] == 3 for array in state.arrays.values()))
+
+
+def test_change_point_uneven_entities():
+
+    # entities with different numbers of rows in shuffled frame order, with missing values
+    df_i = make_frame()
+    df_i = df_i[~((df_i.index.get_level_values(0) == 'Pump2') & (np.arange(df_i.shape[0]) % 400 >= 250))]
+    df_i = df_i.drop(index='Pump3').iloc[::-1].sample(frac=1, random_state=0)
+    df_i = pd.concat([df_i, make_frame().loc[['Pump3']].iloc[:90]])
+    df_i.iloc[[3, 77], 0] = np.nan
+
+    for name, detector in detectors.items():
+        flags, run_lengths = detect_change_points(ChangePointState(detector()), df_i.index, df_i[Temperature].values)
+
+        # all entities at once give the results of one entity at a time
+        for entity in ['Pump1', 'Pump2', 'Pump3']:
+            rows = np.flatnonzero(df_i.index.get_level_values(0) == entity)
+            f, r = detect_change_points(ChangePointState(detector()), df_i.index[rows],
+                                        df_i[Temperature].values[rows])
+            assert_true(np.array_equal(flags[rows], f) and np.allclose(run_lengths[rows], r))
+        assert_true(not np.isnan(run_lengths).any())
+
+
+def test_change_point_segmentation():
+
+    df_i = make_frame()
+    df_i.iloc[[10, 500], 0] = np.nan
+
+    for method in ['pelt', 'binseg']:
+        print('Segment with ' + method)
+        segmentation = ChangePointSegmentation(Temperature, method=method)
+        et = segmentation._build_entity_type(columns=[Column(Temperature, Float())])
+        segmentation._entity_type = et
+        df_o = segmentation.execute(df=df_i)
+
+        for entity in ['Pump1', 'Pump2', 'Pump3']:
+            assert_true(np.array_equal(np.flatnonzero(df_o.loc[entity]['change_point'].values), [200]))
+            assert_true(np.array_equal(np.unique(df_o.loc[entity]['segment'].values), [0, 1]))
+
+
+# uncomment to run from the command line
+# test_online_change_point()
+# test_change_point_state()
+# test_change_point_uneven_entities()
+# test_change_point_segmentation()
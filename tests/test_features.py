@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.preprocessing import PolynomialFeatures
+from mmfunctions.features import PolynomialExpansion, EntityGroups, TailState, lag_matrix, feature_family, \
+    group_histograms
+from nose.tools import assert_true
+
+
+def test_polynomial_expansion():
+
+    X = np.random.default_rng(42).normal(size=(100, 5))
+
+    for interaction_only in [False, True]:
+        for include_bias in [False, True]:
+            print('Expand with interaction_only=' + str(interaction_only) + ', include_bias=' + str(include_bias))
+            expected = PolynomialFeatures(degree=3, interaction_only=interaction_only,
+                                          include_bias=include_bias).fit_transform(X)
+            expansion = PolynomialExpansion(degree=3, interaction_only=interaction_only, include_bias=include_bias)
+            assert_true(np.allclose(expansion.fit_transform(X), expected))
+
+    # fit and predict on the same batch share the expansion
+    expansion = PolynomialExpansion(degree=3, dtype=np.float32)
+    Xe = expansion.fit_transform(X)
+    assert_true(Xe.dtype == np.float32)
+    assert_true(expansion.transform(X.copy()) is Xe)
+    # the shared expansion cannot be modified in place
+    assert_true(not Xe.flags.writeable)
+    try:
+        Xe *= 2
+        assert_true(False)
+    except ValueError:
+        pass
+    assert_true(np.allclose(expansion.transform(X), PolynomialFeatures(degree=3).fit_transform(X), atol=1e-4))
+    assert_true(expansion.transform(X[:50]) is not Xe)
+
+    # mostly zero features expand to a sparse matrix of the nonzeros, from dense or sparse input
+    X_zeros = X * (np.random.default_rng(0).random(X.shape) < 0.2)
+    for interaction_only in [False, True]:
+        expected = PolynomialFeatures(degree=3, interaction_only=interaction_only).fit_transform(X_zeros)
+        for X_in in [X_zeros, scipy.sparse.csr_matrix(X_zeros)]:
+            expansion = PolynomialExpansion(degree=3, interaction_only=interaction_only, sparse=True)
+            Xe = expansion.fit_transform(X_in)
+            assert_true(scipy.sparse.isspmatrix_csr(Xe) and Xe.nnz == np.count_nonzero(expected))
+            assert_true(np.allclose(Xe.toarray(), expected))
+            assert_true(expansion.transform(X_in) is Xe and not Xe.data.flags.writeable)
+
+
+def test_lag_matrix():
+
+    rng = np.random.default_rng(42)
+    frames = []
+    for entity, periods in [('Pump2', 30), ('Pump1', 20)]:
+        ts = pd.date_range('2021-01-01', periods=periods, freq='h')
+        frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts, 'Temperature': rng.normal(size=periods),
+                                    'Pressure': rng.normal(size=periods)}))
+    df = pd.concat(frames).set_index(['entity', 'timestamp'])
+
+    lags = [2, 1, 0, -1]
+    lagged = lag_matrix(EntityGroups(df.index), df[['Temperature', 'Pressure']].values, lags, dtype=np.float64)
+
+    # lags never cross entity boundaries
+    expected = np.column_stack([df.groupby(level=0)[feature].shift(lag).values
+                                for feature in ['Temperature', 'Pressure'] for lag in lags])
+    assert_true(np.allclose(lagged, expected, equal_nan=True))
+
+
+def test_tail_state():
+
+    rng = np.random.default_rng(42)
+    frames = []
+    for entity in ['Pump1', 'Pump2']:
+        ts = pd.date_range('2021-01-01', periods=100, freq='h')
+        frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts, 'Temperature': rng.normal(size=100)}))
+    df = pd.concat(frames).set_index(['entity', 'timestamp'])
+    expected = df.groupby(level=0)['Temperature'].transform(lambda x: x.rolling(5).mean())
+
+    # rolling means of consecutive batches from the tail of the previous batch
+    state = TailState(['Temperature'], 4)
+    timestamps = df.index.get_level_values(1)
+    for start, stop in [(0, 40), (40, 41), (41, 100)]:
+        batch = df[(timestamps >= timestamps[start]) & (timestamps < timestamps[stop - 1] + pd.Timedelta('1h'))]
+        extended, from_df = state.extend(batch)
+        rolling = extended.groupby(level=0)['Temperature'].transform(lambda x: x.rolling(5).mean())[from_df]
+        state.update(extended)
+
+        assert_true(rolling.shape[0] == batch.shape[0])
+        assert_true(np.allclose(rolling.values, expected.loc[batch.index].values, equal_nan=True))
+
+
+def test_feature_family():
+
+    rng = np.random.default_rng(42)
+    frames = []
+    for entity, periods in [('Pump2', 40), ('Pump1', 25), ('Pump3', 1)]:
+        ts = pd.date_range('2021-01-01', periods=periods, freq='h')
+        frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts,
+                                    'Temperature': rng.normal(1e6, 100, size=periods),
+                                    'Pressure': rng.normal(size=periods)}))
+    df = pd.concat(frames).set_index(['entity', 'timestamp'])
+    df.iloc[[3, 17, 50], 0] = np.nan
+
+    windows = [1, 3, 7]
+    methods = ['mean', 'plain', 'stddev', 'min', 'max']
+    family = feature_family(EntityGroups(df.index), df[['Temperature', 'Pressure']].values, windows, methods)
+
+    # same as pandas rolling over the previous rows of each entity
+    expected = []
+    for feature in ['Temperature', 'Pressure']:
+        for method in methods:
+            if method == 'plain':
+                expected.append(df.groupby(level=0)[feature].shift(1).values)
+                continue
+            for window in windows:
+                expected.append(df.groupby(level=0)[feature].transform(
+                    lambda x: getattr(x.rolling(window, min_periods=0), 'std' if method == 'stddev' else method)()
+                    .shift(1)).values)
+    expected = np.column_stack(expected)
+
+    assert_true(family.shape == expected.shape)
+    assert_true(np.allclose(family, expected, equal_nan=True, atol=1e-6))
+
+
+def test_group_histograms():
+
+    rng = np.random.default_rng(42)
+    codes = rng.integers(0, 50, 5000)
+    values = rng.normal(size=5000)
+    values[codes == 7] = 3.0
+    values[np.flatnonzero(codes == 9)[0]] = np.nan
+
+    density = group_histograms(codes, 51, values, 15, dtype=np.float64)
+
+    for group in range(51):
+        group_values = values[codes == group]
+        if group in [9, 50]:
+            # groups with NaN and empty groups
+            assert_true(np.isnan(density[group]).all())
+            continue
+        spread = group_values.max() - group_values.min()
+        scaled = (group_values - group_values.min()) / (spread if spread > 0 else 1)
+        expected = np.histogram(scaled, bins=15, density=True)[0]
+        assert_true(np.allclose(density[group], expected))
+
+
+# uncomment to run from the command line
+# test_polynomial_expansion()
+# test_lag_matrix()
+# test_tail_state()
+# test_feature_family()
+# test_group_histograms()
@@ -0,0 +1,39 @@
+import json
+import subprocess
+import sys
+from nose.tools import assert_true
+
+# heavy dependencies only the functions using them may import
+heavy_modules = ['torch', 'lightgbm', 'stumpy', 'pyod', 'statsmodels', 'keras', 'tensorflow', 'wiotp',
+                 'iotfunctions.bif', 'scipy.signal']
+
+# seconds on top of importing iotfunctions.base, which every function module needs anyway
+import_budget = 1.5
+
+
+def import_profile(module):
+    script = ('import json, sys, time\n'
+              't = time.perf_counter()\n'
+              'import ' + module + '\n'
+              'seconds = time.perf_counter() - t\n'
+              'print(json.dumps({"seconds": seconds, "loaded": [m for m in ' + repr(heavy_modules) +
+              ' if m in sys.modules]}))\n')
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_import_time():
+
+    reference = min(import_profile('iotfunctions.base')['seconds'] for _ in range(2))
+
+    for module in ['mmfunctions.anomaly', 'mmfunctions.customer', 'mmfunctions.telemanom']:
+        profile = min((import_profile(module) for _ in range(2)), key=lambda profile: profile['seconds'])
+        print('Import ' + module + ' in ' + str(round(profile['seconds'], 2)) + 's, iotfunctions.base in ' +
+              str(round(reference, 2)) + 's')
+
+        assert_true(profile['loaded'] == [])
+        assert_true(profile['seconds'] - reference < import_budget)
+
+
+# uncomment to run from the command line
+# test_import_time()
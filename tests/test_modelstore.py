@@ -0,0 +1,304 @@
+import os
+import subprocess
+import sys
+import tempfile
+import types
+
+import numpy as np
+import pandas as pd
+from iotfunctions.dbtables import FileModelStore
+from sqlalchemy import Column, Float
+from mmfunctions.anomaly import OnlineChangePoint, KDEAnomalyScore, EntityScaler, IncrementalBayesRidge
+from mmfunctions.changepoint import ChangePointState, detectors, detect_change_points
+from mmfunctions.modelstore import CachingModelStore, ModelCache, ModelBatch, LocalModelStore, LocalDatabase, \
+    MISSING, cache_model_store, model_cache
+from nose.tools import assert_true
+
+
+def test_caching_model_store():
+
+    with tempfile.TemporaryDirectory() as path:
+        store = CachingModelStore(FileModelStore(path), ModelCache(max_models=2))
+
+        # write through, then served from the cache - as copies, changes of one caller are not seen by others
+        weights = {'weights': [1, 2]}
+        store.store_model('model.a', weights)
+        weights['weights'].append(0)
+        model = store.retrieve_model('model.a')
+        assert_true(model == {'weights': [1, 2]})
+        model['weights'].append(3)
+        assert_true(store.retrieve_model('model.a') == {'weights': [1, 2]})
+        assert_true(store.counts()['hits'] == 2 and store.counts()['misses'] == 0)
+
+        # another writer changes the stored model - the cached one is stale
+        FileModelStore(path).store_model('model.a', {'weights': [3, 4, 5]})
+        assert_true(store.retrieve_model('model.a') == {'weights': [3, 4, 5]})
+        assert_true(store.counts()['stale'] == 1 and store.counts()['misses'] == 1)
+
+        # least recently used models are evicted, missing models are not retrieved
+        store.store_model('model.b', 'b')
+        store.store_model('model.c', 'c')
+        assert_true(len(store.cache) == 2 and 'model.a' not in store.cache.entries)
+        assert_true(store.retrieve_model('model.missing') is None)
+
+        store.delete_model('model.b')
+        assert_true('model.b' not in store.cache.entries)
+
+
+def test_model_cache_in_functions():
+
+    rng = np.random.default_rng(42)
+    ts = pd.date_range('2021-01-01', periods=100, freq='min')
+    df_i = pd.DataFrame({'entity': 'Pump1', 'timestamp': ts, 'Temperature': rng.normal(size=100)})
+    df_i = df_i.set_index(['entity', 'timestamp'])
+
+    with tempfile.TemporaryDirectory() as path:
+        detector = OnlineChangePoint('Temperature')
+        et = detector._build_entity_type(columns=[Column('Temperature', Float())])
+        et.db = types.SimpleNamespace(model_store=FileModelStore(path), credentials={})
+        detector._entity_type = et
+
+        # the first run stores the detector state, the following runs get it from the cache
+        for run in range(3):
+            detector.execute(df=df_i)
+
+        # the cache is in front of the model store during the runs only
+        assert_true(isinstance(et.db.model_store, FileModelStore))
+        store = cache_model_store(et.db)
+        assert_true(isinstance(store, CachingModelStore))
+        assert_true(store.counts()['hits'] == 2 and store.counts()['stores'] == 3)
+
+
+class FlakyStore(FileModelStore):
+
+    def store_model(self, model_name, model, user_name=None, serialize=True):
+        if model_name.startswith('broken'):
+            raise IOError('disk full')
+        super().store_model(model_name, model, user_name=user_name, serialize=serialize)
+
+
+class DictStore(object):
+    # a model store without a version lookup
+
+    def __init__(self):
+        self.models = {}
+
+    def store_model(self, model_name, model, user_name=None, serialize=True):
+        self.models[model_name] = model
+
+    def retrieve_model(self, model_name, deserialize=True):
+        return self.models.get(model_name)
+
+
+class FailingFunction(object):
+
+    def __init__(self, db):
+        self._entity_type = types.SimpleNamespace(db=db)
+
+    def trace_append(self, msg, **kwargs):
+        pass
+
+    @model_cache
+    def execute(self, df):
+        model = self._entity_type.db.model_store.retrieve_model('model.a')
+        model['weights'].append(df)
+        raise ValueError('fit failed')
+
+
+def test_caching_model_store_invalidation():
+
+    # without a version stored models are reused for ttl seconds only
+    store = CachingModelStore(DictStore(), ttl=60)
+    store.store.store_model('model.a', {'weights': [1]})
+    assert_true(store.retrieve_model('model.a') == store.retrieve_model('model.a') == {'weights': [1]})
+    store.store.store_model('model.a', {'weights': [2]})
+    assert_true(store.retrieve_model('model.a') == {'weights': [1]})
+    store.ttl = 0
+    assert_true(store.retrieve_model('model.a') == {'weights': [2]})
+    assert_true(store.counts()['hits'] == 2 and store.counts()['stale'] == 1)
+
+    # a failed run changed the cached model without storing it - the next run gets the stored one
+    with tempfile.TemporaryDirectory() as path:
+        db = types.SimpleNamespace(model_store=FileModelStore(path), credentials={})
+        db.model_store.store_model('model.a', {'weights': [1]})
+        function = FailingFunction(db)
+        for run in range(2):
+            try:
+                function.execute(df=2)
+            except ValueError:
+                pass
+            assert_true(isinstance(db.model_store, FileModelStore))
+
+        store = cache_model_store(db)
+        assert_true('model.a' not in store.cache.entries)
+        assert_true(store.counts()['hits'] == 0 and store.counts()['misses'] == 2)
+        assert_true(store.retrieve_model('model.a') == {'weights': [1]})
+
+
+def test_model_batch():
+
+    with tempfile.TemporaryDirectory() as path:
+        store = FlakyStore(path)
+        store.store_model('model.a', 'a')
+        db = types.SimpleNamespace(model_store=store, credentials={})
+
+        # one bulk retrieval, missing models are None
+        batch = ModelBatch(db)
+        models = batch.preload(['model.a', 'model.b', 'model.c'])
+        assert_true(models == {'model.a': 'a', 'model.b': None, 'model.c': None})
+
+        # changed models are written in one flush, failures reported per model
+        batch.put('model.b', 'b')
+        batch.put('broken.c', 'c')
+        failures = batch.flush()
+        assert_true(list(failures.keys()) == ['broken.c'] and isinstance(failures['broken.c'], IOError))
+        assert_true(store.retrieve_model('model.b') == 'b')
+        assert_true(batch.flush() == {})
+
+        # compact models are bundles on disk, a direct retrieval still returns the model
+        batch = ModelBatch(db, compact=True, codec='zlib')
+        batch.put('model.d', {'weights': np.arange(1000.0)})
+        assert_true(batch.flush() == {})
+        assert_true(np.array_equal(FileModelStore(path).retrieve_model('model.d')['weights'], np.arange(1000.0)))
+
+        # through the cache the second bulk retrieval is served from memory
+        db.model_store = CachingModelStore(store)
+        for run in range(2):
+            models = ModelBatch(db).preload(['model.a', 'model.b'])
+        assert_true(models == {'model.a': 'a', 'model.b': 'b'})
+        assert_true(db.model_store.counts()['hits'] == 2 and db.model_store.counts()['misses'] == 2)
+
+
+def test_model_batch_in_functions():
+
+    rng = np.random.default_rng(42)
+    ts = pd.date_range('2021-01-01', periods=50, freq='min')
+    df_i = pd.concat([pd.DataFrame({'entity': entity, 'timestamp': ts, 'Temperature': rng.normal(size=50),
+                                    'Pressure': rng.normal(size=50)}) for entity in ['Pump1', 'Pump2']])
+    df_i = df_i.set_index(['entity', 'timestamp'])
+
+    with tempfile.TemporaryDirectory() as path:
+        scorer = KDEAnomalyScore(1e-6, ['Temperature'], ['Pressure'])
+        et = scorer._build_entity_type(columns=[Column('Temperature', Float()), Column('Pressure', Float())])
+        # set by the pipeline, part of the model names
+        et.name = 'pumps'
+        scorer.name = 'KDEAnomalyScore'
+        et.db = types.SimpleNamespace(model_store=FileModelStore(path), credentials={})
+        scorer._entity_type = et
+
+        # the first run trains and stores both models, the second one loads them
+        for run in range(2):
+            result = scorer.execute(df=df_i)
+
+        store = cache_model_store(et.db)
+        assert_true(store.counts()['stores'] == 2 and store.counts()['hits'] == 2)
+        assert_true(result[scorer.predictions].notna().all().all())
+
+
+def test_local_model_store():
+
+    with tempfile.TemporaryDirectory() as path:
+        store = LocalModelStore(path)
+        weights = np.arange(100000, dtype=np.float64)
+        store.store_model('pumps/model.a', {'weights': weights, 'name': 'a'})
+        store.store_model('model.b', lambda x: 2 * x)
+
+        # arrays of bundles are backed by the memory-mapped file, changes are copied and not written back
+        model = store.retrieve_model('pumps/model.a')
+        assert_true(model['name'] == 'a' and np.array_equal(model['weights'], weights))
+        model['weights'][0] = -1.0
+        assert_true(store.retrieve_model('pumps/model.a')['weights'][0] == 0.0)
+        # models the bundle pickler cannot write are pickled with dill
+        assert_true(store.retrieve_model('model.b')(2) == 4)
+        assert_true(store.model_names() == ['model.b', 'pumps/model.a'])
+
+        # files are replaced, no temporary files are left behind
+        version = store.model_version('model.b')
+        store.store_model('model.b', 'b')
+        assert_true(store.retrieve_model('model.b') == 'b' and store.model_version('model.b') != version)
+        assert_true(len(os.listdir(path)) == 2)
+
+        store.delete_model('model.b')
+        store.delete_model('model.missing')
+        assert_true(store.retrieve_model('model.b') is None and store.model_version('model.b') is MISSING)
+
+
+# readings of 200 pumps, X and y of a regression with 150 features
+make_batch = """
+import numpy as np
+import pandas as pd
+def make_batch(day):
+    rng = np.random.default_rng(day)
+    ts = pd.date_range('2021-01-01', periods=20, freq='min') + pd.Timedelta(days=day)
+    index = pd.MultiIndex.from_product([['Pump' + str(i) for i in range(200)], ts], names=['entity', 'timestamp'])
+    X = rng.normal(size=(500, 150))
+    return pd.DataFrame({'Temperature': rng.normal(size=index.size)}, index=index), X, X @ np.ones(150)
+"""
+
+
+def test_local_model_store_update():
+
+    namespace = {}
+    exec(make_batch, namespace)
+    df_i, X, y = namespace['make_batch'](0)
+
+    with tempfile.TemporaryDirectory() as path:
+        store = LocalModelStore(path)
+        store.store_model('scaler', EntityScaler('standard', ['Temperature'], incremental=True).partial_fit(df_i))
+        state = ChangePointState(detectors['bayesian']())
+        detect_change_points(state, df_i.index, df_i['Temperature'].values)
+        store.store_model('state', state)
+        store.store_model('ridge', IncrementalBayesRidge().partial_fit(X, y))
+
+        # a fresh process updates the retrieved models in place
+        script = (make_batch +
+                  'from mmfunctions.modelstore import LocalModelStore\n'
+                  'from mmfunctions.changepoint import detect_change_points\n'
+                  'store = LocalModelStore(' + repr(path) + ')\n'
+                  'df_i, X, y = make_batch(1)\n'
+                  'scaler = store.retrieve_model("scaler").partial_fit(df_i)\n'
+                  'state = store.retrieve_model("state")\n'
+                  'flags, run_lengths = detect_change_points(state, df_i.index, df_i["Temperature"].values)\n'
+                  'ridge = store.retrieve_model("ridge").partial_fit(X, y)\n'
+                  'print(int(scaler.count.sum()), int(state.last_timestamp.max()), ridge.n)\n')
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+        count, last_timestamp, n = [int(value) for value in output.strip().splitlines()[-1].split()]
+
+    assert_true(count == 8000 and n == 1000)
+    assert_true(last_timestamp == namespace['make_batch'](1)[0].index.get_level_values(1).asi8.max())
+
+
+def test_local_database():
+
+    rng = np.random.default_rng(42)
+    ts = pd.date_range('2021-01-01', periods=50, freq='min')
+    df_i = pd.concat([pd.DataFrame({'entity': entity, 'timestamp': ts, 'Temperature': rng.normal(size=50),
+                                    'Pressure': rng.normal(size=50)}) for entity in ['Pump1', 'Pump2']])
+    df_i = df_i.set_index(['entity', 'timestamp'])
+
+    with tempfile.TemporaryDirectory() as path:
+        results = []
+        # a new scorer and entity type per run, the models come from the directory
+        for run in range(2):
+            scorer = KDEAnomalyScore(1e-6, ['Temperature'], ['Pressure'])
+            scorer.name = 'KDEAnomalyScore'
+            scorer._entity_type = scorer._build_entity_type(name='pumps', db=LocalDatabase(path),
+                                                            columns=[Column('Temperature', Float()),
+                                                                     Column('Pressure', Float())])
+            results.append(scorer.execute(df=df_i)[scorer.predictions])
+
+        assert_true(LocalModelStore(path).model_names() == ['model.pumps.KDEAnomalyScore.Pressure.Pump1',
+                                                            'model.pumps.KDEAnomalyScore.Pressure.Pump2'])
+        assert_true(np.allclose(results[0].values.astype(float), results[1].values.astype(float)))
+
+
+# uncomment to run from the command line
+# test_caching_model_store()
+# test_model_cache_in_functions()
+# test_caching_model_store_invalidation()
+# test_model_batch()
+# test_model_batch_in_functions()
+# test_local_model_store()
+# test_local_model_store_update()
+# test_local_database()
@@ -0,0 +1,105 @@
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, Float
+from mmfunctions.anomaly import GBMRegressor, execute_estimator
+from mmfunctions.modelstore import LocalModelStore, LocalDatabase
+from mmfunctions.parallel import CollectingDatabase, train_entities, worker_payload
+from nose.tools import assert_true
+
+
+class CountingModelStore(object):
+    # counts the retrievals that reach the model store
+    def __init__(self, store):
+        self.store = store
+        self.retrieved = []
+
+    def retrieve_model(self, model_name, deserialize=True):
+        self.retrieved.append(model_name)
+        return self.store.retrieve_model(model_name)
+
+    def store_model(self, model_name, model, user_name=None, serialize=True):
+        self.store.store_model(model_name, model, user_name=user_name, serialize=serialize)
+
+    def delete_model(self, model_name):
+        self.store.delete_model(model_name)
+
+
+class SplitRegressor(GBMRegressor):
+    # same train test split in every process
+    def execute_train_test_split(self, df):
+        test = np.arange(df.shape[0]) % 5 == 0
+        return df[~test], df[test]
+
+
+def make_frame():
+    rng = np.random.default_rng(42)
+    frames = []
+    for i, entity in enumerate(['Pump1', 'Pump2', 'Pump3']):
+        ts = pd.date_range('2021-01-01', periods=300, freq='h')
+        x = rng.normal(size=300)
+        frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts, 'x': x,
+                                    'y': (2 + i) * x + i + rng.normal(0, 0.1, 300)}))
+    return pd.concat(frames).set_index(['entity', 'timestamp'])
+
+
+def test_train_entities():
+
+    df_i = make_frame()
+
+    results = {}
+    for n_jobs in [1, 2]:
+        with tempfile.TemporaryDirectory() as path:
+            regressor = SplitRegressor(['x'], ['y'], ['y_pred'], n_estimators=50, num_leaves=8, learning_rate=0.1)
+            regressor.name = 'GBMRegressor'
+            regressor._entity_type = regressor._build_entity_type(name='pumps', db=LocalDatabase(path),
+                                                                  columns=[Column('x', Float()), Column('y', Float())])
+
+            # jobs see the plain database attributes, no connections and no trace
+            worker = pickle.loads(worker_payload(regressor))
+            assert_true(isinstance(worker._entity_type.db, CollectingDatabase))
+            assert_true(worker._entity_type.db.db_type == 'local' and worker._entity_type.db.tenant_id == 'local')
+            assert_true(regressor._entity_type.db.model_store.path == path)
+
+            written = train_entities(regressor, df_i, ['Pump1', 'Pump2', 'Pump3'], n_jobs=n_jobs)
+            assert_true(len(written) == (3 if n_jobs > 1 else 0))
+
+            regressor.n_jobs = n_jobs
+            results[n_jobs] = regressor.execute(df=df_i)['y_pred']
+            assert_true(len(LocalModelStore(path).model_names()) == 3)
+
+    # models trained in parallel are the models trained serially
+    assert_true(np.allclose(results[1].values.astype(float), results[2].values.astype(float)))
+
+
+def test_train_entities_retrieves_once():
+
+    df_i = make_frame()
+    entities = ['Pump1', 'Pump2', 'Pump3']
+
+    with tempfile.TemporaryDirectory() as path:
+        regressor = SplitRegressor(['x'], ['y'], ['y_pred'], n_estimators=50, num_leaves=8, learning_rate=0.1)
+        regressor.name = 'GBMRegressor'
+        regressor._entity_type = regressor._build_entity_type(name='pumps', db=LocalDatabase(path),
+                                                              columns=[Column('x', Float()), Column('y', Float())])
+        db = regressor._entity_type.db
+
+        # Pump3 has a model, Pump1 and Pump2 are trained over the pool
+        execute_estimator(regressor, df_i.loc[['Pump3']], 'Pump3')
+        store = db.model_store = CountingModelStore(LocalModelStore(path))
+        written = train_entities(regressor, df_i, entities, n_jobs=2)
+        assert_true(len(written) == 2 and len(store.retrieved) == 3)
+
+        # the serial loop is served the retrieved and the trained models instead of retrieving them again
+        for entity in entities:
+            dfe = execute_estimator(regressor, df_i.loc[[entity]], entity)
+            assert_true(dfe['y_pred'].notna().all())
+        assert_true(len(store.retrieved) == 3 and db.model_store is store)
+        assert_true(regressor._prefetched_models == {})
+
+
+# uncomment to run from the command line
+# test_train_entities()
+# test_train_entities_retrieves_once()
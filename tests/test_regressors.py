@@ -0,0 +1,308 @@
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import BayesianRidge
+from sqlalchemy import Column, Float
+from mmfunctions.anomaly import IncrementalBayesRidge, WarmStartGBM, StreamingSGD, SimpleRegressor, GBMRegressor, \
+    GBMForecaster
+from mmfunctions import timing
+from mmfunctions.modelstore import LocalModelStore, LocalDatabase
+from nose.tools import assert_true
+
+
+def make_regression(n=500, seed=42):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 3))
+    y = X @ [1.5, -2.0, 0.5] + 3 + rng.normal(0, 0.3, n)
+    return X, y
+
+
+def make_frame(entities, periods, seed=42, freq='h', start='2021-01-01'):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i, entity in enumerate(entities):
+        ts = pd.date_range(start, periods=periods, freq=freq)
+        x = rng.normal(size=periods)
+        frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts, 'x': x,
+                                    'y': (2 + i) * x + i + rng.normal(0, 0.1, periods)}))
+    return pd.concat(frames).set_index(['entity', 'timestamp'])
+
+
+def build_function(function, path, name):
+    function.name = name
+    function._entity_type = function._build_entity_type(name='pumps', db=LocalDatabase(path),
+                                                        columns=[Column('x', Float()), Column('y', Float())])
+    return function
+
+
+def test_incremental_bayes_ridge():
+
+    X, y = make_regression()
+    expected = BayesianRidge().fit(X, y)
+
+    one = IncrementalBayesRidge().partial_fit(X, y)
+    # the same observations in two batches give the same sufficient statistics
+    two = IncrementalBayesRidge().partial_fit(X[:200], y[:200]).partial_fit(X[200:], y[200:])
+
+    for model in [one, two]:
+        assert_true(np.allclose(model.coef, expected.coef_))
+        assert_true(np.isclose(model.intercept, expected.intercept_))
+        assert_true(np.isclose(model.alpha, expected.alpha_, rtol=1e-6))
+        assert_true(np.isclose(model.lambda_, expected.lambda_, rtol=1e-6))
+
+        mean, std = model.predict(X[:20], return_std=True)
+        expected_mean, expected_std = expected.predict(X[:20], return_std=True)
+        assert_true(np.allclose(mean, expected_mean) and np.allclose(std, expected_std))
+
+
+def test_warm_start_gbm():
+
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(3000, 3))
+    y = 2 * X[:, 0] - X[:, 1] ** 2 + rng.normal(0, 0.1, 3000)
+
+    model = WarmStartGBM(n_estimators=50, update_estimators=10, max_trees=65, seed=0)
+    model.partial_fit(X[:1000], y[:1000])
+    first = model.predict(X[2000:])
+    assert_true(model.booster.current_iteration() == 50)
+
+    # boosting continues from the previous trees, they are kept as they are
+    model.partial_fit(X[1000:2000], y[1000:2000])
+    assert_true(model.booster.current_iteration() == 60)
+    assert_true(np.allclose(model.booster.predict(X[2000:], num_iteration=50), first))
+
+    # beyond max_trees the oldest trees are dropped
+    model.partial_fit(X[1000:2000], y[1000:2000])
+    assert_true(model.booster.current_iteration() == 65 and model.n == 3000)
+
+    # the binning reference is rebuilt after loading, boosting continues from the loaded trees
+    loaded = pickle.loads(pickle.dumps(model))
+    assert_true(loaded.reference is None)
+    assert_true(np.allclose(loaded.predict(X[2000:]), model.predict(X[2000:])))
+    loaded.partial_fit(X[2000:], y[2000:])
+    assert_true(loaded.booster.current_iteration() == 65 and loaded.reference is not None)
+
+
+def test_warm_start_gbm_prune():
+
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(6000, 3))
+    y = 2 * X[:, 0] - X[:, 1] ** 2 + 3 + rng.normal(0, 0.1, 6000)
+    # later batches come from another part of the feature space
+    early, late = X[:, 0] < 0.3, X[:, 0] >= -0.3
+    X_early, y_early, X_late, y_late = X[early], y[early], X[late], y[late]
+
+    model = WarmStartGBM(n_estimators=200, update_estimators=20, max_trees=200, sample_size=1000, seed=0)
+    assert_true(model.decay_rate == 0.9)
+    model.partial_fit(X_early[:2000], y_early[:2000])
+    before = np.mean((model.predict(X_early[2000:]) - y_early[2000:]) ** 2)
+    for batch in range(3):
+        model.partial_fit(X_late[batch * 500:(batch + 1) * 500], y_late[batch * 500:(batch + 1) * 500])
+
+    # the remaining trees are refitted on a sample of all rows, the fit of the earlier rows survives pruning
+    after = np.mean((model.predict(X_early[2000:]) - y_early[2000:]) ** 2)
+    assert_true(model.booster.current_iteration() == 200 and model.history_y.size == 1000)
+    assert_true(after < 2 * before)
+
+    regressor = GBMRegressor(['x'], ['y'], ['y_pred'], warm_start=True, max_trees=100, decay_rate=0.5)
+    assert_true(regressor.decay_rate == 0.5)
+
+
+def test_streaming_sgd():
+
+    X, y = make_regression(n=2000)
+
+    # the scaling of the first batch is kept, later batches with another scale only update the regressor
+    model = StreamingSGD(eta0=0.01, seed=0).partial_fit(X[:1000], y[:1000])
+    mean, scale = model.scaler.mean_.copy(), model.scaler.scale_.copy()
+    model.partial_fit(X[1000:] * 3 + 5, y[1000:])
+    assert_true(np.array_equal(model.scaler.mean_, mean) and np.array_equal(model.scaler.scale_, scale))
+
+    model = StreamingSGD(eta0=0.01, seed=0)
+    for batch in range(10):
+        model.partial_fit(X[batch * 200:(batch + 1) * 200], y[batch * 200:(batch + 1) * 200])
+    assert_true(np.mean((model.predict(X) - y) ** 2) < 0.2)
+
+    df_i = make_frame(['Pump1', 'Pump2', 'Pump3'], 200)
+    df_i.loc['Pump3', 'y'] = np.nan
+    with tempfile.TemporaryDirectory() as path:
+        regressor = build_function(SimpleRegressor(['x'], ['y'], ['y_pred'], streaming=True), path,
+                                   'SimpleRegressor')
+        df_o = regressor.execute(df=df_i)
+        model = LocalModelStore(path).retrieve_model(regressor.get_model_name(['x'], 'y', suffix='streaming.Pump1'))
+        assert_true(model.sgd.eta0 == 0.01)
+
+    # entities without a model are not predicted
+    assert_true(df_o.loc[['Pump1', 'Pump2'], 'y_pred'].notna().all())
+    assert_true(df_o.loc['Pump3', 'y_pred'].isna().all())
+
+    # the SGD regressor has its own learning rate, learning_rate is the one of the boosted models
+    with tempfile.TemporaryDirectory() as path:
+        regressor = build_function(SimpleRegressor(['x'], ['y'], ['y_pred'], learning_rate=0.5, streaming=True,
+                                                   eta0=0.005), path, 'SimpleRegressor')
+        regressor.execute(df=df_i)
+        model = LocalModelStore(path).retrieve_model(regressor.get_model_name(['x'], 'y', suffix='streaming.Pump1'))
+        assert_true(model.sgd.eta0 == 0.005)
+
+
+def test_global_gbm():
+
+    df_i = make_frame(['Pump1', 'Pump2'], 300)
+    df_new = make_frame(['Pump1', 'Pump2', 'Pump3'], 300, seed=1, start='2021-02-01')
+
+    with tempfile.TemporaryDirectory() as path:
+
+        def run(df, shelf_life_days=None):
+            regressor = GBMRegressor(['x'], ['y'], ['y_pred'], n_estimators=50, num_leaves=8, learning_rate=0.1,
+                                     global_model=True, entity_scaling=True)
+            regressor.shelf_life_days = shelf_life_days
+            regressor = build_function(regressor, path, 'GBMRegressor')
+            df_o = regressor.execute(df=df)
+            model = LocalModelStore(path).retrieve_model(regressor.get_model_name(['x'], 'y', suffix='global'))
+            return df_o, model
+
+        df_o, model = run(df_i)
+        assert_true(list(model.entities) == ['Pump1', 'Pump2'] and model.eval_metric_test > 0.9)
+        assert_true(df_o['y_pred'].notna().all())
+
+        # the stored model is loaded and kept
+        df_o, loaded = run(df_i)
+        assert_true(loaded.trained_date == model.trained_date)
+
+        # a new entity gets a model, known entities keep their category
+        df_o, extended = run(df_new, shelf_life_days=0)
+        assert_true(extended.trained_date > model.trained_date)
+        assert_true(list(extended.entities) == ['Pump1', 'Pump2', 'Pump3'])
+        assert_true(df_o['y_pred'].notna().all())
+        error = (df_o['y_pred'] - df_o['y']).abs().groupby(level=0).mean()
+        assert_true((error < 0.5).all())
+
+        # expired models are retrained
+        assert_true(extended.expiry_date == extended.trained_date)
+        df_o, retrained = run(df_new)
+        assert_true(retrained.trained_date > extended.trained_date and retrained.expiry_date is None)
+
+
+def test_gbm_forecaster_missing_reading():
+
+    df_i = make_frame(['Pump1', 'Pump2'], 300)
+    df_i.iloc[100, 1] = np.nan
+
+    with tempfile.TemporaryDirectory() as path:
+        forecaster = build_function(GBMForecaster(['x'], ['y'], lags=[1, 2, 3]), path, 'GBMForecaster')
+        df_o = forecaster.execute(df=df_i)
+
+    # the row with the missing target is left out of training, the entity still gets a model
+    predicted = df_o[forecaster.predictions[0]].notna().groupby(level=0).sum()
+    assert_true(predicted['Pump1'] == predicted['Pump2'] == 298)
+
+
+def test_gbm_forecaster_models():
+
+    df_i = make_frame(['Pump1', 'Pump2', 'Pump3'], 200)
+
+    for global_model in [False, True]:
+        with tempfile.TemporaryDirectory() as path:
+            outputs = []
+            for run in range(2):
+                forecaster = build_function(GBMForecaster(['x'], ['y'], lags=[1, 2, 3], global_model=global_model),
+                                            path, 'GBMForecaster')
+                outputs.append(forecaster.execute(df=df_i))
+            prediction = forecaster.predictions[0]
+
+            # the second run predicts with the stored models
+            assert_true(np.allclose(outputs[0][prediction].values.astype(float),
+                                    outputs[1][prediction].values.astype(float)))
+
+            # predictions are those of the models applied to the inference features of each entity
+            _, df_inference = forecaster.lag_features(df=df_i, Train=False)
+            if global_model:
+                model = LocalModelStore(path).retrieve_model(
+                    forecaster.get_model_name(forecaster.features, 'y', suffix='global'))
+                expected = model.predict(df_inference, df_inference[forecaster.features].to_numpy(dtype=np.float64))
+            else:
+                models = forecaster.load_models(['Pump1', 'Pump2', 'Pump3'])
+                expected = np.concatenate([models[entity][0].predict(df_inference.loc[[entity]])
+                                           for entity in ['Pump1', 'Pump2', 'Pump3']])
+            assert_true(outputs[1].shape[0] == df_inference.shape[0])
+            assert_true(np.allclose(outputs[1][prediction].values.astype(float), expected))
+
+
+def test_gbm_forecaster_horizons():
+
+    def make_series(entities, start='2021-01-01'):
+        rng = np.random.default_rng(3)
+        frames = []
+        for i, entity in enumerate(entities):
+            ts = pd.date_range(start, periods=400, freq='h')
+            y = np.sin(2 * np.pi * (np.arange(400) + 5 * i) / 24) + i + rng.normal(0, 0.05, 400)
+            frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts, 'x': y, 'y': y}))
+        return pd.concat(frames).set_index(['entity', 'timestamp'])
+
+    with tempfile.TemporaryDirectory() as path:
+
+        def run(df):
+            forecaster = build_function(GBMForecaster(['x'], ['y'], lags=[1, 2, 3], horizons=[1, 3]), path,
+                                        'GBMForecaster')
+            df_o = forecaster.execute(df=df)
+            models = [LocalModelStore(path).retrieve_model(
+                forecaster.get_model_name(forecaster.features, 'y', suffix='horizon.' + str(horizon)))
+                for horizon in [1, 3]]
+            return forecaster, df_o, models
+
+        forecaster, df_o, models = run(make_series(['Pump1', 'Pump2']))
+        assert_true(forecaster.horizon_predictions == ['y_forecast_1', 'y_forecast_3'])
+        assert_true(df_o[forecaster.horizon_predictions].notna().all().all())
+        # boosters are trained on the features of lag_features, calendar features included
+        assert_true(all(model.features == forecaster.features for model in models))
+        for horizon, column in zip([1, 3], forecaster.horizon_predictions):
+            ahead = df_o.groupby(level=0)['y'].shift(-horizon)
+            known = ahead.notna()
+            assert_true(np.corrcoef(df_o[column][known], ahead[known])[0, 1] > 0.95)
+
+        # stored boosters are loaded, a new entity has them retrained
+        _, _, loaded = run(make_series(['Pump1', 'Pump2'], start='2021-02-01'))
+        assert_true(all(a.trained_date == b.trained_date for a, b in zip(models, loaded)))
+        _, df_o, extended = run(make_series(['Pump1', 'Pump2', 'Pump3'], start='2021-03-01'))
+        assert_true(all(list(model.entities) == ['Pump1', 'Pump2', 'Pump3'] for model in extended))
+        assert_true(df_o.loc['Pump3', forecaster.horizon_predictions].notna().all().all())
+
+
+def test_regressor_stage_timing():
+
+    df_i = make_frame(['Pump1', 'Pump2'], 200)
+
+    with tempfile.TemporaryDirectory() as path:
+        timing.recent_runs.clear()
+        timing.enable(True)
+        try:
+            build_function(GBMRegressor(['x'], ['y'], ['y_pred'], n_estimators=20, num_leaves=8), path,
+                           'GBMRegressor').execute(df=df_i)
+            build_function(SimpleRegressor(['x'], ['y'], ['y_pred'], streaming=True), path,
+                           'SimpleRegressor').execute(df=df_i)
+            build_function(GBMForecaster(['x'], ['y'], lags=[1, 2, 3]), path, 'GBMForecaster').execute(df=df_i)
+        finally:
+            timing.enable(False)
+
+    assert_true([summary['function'] for summary in timing.recent_runs] ==
+                ['GBMRegressor', 'SimpleRegressor', 'GBMForecaster'])
+    for summary in timing.recent_runs:
+        stages = summary['stages']
+        # fit and score per entity, nested stages are not counted twice
+        assert_true(all(stage in stages for stage in ['fit', 'score', 'write_back']))
+        assert_true(sorted(e for e, t in stages['fit']['slowest_entities']) == ['Pump1', 'Pump2'])
+        assert_true(sum(stage['share'] for stage in stages.values()) <= 1.0)
+
+
+# uncomment to run from the command line
+# test_incremental_bayes_ridge()
+# test_warm_start_gbm()
+# test_warm_start_gbm_prune()
+# test_streaming_sgd()
+# test_global_gbm()
+# test_gbm_forecaster_missing_reading()
+# test_gbm_forecaster_models()
+# test_gbm_forecaster_horizons()
+# test_regressor_stage_timing()
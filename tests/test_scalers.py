@@ -0,0 +1,97 @@
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler, RobustScaler, MinMaxScaler
+from sqlalchemy import Column, Float
+from mmfunctions.anomaly import Standard_Scaler, Robust_Scaler, MinMax_Scaler, EntityScaler
+from mmfunctions.modelstore import LocalModelStore, LocalDatabase
+from nose.tools import assert_true
+
+# constants
+Temperature = 'Temperature'
+Pressure = 'Pressure'
+scaled = ['TemperatureScaled', 'PressureScaled']
+
+
+def make_frame():
+    rng = np.random.default_rng(42)
+    frames = []
+    for i, entity in enumerate(['Pump1', 'Pump2', 'Pump3']):
+        ts = pd.date_range('2021-01-01', periods=200, freq='min')
+        frames.append(pd.DataFrame({'entity': entity, 'timestamp': ts,
+                                    Temperature: rng.normal(20 + i, 1 + i, 200),
+                                    Pressure: rng.normal(5 * i, 2, 200)}))
+    df = pd.concat(frames).set_index(['entity', 'timestamp'])
+
+    # one broken entity
+    df.loc[('Pump3', df.loc['Pump3'].index[5]), Temperature] = np.nan
+    return df
+
+
+def test_vectorized_scalers():
+
+    df_i = make_frame()
+
+    for scaler_class, sk_scaler in [(Standard_Scaler, StandardScaler), (Robust_Scaler, RobustScaler),
+                                    (MinMax_Scaler, MinMaxScaler)]:
+
+        print('Compute vectorized ' + scaler_class.__name__)
+        scaler = scaler_class([Temperature, Pressure], [Temperature, Pressure], scaled, vectorized=True)
+        et = scaler._build_entity_type(columns=[Column(Temperature, Float()), Column(Pressure, Float())])
+        scaler._entity_type = et
+        df_o = scaler.execute(df=df_i)
+
+        for entity in ['Pump1', 'Pump2']:
+            expected = sk_scaler().fit_transform(df_i.loc[entity][[Temperature, Pressure]].values)
+            assert_true(np.allclose(df_o.loc[entity][scaled].values.astype(float), expected))
+
+        # entity with NaN is not scaled
+        assert_true(df_o.loc['Pump3'][scaled].isna().all().all())
+
+
+def test_incremental_scaler():
+
+    df_i = make_frame().dropna()
+    first = df_i.index.get_level_values(1) < pd.Timestamp('2021-01-01 02:00')
+
+    for method in ['standard', 'minmax', 'robust']:
+        print('Update ' + method + ' scaler incrementally')
+        batch_scaler = EntityScaler(method, [Temperature, Pressure]).fit(df_i)
+        inc_scaler = EntityScaler(method, [Temperature, Pressure], incremental=True)
+
+        inc_scaler.partial_fit(df_i[first])
+        # overlapping second batch - rows of the first batch must not be counted again
+        inc_scaler.partial_fit(df_i[inc_scaler.new_rows(df_i)])
+
+        assert_true(np.allclose(inc_scaler.count.sum(axis=0), df_i.shape[0]))
+        tolerance = 0.1 if method == 'robust' else 1e-9
+        assert_true(np.allclose(inc_scaler.transform(df_i), batch_scaler.transform(df_i), atol=tolerance))
+
+
+def test_incremental_scaler_auto_train():
+
+    df_i = make_frame().dropna()
+
+    with tempfile.TemporaryDirectory() as path:
+        scaler = Standard_Scaler([Temperature, Pressure], [Temperature, Pressure], scaled, incremental=True)
+        scaler.name = 'Standard_Scaler'
+        scaler._entity_type = scaler._build_entity_type(name='pumps', db=LocalDatabase(path),
+                                                        columns=[Column(Temperature, Float()),
+                                                                 Column(Pressure, Float())])
+
+        # without training the statistics are neither updated nor stored
+        scaler.auto_train = False
+        scaler.execute(df=df_i)
+        assert_true(LocalModelStore(path).model_names() == [])
+
+        scaler.auto_train = True
+        df_o = scaler.execute(df=df_i)
+        assert_true(len(LocalModelStore(path).model_names()) == 1)
+        assert_true(df_o[scaled].notna().all().all())
+
+
+# uncomment to run from the command line
+# test_vectorized_scalers()
+# test_incremental_scaler()
+# test_incremental_scaler_auto_train()
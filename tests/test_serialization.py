@@ -0,0 +1,49 @@
+import pickle
+
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler
+from statsmodels.nonparametric.kernel_density import KDEMultivariate
+from mmfunctions import serialization
+from mmfunctions.variational import VI
+from nose.tools import assert_true
+
+
+def test_model_bundle():
+
+    rng = np.random.default_rng(42)
+    xy = rng.normal(size=(2000, 2))
+    kde = KDEMultivariate(xy, var_type='cc', bw=[0.3, 0.2])
+    scaler = StandardScaler().fit(xy[:, :1])
+    vi = VI(scaler, prior_sigma=2.0, adjust_mean=1.5, version=3)
+
+    for codec in ['none', 'zlib']:
+        # arrays are kept out of the pickled structure
+        bundle = serialization.dumps({'kde': kde, 'vi': vi}, codec=codec)
+        assert_true(serialization.is_bundle(bundle))
+        assert_true(len(bundle) < len(pickle.dumps({'kde': kde, 'vi': vi})))
+
+        models = serialization.loads(bundle)
+        # stores that pickle the bundle hand out the model
+        assert_true(np.allclose(pickle.loads(pickle.dumps(bundle))['kde'].bw, [0.3, 0.2]))
+        assert_true(np.allclose(models['kde'].pdf(xy[:10]), kde.pdf(xy[:10])))
+        assert_true(np.allclose(models['kde'].bw, [0.3, 0.2]))
+        assert_true(models['vi'].version == 3 and models['vi'].adjust_mean == 1.5)
+        assert_true(np.allclose(models['vi'].scaler.mean_, scaler.mean_))
+        with torch.no_grad():
+            x = torch.ones(3, 1)
+            assert_true(torch.allclose(models['vi'](x)[1], vi(x)[1]))
+
+    # arrays of read-only data are copied, models update them in place
+    assert_true(serialization.loads(serialization.dumps(np.arange(1000.0), codec='none')).flags.writeable)
+
+    # lazy models are rebuilt on first use and written as the model itself
+    lazy = serialization.loads(serialization.dumps(kde), lazy=True)
+    assert_true(lazy._model is None)
+    assert_true(np.allclose(lazy.pdf(xy[:10]), kde.pdf(xy[:10])))
+    assert_true(type(pickle.loads(pickle.dumps(lazy))) is KDEMultivariate)
+    assert_true(len(serialization.dumps(lazy)) == len(serialization.dumps(kde)))
+
+
+# uncomment to run from the command line
+# test_model_bundle()
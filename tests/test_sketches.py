@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from mmfunctions.anomaly import (HistogramAggregator, HistogramDirectAggregator, HistogramSketchAggregator,
+                                 HistogramSketchMerge, QuantileAggregator, QuantileSketchAggregator, QuantileSketchMerge)
+from mmfunctions.sketches import HistogramSketch, KLLSketch
+from nose.tools import assert_true
+
+
+def make_frame():
+    rng = np.random.default_rng(42)
+    frames = []
+    for entity in ['Pump1', 'Pump2']:
+        ts = pd.date_range('2021-01-01', periods=3 * 24 * 60, freq='min')
+        frames.append(pd.DataFrame({'deviceid': entity, 'timestamp': ts,
+                                    'Temperature': rng.lognormal(3, 0.5, ts.size)}))
+    return pd.concat(frames).set_index(['deviceid', 'timestamp'])
+
+
+def test_histogram_sketch_rollup():
+
+    df = make_frame()
+
+    for kind in ['log', 'fixed']:
+        print('Roll up ' + kind + ' histogram sketches from hours to days')
+        aggregator = HistogramSketchAggregator('Temperature', kind=kind, bins=20, low=0, high=100)
+        hourly = df.groupby([pd.Grouper(freq='1H', level='timestamp'),
+                             pd.Grouper(level='deviceid')])['Temperature'].agg(aggregator.execute)
+        daily = hourly.groupby([pd.Grouper(freq='1D', level='timestamp'),
+                                pd.Grouper(level='deviceid')]).agg(HistogramSketchMerge('Temperature').execute)
+        direct = df.groupby([pd.Grouper(freq='1D', level='timestamp'),
+                             pd.Grouper(level='deviceid')])['Temperature'].agg(aggregator.execute)
+
+        for merged, expected in zip(daily.values, direct.values):
+            merged, expected = HistogramSketch.decode(merged), HistogramSketch.decode(expected)
+            assert_true(merged.n == expected.n == 24 * 60)
+            assert_true(np.array_equal(merged.histogram()[1], expected.histogram()[1]))
+
+        # quantiles of log sketches stay within the relative accuracy
+        if kind == 'log':
+            values = df.loc['Pump1', 'Temperature'].values[:24 * 60]
+            sketch = HistogramSketch.decode(daily.loc[(slice(None), 'Pump1')].values[0])
+            assert_true(np.allclose(sketch.quantile([0.1, 0.5, 0.9]), np.quantile(values, [0.1, 0.5, 0.9]),
+                                    rtol=0.02))
+
+
+def test_histogram_direct_aggregator():
+
+    df = make_frame()
+    df.iloc[5, 0] = np.nan
+    group_base = [pd.Grouper(freq='1h', level='timestamp'), pd.Grouper(level='deviceid')]
+
+    aggregator = HistogramDirectAggregator('Temperature', 10, name='histogram')
+    assert_true(aggregator.is_direct_aggregator and not getattr(aggregator, 'is_simple_aggregator', False))
+    df_o = aggregator.execute(df=df, group_base=group_base, group_base_names=['timestamp', 'deviceid'])
+
+    # one pass over all groups gives the histograms of the per group aggregator
+    expected = df.groupby(group_base)['Temperature'].agg(HistogramAggregator('Temperature', 10).execute)
+    assert_true(list(df_o.columns) == ['histogram'] and df_o.index.names == ['timestamp', 'deviceid'])
+    assert_true(df_o.shape[0] == 3 * 24 * 2 and (df_o['histogram'] == expected).all())
+    assert_true(df_o['histogram'].iloc[0] == '')
+
+    # numeric encoding, the densities of the string encoding in one float32 column per bin
+    numeric = HistogramDirectAggregator('Temperature', 10, name='histogram', encoding='numeric')
+    df_n = numeric.execute(df=df, group_base=group_base, group_base_names=['timestamp', 'deviceid'])
+    assert_true(list(df_n.columns) == ['histogram_' + str(i) for i in range(10)])
+    assert_true(df_n.index.equals(df_o.index) and (df_n.dtypes == np.float32).all())
+    assert_true(df_n.iloc[0].isna().all())
+    densities = np.array([np.array(text.strip('[]').split(), dtype=np.float64) for text in df_o['histogram'].iloc[1:]])
+    assert_true(np.allclose(df_n.iloc[1:].to_numpy(dtype=np.float64), densities, rtol=1e-6))
+
+
+def test_quantile_sketch_rollup():
+
+    df = make_frame()
+    hours = [pd.Grouper(freq='1H', level='timestamp'), pd.Grouper(level='deviceid')]
+    days = [pd.Grouper(freq='1D', level='timestamp'), pd.Grouper(level='deviceid')]
+
+    exact = df.groupby(days)['Temperature'].quantile(0.95)
+
+    # quantiles from raw values and from hourly sketches rolled up to days
+    direct = df.groupby(days)['Temperature'].agg(QuantileAggregator('Temperature', quantile=0.95).execute)
+    hourly = df.groupby(hours)['Temperature'].agg(QuantileSketchAggregator('Temperature').execute)
+    daily = hourly.groupby(days).agg(QuantileSketchMerge('Temperature').execute)
+    rolled_up = daily.groupby(level=[0, 1]).agg(QuantileAggregator('Temperature', quantile=0.95).execute)
+
+    assert_true(np.allclose(direct.values, exact.values, rtol=0.05))
+    assert_true(np.allclose(rolled_up.values, exact.values, rtol=0.05))
+
+    # sketch size does not depend on the number of events
+    sketches = [KLLSketch.decode(text) for text in daily.values]
+    assert_true(all(len(sketch) == 24 * 60 for sketch in sketches))
+    assert_true(max(sketch.size for sketch in sketches) < 3 * 200)
+
+
+# uncomment to run from the command line
+# test_histogram_sketch_rollup()
+# test_histogram_direct_aggregator()
+# test_quantile_sketch_rollup()
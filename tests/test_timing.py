@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, Float
+from mmfunctions import timing
+from mmfunctions.anomaly import KDEAnomalyScore
+from mmfunctions.modelstore import LocalDatabase
+from nose.tools import assert_true
+
+
+def test_stage_timing():
+
+    rng = np.random.default_rng(42)
+    ts = pd.date_range('2021-01-01', periods=50, freq='min')
+    df_i = pd.concat([pd.DataFrame({'entity': entity, 'timestamp': ts, 'Temperature': rng.normal(size=50),
+                                    'Pressure': rng.normal(size=50)}) for entity in ['Pump1', 'Pump2']])
+    df_i = df_i.set_index(['entity', 'timestamp'])
+
+    with tempfile.TemporaryDirectory() as path:
+        scorer = KDEAnomalyScore(1e-6, ['Temperature'], ['Pressure'])
+        scorer.name = 'KDEAnomalyScore'
+        scorer._entity_type = scorer._build_entity_type(name='pumps', db=LocalDatabase(path),
+                                                        columns=[Column('Temperature', Float()),
+                                                                 Column('Pressure', Float())])
+
+        # off by default, stages are shared no-op timers
+        assert_true(timing.stage(scorer, 'fit') is timing.stage(scorer, 'score'))
+        timing.recent_runs.clear()
+        scorer.execute(df=df_i)
+        assert_true(len(timing.recent_runs) == 0)
+
+        export_path = os.path.join(path, 'timings.json')
+        timing.enable(True, path=export_path)
+        try:
+            scorer.execute(df=df_i)
+        finally:
+            timing.enable(False)
+            timing.export_path = None
+
+        assert_true(len(timing.recent_runs) == 1)
+        summary = timing.recent_runs[-1]
+        assert_true(summary['function'] == 'KDEAnomalyScore' and summary['seconds'] > 0)
+        assert_true('model_io' in summary['stages'] and 'score' in summary['stages'])
+        assert_true(sum(stage['share'] for stage in summary['stages'].values()) <= 1.0)
+        assert_true(sorted(e for e, t in summary['stages']['score']['slowest_entities']) == ['Pump1', 'Pump2'])
+        assert_true(getattr(scorer, '_stage_timings', None) is None)
+
+        # the summary goes to the trace and to the export file
+        with open(export_path) as f:
+            assert_true(json.load(f)[-1]['stages'].keys() == summary['stages'].keys())
+        metrics = timing.openmetrics()
+        assert_true('mmfunctions_stage_seconds_total{function="KDEAnomalyScore",stage="score"}' in metrics)
+        assert_true(metrics.endswith('# EOF\n'))
+
+
+def test_cumulative_counters():
+
+    def runs_total(metrics):
+        prefix = 'mmfunctions_function_runs_total{function="Dummy"} '
+        lines = [line for line in metrics.splitlines() if line.startswith(prefix)]
+        return int(lines[0][len(prefix):]) if lines else 0
+
+    summary = {'function': 'Dummy', 'timestamp': 0.0, 'seconds': 0.5,
+               'stages': {'fit': {'calls': 2, 'seconds': 0.25, 'max': 0.25, 'share': 0.5, 'slowest_entities': []}}}
+
+    # the counters keep growing when the oldest runs leave recent_runs
+    previous = runs_total(timing.openmetrics())
+    for batch in range(2):
+        for run in range(timing.recent_runs.maxlen):
+            timing.report(object(), summary)
+        current = runs_total(timing.openmetrics())
+        assert_true(current == previous + timing.recent_runs.maxlen)
+        previous = current
+
+    assert_true(len(timing.recent_runs) == timing.recent_runs.maxlen)
+    assert_true(timing.totals()['Dummy']['stages']['fit']['calls'] == 2 * previous)
+    assert_true(timing.totals(list(timing.recent_runs))['Dummy']['runs'] == timing.recent_runs.maxlen)
+
+
+# uncomment to run from the command line
+# test_stage_timing()
+# test_cumulative_counters()